@@ -0,0 +1,164 @@
+"""
+Remember what is in a backup_dir so finding a backup doesn't mean decrypting anything or guessing from filenames
+
+The catalog is a sqlite database in the backup_dir that backup adds a row to for each backup it makes (or fails to make).
+It isn't encrypted, so it says which databases and tables are backed up there but nothing that's in them.
+"""
+from db_backup.errors import BadBackupDir
+
+from contextlib import contextmanager
+import calendar
+import datetime
+import sqlite3
+import json
+import os
+
+# The file in the backup_dir that holds the catalog
+CATALOG_FILENAME = ".db_backup_catalog"
+
+# How long we wait for another backup to finish writing to the catalog
+LOCK_TIMEOUT = 60
+
+SCHEMA = """
+    create table if not exists backups
+    ( id integer primary key
+    , filename text not null
+    , engine text
+    , database text
+    , kind text
+    , dump_format text
+    , started real not null
+    , finished real not null
+    , succeeded integer not null
+    , error text
+    , plaintext_size integer
+    , ciphertext_size integer
+    , codec text
+    , encryption text
+    , recipients text
+    , rows text
+    );
+    create index if not exists backups_by_database on backups (database, succeeded, finished);
+    create index if not exists backups_by_finished on backups (finished);
+    create index if not exists backups_by_filename on backups (filename);
+"""
+
+def as_timestamp(when):
+    """Return a unix timestamp for a datetime (UTC unless it says otherwise) or a timestamp"""
+    if isinstance(when, datetime.datetime):
+        if when.tzinfo is not None:
+            when = (when - when.utcoffset()).replace(tzinfo=None)
+        return calendar.timegm(when.timetuple()) + when.microsecond / 1e6
+    return when
+
+class CatalogEntry(object):
+    """What the catalog knows about one backup"""
+    ATTRS = (
+          "filename", "engine", "database", "kind", "dump_format", "started", "finished", "succeeded", "error"
+        , "plaintext_size", "ciphertext_size", "codec", "encryption", "recipients", "rows"
+        )
+
+    def __init__(self, backup_dir, filename, engine=None, database=None, kind="full", started=None, finished=None
+        , succeeded=True, error=None, plaintext_size=None, ciphertext_size=None, codec=None, encryption=None
+        , recipients=None, rows=None, dump_format=None
+        ):
+        self.kind = kind
+        self.rows = rows
+        self.error = error
+        self.codec = codec
+        self.engine = engine
+        self.started = started
+        self.finished = finished
+        self.database = database
+        self.filename = filename
+        self.dump_format = dump_format
+        self.succeeded = bool(succeeded)
+        self.encryption = encryption
+        self.recipients = list(recipients or [])
+        self.backup_dir = backup_dir
+        self.plaintext_size = plaintext_size
+        self.ciphertext_size = ciphertext_size
+
+    @property
+    def location(self):
+        """Where the backup file is"""
+        return os.path.join(self.backup_dir, self.filename)
+
+    def as_dict(self):
+        """Return what the catalog knows about this backup as a dictionary"""
+        return dict((key, getattr(self, key)) for key in CatalogEntry.ATTRS)
+
+    def __repr__(self):
+        return "<CatalogEntry {0} of {1} ({2})>".format(self.filename, self.database, "succeeded" if self.succeeded else "failed")
+
+class Catalog(object):
+    """The catalog of the backups in a backup_dir"""
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+
+    @property
+    def path(self):
+        """Where the catalog lives"""
+        return os.path.join(self.backup_dir, CATALOG_FILENAME)
+
+    @contextmanager
+    def connection(self, create=False):
+        """Yield a connection to the catalog, making it first if create and it doesn't exist yet"""
+        if not create and not os.path.exists(self.path):
+            raise BadBackupDir("There is no catalog in the backup directory at '{0}'".format(self.backup_dir))
+
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        try:
+            if create:
+                connection.executescript(SCHEMA)
+            yield connection
+        finally:
+            connection.close()
+
+    def add(self, entry):
+        """Add an entry for a backup to the catalog"""
+        values = entry.as_dict()
+        values["recipients"] = json.dumps(entry.recipients)
+        values["rows"] = json.dumps(entry.rows) if entry.rows is not None else None
+        values["succeeded"] = int(entry.succeeded)
+
+        with self.connection(create=True) as connection:
+            with connection:
+                connection.execute("insert into backups ({0}) values ({1})".format(
+                      ", ".join(CatalogEntry.ATTRS), ", ".join("?" for _ in CatalogEntry.ATTRS)
+                    ), [values[key] for key in CatalogEntry.ATTRS])
+
+    def latest(self, database, succeeded=True):
+        """Return the CatalogEntry for the newest backup of this database that succeeded (or failed) or None if there isn't one"""
+        found = self.select("where database = ? and succeeded = ? order by finished desc limit 1", database, int(succeeded))
+        return found[0] if found else None
+
+    def find(self, filename):
+        """Return the CatalogEntry for the backup with this filename that succeeded or None if there isn't one"""
+        found = self.select("where filename = ? and succeeded = 1 order by finished desc limit 1", filename)
+        return found[0] if found else None
+
+    def between(self, start, end, database=None, succeeded=True):
+        """
+        Return CatalogEntries for the backups (of database if we have one) that succeeded (or failed)
+        and finished between start and end, oldest first
+
+        start and end are datetimes (in UTC unless they say otherwise) or timestamps
+        """
+        start, end = as_timestamp(start), as_timestamp(end)
+        if database is None:
+            return self.select("where succeeded = ? and finished between ? and ? order by finished", int(succeeded), start, end)
+        return self.select("where database = ? and succeeded = ? and finished between ? and ? order by finished", database, int(succeeded), start, end)
+
+    def select(self, condition, *args):
+        """Return CatalogEntries for the rows of the catalog that match this sql condition"""
+        with self.connection() as connection:
+            rows = connection.execute("select {0} from backups {1}".format(", ".join(CatalogEntry.ATTRS), condition), args).fetchall()
+
+        entries = []
+        for row in rows:
+            values = dict(zip(CatalogEntry.ATTRS, row))
+            values["recipients"] = json.loads(values["recipients"] or "[]")
+            values["rows"] = json.loads(values["rows"]) if values["rows"] else None
+            entries.append(CatalogEntry(self.backup_dir, **values))
+        return entries
@@ -0,0 +1,51 @@
+"""Split a stream into chunks where it's content says to, so the same content is chunked the same way wherever it is"""
+import zlib
+
+# A chunk is at least MINIMUM_SIZE bytes and about AVERAGE_SIZE bytes more than that on average
+MINIMUM_SIZE = 256 * 1024
+AVERAGE_SIZE = 768 * 1024
+
+# A chunk that gets this big without ending is cut here
+MAXIMUM_SIZE = 8 * 1024 * 1024
+
+# How many bytes up to a newline decide whether it ends a chunk
+WINDOW_SIZE = 64
+
+def content_defined(chunks, minimum=MINIMUM_SIZE, average=AVERAGE_SIZE, maximum=MAXIMUM_SIZE, window=WINDOW_SIZE):
+    """
+    Yield strings made from the chunks we're given that end where their content says to
+
+    A chunk may only end at a newline (sql dumps are made of lines and binary data has one every 256 bytes or so)
+    and does when the crc32 of the window of bytes up to it is small enough. The longer the line before the newline,
+    the more likely it is to end a chunk, so chunks come out about the same size however long the lines are.
+
+    Whether a newline ends a chunk only depends on the bytes just before it, so adding or removing something
+    only changes the chunks around it and the rest of the stream is chunked the same as before.
+    """
+    pending = bytearray()
+    scan = 0
+    for chunk in chunks:
+        pending.extend(chunk)
+        while True:
+            found = pending.find("\n", max(scan, minimum - 1))
+            if found == -1 or found >= maximum:
+                if len(pending) < maximum:
+                    scan = len(pending)
+                    break
+
+                yield str(pending[:maximum])
+                del pending[:maximum]
+                scan = 0
+                continue
+
+            end = found + 1
+            line = found - pending.rfind("\n", 0, found)
+            if (zlib.crc32(str(pending[max(0, end - window):end])) & 0xffffffff) * average < line << 32:
+                yield str(pending[:end])
+                del pending[:end]
+                scan = 0
+            else:
+                scan = end
+
+    if pending:
+        yield str(pending)
@@ -1,39 +1,654 @@
-from db_backup.errors import BadBackupFile, NonEmptyDatabase
+from db_backup.errors import BadBackupFile, BadBackupDir, NonEmptyDatabase, FailedBackup, FailedVerification, NotIncremental
+from db_backup.manifest import StreamHash, Manifest
+from db_backup.catalog import Catalog, CatalogEntry
+from db_backup.incremental import ChainLink
+from db_backup.tables import TableIndex
 from db_backup.databases import DatabaseHandler
-from db_backup.encryption import Encryptor
+from db_backup.processes import (
+      Pipeline, ProcessStage, Fanout, supervise_all, run_concurrently, check_for_command
+    , DEFAULT_IDLE_TIMEOUT, FANOUT_BUFFER_SIZE
+    )
+from db_backup.encryption import Encryptor, ChunkedEncryptor, DedupEncryptor, encryptor_for
+from db_backup.compression import find_codec
 
+from contextlib import contextmanager
 import urlparse
+import calendar
+import logging
+import sqlite3
+import pipes
 import time
+import sys
 import os
 
+log = logging.getLogger("db_backup")
+
+class Result(object):
+    """
+    What happened during a backup or restore
+
+    location is the backup file that was written or restored from, locations is every file a backup wrote
+    and stages is the ProcessStats of each process involved, in the order they finished
+    """
+    def __init__(self, location, locations=None):
+        self.stages = []
+        self.location = location
+        self.locations = locations or [location]
+
+    def collector(self, metrics=None):
+        """Return a metrics callback that records stats on this result and then passes them onto metrics"""
+        def collect(stats):
+            self.stages.append(stats)
+            if metrics is not None:
+                metrics(stats)
+        return collect
+
 def make_backup_filename():
     """Return a string for the filename of a backup"""
     return "db_backup_{0}.gpg".format(time.time())
 
-def backup(database_settings, recipients, backup_dir, filename_maker=None, gpg_home=None):
-    """Backup the database into the specified backup_dir for our recipients"""
+def backup(database_settings, recipients, backup_dir, filename_maker=None, gpg_home=None
+    , idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None, compression=None, chunked=False
+    , targets=None, buffer_size=FANOUT_BUFFER_SIZE, manifest=False, signer=None, incremental=False, base_backup=False
+    , dedup=False, table_index=False
+    ):
+    """
+    Backup the database into the specified backup_dir for our recipients
+    and return a Result saying where it went and what each process cost
+
+    compression is the name of a codec (see db_backup.compression) to compress the dump with before gpg gets it,
+    or None to let gpg compress it
+
+    chunked makes a container of chunks that are encrypted and decrypted in parallel (see ChunkedEncryptor)
+    rather than one stream from one gpg
+
+    dedup splits the dump into chunks where it's content says to and only stores the chunks that aren't already
+    in backup_dir from an earlier deduplicated backup (see DedupEncryptor), so similar backups take little space.
+    Compressing first would change every chunk after a change, so it can't be used with compression.
+
+    table_index writes where each table is in the dump into a .tables file next to the backup, encrypted for
+    the recipients, so restore can restore only some of the tables (see db_backup.tables).
+    Like manifest, this means the dump passes through python.
+
+    targets is a list of more (recipients, backup_dir) that get their own copy of the same dump,
+    so the database is only dumped once. A target that falls behind gets up to buffer_size bytes
+    behind the others before they all wait for it.
+
+    manifest writes the sha256 and size of the dump and of each backup file next to the backup
+    (see db_backup.manifest) so verify can check the backup without restoring it, signed by signer if we have one.
+    This means the dump passes through python to be hashed, so it's off unless asked for.
+
+    incremental only dumps what changed since the last incremental backup of this database in backup_dir
+    and writes a chain file next to the backup saying which backups restore needs (see db_backup.incremental).
+    The first backup of a chain is a full backup. Only some engines (i.e. sqlite3_file) can do this
+    and the chain only lives in one backup_dir, so it can't be used with targets.
+
+    base_backup copies the whole cluster the database lives in (i.e. with pg_basebackup) instead of dumping
+    the database, for point_in_time_restore with the WAL that archive_wal has archived since.
+
+    Every backup (even one that fails) is added to the catalog in it's backup_dir (see db_backup.catalog)
+    along with how many rows each table had, if the database can tell us without counting them.
+
+    Each process involved is killed if it goes idle_timeout seconds without progress
+    or takes longer than total_timeout seconds
+
+    metrics is called with the ProcessStats of each process when it's done
+    """
     if filename_maker is None:
         filename_maker = make_backup_filename
 
-    filename = filename_maker()
-    destination = os.path.join(backup_dir, filename)
+    targets = [(recipients, backup_dir)] + list(targets or [])
+    destinations = [(recipients, os.path.join(backup_dir, filename_maker())) for recipients, backup_dir in targets]
+    result = Result(destinations[0][1], [destination for _, destination in destinations])
+    if incremental and len(targets) > 1:
+        raise ValueError("Incremental backups can only go to one backup_dir")
+    if dedup and compression:
+        raise ValueError("Deduplicated backups can't be compressed first, gpg compresses each chunk instead")
+    if table_index and (incremental or base_backup):
+        raise ValueError("Can only index the tables of a full dump of the database")
+
+    manifests = None
+    if manifest:
+        plaintext = StreamHash()
+        manifests = [Manifest(destination, plaintext) for _, destination in destinations]
 
+    if dedup:
+        encryptor = DedupEncryptor()
+    else:
+        encryptor = ChunkedEncryptor() if chunked else Encryptor()
     database_handler = DatabaseHandler(database_settings)
-    Encryptor().encrypt(database_handler.dump(), recipients, destination, gpg_home=gpg_home)
-    return destination
+    codec = find_codec(compression) if compression else None
+    tables = database_handler.table_index() if table_index else None
+
+    checks = [lambda: database_handler.check_commands("base_backup" if base_backup else "dump")]
+    for recipients, backup_dir in targets:
+        checks.append(lambda recipients=recipients: encryptor.check_recipients(recipients, gpg_home))
+        checks.append(lambda backup_dir=backup_dir: check_writable(backup_dir))
+    if codec:
+        checks.append(lambda: codec.check_commands("compress"))
+    if signer:
+        checks.append(lambda: encryptor.find_key(signer, gpg_home, capability="s"))
+    checks.append(lambda: count_rows(database_handler))
+    rows = run_concurrently(*checks)[-1]
+
+    link = previous = None
+    if incremental:
+        previous = ChainLink.latest(targets[0][1], database_handler.database_info.name)
+        if previous is None:
+            link = ChainLink(result.location, database_handler.database_info.name)
+        else:
+            link = previous.after(result.location)
+
+    # Unless it's chunked, the dump goes straight into gpg (through the compressor) without passing through python
+    state = link.state_path if link else None
+    since = previous.state_path if previous else None
+    entry = CatalogEntry(None, None
+        , engine=database_handler.database_info.engine, database=database_handler.database_info.name
+        , kind="base_backup" if base_backup else "full", started=time.time(), codec=codec.name if codec else None
+        , encryption="dedup" if dedup else ("chunked" if chunked else "gpg"), rows=rows
+        , dump_format=database_handler.dump_format(state=state, base_backup=base_backup)
+        )
+
+    try:
+        with database_handler.dump_stage(state=state, since=since, base_backup=base_backup) as dump:
+            stages = backup_stages(dump, encryptor, destinations, gpg_home, codec, buffer_size, manifests, tables)
+            Pipeline(stages, idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=result.collector(metrics)).run()
+
+        if link:
+            link.write()
+            entry.kind = link.kind
+        if tables:
+            for recipients, destination in destinations:
+                tables.write(destination, lambda data: encryptor.encrypt_for_us(data, recipients, "Encrypting the table index", gpg_home))
+        for manifest in manifests or []:
+            if dedup:
+                manifest.chunks = encryptor.digests[manifest.location]
+            manifest.write(signer, gpg_home)
+    except Exception as error:
+        entry.succeeded, entry.error = False, str(error)
+        catalog_backup(entry, destinations)
+        raise
+
+    # Only the manifest and table index see every byte of the dump, what /proc says the dump wrote includes
+    # it's temporary files and stderr, so otherwise we don't know how big the dump was
+    if manifests:
+        entry.plaintext_size = manifests[0].plaintext.size
+    elif tables:
+        entry.plaintext_size = tables.size
+    catalog_backup(entry, destinations)
+    return result
+
+def count_rows(database_handler):
+    """Return how many rows each table of the database has for the catalog, or None if we can't tell"""
+    try:
+        return database_handler.row_counts()
+    except FailedBackup as error:
+        log.warning("Couldn't count the rows in the database: %s", error)
+
+def catalog_backup(entry, destinations):
+    """
+    Add the entry to the catalog in the backup_dir of each destination, with what we know about that copy
+
+    The backup is what matters, so we only complain in the logs if we can't write to a catalog
+    """
+    if entry.finished is None:
+        entry.finished = time.time()
+
+    for recipients, destination in destinations:
+        entry.recipients = recipients
+        entry.filename = os.path.basename(destination)
+        entry.backup_dir = os.path.dirname(destination)
+        entry.ciphertext_size = os.path.getsize(destination) if os.path.exists(destination) else None
+        try:
+            Catalog(entry.backup_dir).add(entry)
+        except (sqlite3.Error, IOError, OSError) as error:
+            log.error("Couldn't add %s to the catalog in %s: %s", entry.filename, entry.backup_dir, error)
+
+def backup_stages(dump, encryptor, destinations, gpg_home=None, codec=None, buffer_size=FANOUT_BUFFER_SIZE, manifests=None, tables=None):
+    """
+    Return the stages for a Pipeline that encrypts the dump for each (recipients, destination) in destinations,
+    compressing it first if we have a codec
+
+    If we have manifests (one for each destination, sharing the same plaintext) then they get the hashes of
+    the dump and of what is written to each destination. If we have tables (a TableIndex) it finds the tables in the dump.
+    """
+    stages = [dump]
+    if manifests:
+        stages.append(manifests[0].plaintext.stage("Hashing the dump"))
+    if tables:
+        stages.append(tables.stage("Indexing tables"))
+    if codec:
+        stages.append(codec.compress_stage())
 
-def restore(database_settings, restore_from, gpg_home=None):
-    """Restore to the database from the specified restoration point"""
+    encrypters = []
+    for index, (recipients, destination) in enumerate(destinations):
+        hasher = manifests[index].ciphertext if manifests else None
+        encrypters.append(encryptor.encrypt_stages(recipients, destination, gpg_home, codec=codec, hasher=hasher))
+
+    if len(encrypters) == 1:
+        stages.extend(encrypters[0])
+    else:
+        stages.append(Fanout(encrypters, buffer_size=buffer_size))
+    return stages
+
+def backup_many(jobs, filename_maker=None, gpg_home=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None, compression=None, chunked=False):
+    """
+    Backup many databases at the same time from the one thread
+
+    jobs is a list of (database_settings, recipients, backup_dir) and the other options are as for backup
+    Return a list of (destination, error) for each job where error is None if that backup succeeded
+
+    metrics is called with the ProcessStats of each process of every backup when it's done
+
+    Like backup, each backup (even one that fails) is added to the catalog in it's backup_dir.
+    With chunked the encrypting happens in python, which means a thread for each backup.
+    """
+    if filename_maker is None:
+        filename_maker = make_backup_filename
+
+    codec = find_codec(compression) if compression else None
+    handlers = [DatabaseHandler(database_settings) for database_settings, _, _ in jobs]
+    counts = run_concurrently(*[lambda handler=handler: count_rows(handler) for handler in handlers])
+    with all_of([handler.dump_stage() for handler in handlers]) as dumps:
+        results = []
+        entries = []
+        supervisors = []
+        for handler, dump, rows, (_, recipients, backup_dir) in zip(handlers, dumps, counts, jobs):
+            destination = os.path.join(backup_dir, filename_maker())
+            dump.desc = "Dump command ({0})".format(handler.database_info.name)
+            entry = CatalogEntry(None, None
+                , engine=handler.database_info.engine, database=handler.database_info.name, started=time.time()
+                , codec=codec.name if codec else None, encryption="chunked" if chunked else "gpg", rows=rows
+                , dump_format=handler.dump_format()
+                )
+            entries.append(entry)
+            try:
+                encryptor = ChunkedEncryptor() if chunked else Encryptor()
+                stages = backup_stages(dump, encryptor, [(recipients, destination)], gpg_home, codec)
+
+                # The backup is finished when it's last process is
+                def finished(stats, entry=entry):
+                    entry.finished = time.time()
+                    if metrics is not None:
+                        metrics(stats)
+                supervisors.append(Pipeline(stages, idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=finished).start())
+                results.append([destination, None])
+            except FailedBackup as error:
+                results.append([destination, error])
+
+        errors = iter(supervise_all(supervisors))
+        for result in results:
+            if result[1] is None:
+                error = next(errors)
+                if error is not None:
+                    result[1] = error[1]
+
+    for (destination, error), entry, (_, recipients, _) in zip(results, entries, jobs):
+        if error is not None:
+            entry.succeeded, entry.error = False, str(error)
+        catalog_backup(entry, [(recipients, destination)])
+
+    return [tuple(result) for result in results]
+
+@contextmanager
+def all_of(managers):
+    """Enter all of the context managers and yield a list of what they gave us"""
+    if not managers:
+        yield []
+    else:
+        with managers[0] as first:
+            with all_of(managers[1:]) as rest:
+                yield [first] + rest
+
+def restore(database_settings, restore_from, gpg_home=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None, stop_at=None, tables=None):
+    """
+    Restore to the database from the specified restoration point
+    and return a Result saying what each process cost
+
+    Plain gpg, chunked and deduplicated backups can all be restored and
+    if the backup was compressed before it was encrypted then we decompress it with the same codec
+
+    If the backup is part of a chain of incremental backups then we restore each backup in the chain in turn,
+    starting with the full backup it was made after. For engines that can (i.e. mysql) stop_at is a datetime
+    (in UTC unless it says otherwise) to stop replaying the incremental backups at.
+
+    tables is a list of the tables to restore from a backup made with table_index, skipping the rest of the dump.
+    Only the chunks of a chunked backup that those tables are in are decrypted, unless it was compressed.
+
+    A backup that the catalog in it's backup_dir says is a tar of a directory dump (i.e. made with jobs)
+    is restored as one whether or not we have jobs now. Otherwise jobs decides, as it does for dumping.
+
+    Each process involved is killed if it goes idle_timeout seconds without progress
+    or takes longer than total_timeout seconds
+
+    metrics is called with the ProcessStats of each process when it's done
+    """
     location = sanitise_path(restore_from)
 
     if not os.path.exists(location):
         raise BadBackupFile("The backup file at '{0}' doesn't exist".format(location))
 
+    locations = [location]
+    link = ChainLink.of(location)
+    if link:
+        link.check()
+        locations = link.chain
+    if tables is not None and len(locations) > 1:
+        raise ValueError("Can't restore only some tables from a chain of incremental backups")
+
     database_handler = DatabaseHandler(database_settings)
-    if not database_handler.is_empty():
+    if stop_at is not None:
+        if stop_at.tzinfo is not None:
+            stop_at = (stop_at - stop_at.utcoffset()).replace(tzinfo=None)
+        check_stop_at(locations, stop_at)
+        # Complain now rather than after the full backup if the engine can't do this
+        database_handler.stop_at_stage(stop_at)
+
+    ranges = None
+    if tables is not None:
+        encryptor = encryptor_for(location)
+        table_index = TableIndex.read(location, lambda data: encryptor.decrypt_for_us(data, "Decrypting the table index", gpg_home))
+        ranges = table_index.ranges(tables)
+
+    dump_formats = [catalogued_format(backup_file) for backup_file in locations]
+    is_empty, _, _ = run_concurrently(
+          database_handler.is_empty
+        , lambda: [database_handler.check_commands("restore", dump_format=dump_format) for dump_format in set(dump_formats)]
+        , lambda: check_for_command("gpg", "Decrypting something")
+        )
+
+    if not is_empty:
         raise NonEmptyDatabase("Sorry, won't restore to a database that isn't empty")
 
-    database_handler.restore(Encryptor().decrypt(location, gpg_home=gpg_home))
+    result = Result(location, locations)
+    for index, backup_file in enumerate(locations):
+        if ranges is None:
+            stages = encryptor_for(backup_file).decrypt_stages(backup_file, gpg_home=gpg_home)
+        else:
+            stages = encryptor_for(backup_file).decrypt_stages(backup_file, gpg_home=gpg_home, ranges=ranges)
+        if stop_at is not None and index > 0:
+            stages.append(database_handler.stop_at_stage(stop_at))
+        with database_handler.restore_stage(dump_formats[index]) as restorer:
+            Pipeline(stages + [restorer], idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=result.collector(metrics)).run()
+    return result
+
+@contextmanager
+def restoring(database_settings, restore_from, gpg_home=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None):
+    """
+    Start restoring the backup at restore_from and yield a Supervisor for the caller to drive (see db_backup.processes.Supervisor)
+    so the restore doesn't block whatever loop is driving it. The options are as for restore.
+
+    Checking the database is empty still waits for the database before we start, and a chain of incremental backups
+    can't be restored this way because each backup has to wait for the one before it. Chunked and deduplicated backups
+    are decrypted in python, which means a thread for each restore.
+
+    The restore command may need a temporary password file, so the Supervisor is only good until we're done
+    and anything it hasn't finished by then is killed.
+    """
+    location = sanitise_path(restore_from)
+    if not os.path.exists(location):
+        raise BadBackupFile("The backup file at '{0}' doesn't exist".format(location))
+
+    link = ChainLink.of(location)
+    if link and len(link.chain) > 1:
+        raise ValueError("Can't restore a chain of incremental backups without waiting for each one")
+
+    database_handler = DatabaseHandler(database_settings)
+    dump_format = catalogued_format(location)
+    is_empty, _, _ = run_concurrently(
+          database_handler.is_empty
+        , lambda: database_handler.check_commands("restore", dump_format=dump_format)
+        , lambda: check_for_command("gpg", "Decrypting something")
+        )
+
+    if not is_empty:
+        raise NonEmptyDatabase("Sorry, won't restore to a database that isn't empty")
+
+    stages = encryptor_for(location).decrypt_stages(location, gpg_home=gpg_home)
+    with database_handler.restore_stage(dump_format) as restorer:
+        restorer.desc = "Restore command ({0})".format(database_handler.database_info.name)
+        supervisor = Pipeline(stages + [restorer], idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=metrics).start()
+        try:
+            yield supervisor
+        finally:
+            if not supervisor.finished:
+                try:
+                    supervisor.finish()
+                except FailedBackup as error:
+                    log.error("Stopped restoring %s before it finished: %s", location, error)
+
+def restore_many(jobs, gpg_home=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None):
+    """
+    Restore many backups at the same time from the one thread
+
+    jobs is a list of (database_settings, restore_from) and the other options are as for restore
+    Return a list of (location, error) for each job where error is None if that restore succeeded
+
+    Each job is started with restoring, so the same things can't be restored this way
+    """
+    with all_of([attempt(restoring(database_settings, restore_from, gpg_home, idle_timeout, total_timeout)) for database_settings, restore_from in jobs]) as started:
+        errors = iter(supervise_all([supervisor for supervisor, error in started if error is None]))
+
+        results = []
+        for (_, restore_from), (_, error) in zip(jobs, started):
+            if error is None:
+                found = next(errors)
+                error = found[1] if found is not None else None
+            results.append((sanitise_path(restore_from), error))
+
+    return results
+
+@contextmanager
+def attempt(manager):
+    """Enter the context manager and yield (what it gave us, None) or (None, error) if entering it failed"""
+    try:
+        entered = manager.__enter__()
+    except (FailedBackup, ValueError) as error:
+        yield None, error
+        return
+
+    try:
+        yield entered, None
+    except:
+        exc_info = sys.exc_info()
+        if not manager.__exit__(*exc_info):
+            raise exc_info[0], exc_info[1], exc_info[2]
+    else:
+        manager.__exit__(None, None, None)
+
+def catalogued_format(location):
+    """
+    Return the dump_format the catalog next to the backup at location says it has,
+    or None if there is no catalog or it doesn't know about the backup
+    """
+    try:
+        entry = Catalog(os.path.dirname(location)).find(os.path.basename(location))
+    except (BadBackupDir, sqlite3.Error) as error:
+        log.debug("Couldn't find %s in a catalog: %s", location, error)
+        return None
+    return entry.dump_format if entry else None
+
+def check_stop_at(locations, stop_at):
+    """Complain if we can't stop restoring this chain of backups at stop_at (a naive datetime in UTC)"""
+    if len(locations) < 2:
+        raise NotIncremental("Can only stop part way through restoring a chain of incremental backups")
+
+    if ChainLink.of(locations[0]).created > calendar.timegm(stop_at.timetuple()):
+        raise BadBackupFile("The full backup at '{0}' was made after {1} UTC".format(locations[0], stop_at))
+
+def verify(backup_file, gpg_home=None, deep=False, password=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, signer=None):
+    """
+    Check the backup at backup_file against the manifest that backup wrote next to it
+    and return the Manifest with what we found
+
+    Without deep we only hash the backup file (and the chunks a deduplicated backup needs), which doesn't need the key to decrypt it.
+    With deep we also decrypt (and decompress) it and hash the dump that comes out, without restoring it anywhere.
+
+    With a signer (a uid or fingerprint) the manifest must have a good signature from that key.
+
+    Raise FailedVerification if the manifest is missing, it's signature is bad or the backup doesn't match it
+    """
+    location = sanitise_path(backup_file)
+    if not os.path.exists(location):
+        raise BadBackupFile("The backup file at '{0}' doesn't exist".format(location))
+
+    manifest = Manifest(location)
+    expected = manifest.read(gpg_home, signer=signer)
+
+    manifest.ciphertext = StreamHash.of_file(location)
+    manifest.check(expected, "ciphertext")
+    manifest.check_chunks(expected)
+
+    if deep:
+        stages = encryptor_for(location).decrypt_stages(location, gpg_home=gpg_home, password=password)
+        stages.append(manifest.plaintext.sink("Hashing the dump"))
+        Pipeline(stages, idle_timeout=idle_timeout, total_timeout=total_timeout).run()
+        manifest.check(expected, "plaintext")
+
+    return manifest
+
+def archive_wal(wal_path, recipients, archive_dir, gpg_home=None, compression=None, chunked=False
+    , idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None
+    ):
+    """
+    Encrypt a WAL segment into archive_dir for our recipients, for use as postgres' archive_command
+    (see db_backup.wal), and return a Result saying where it went
+
+    The segment gets a manifest next to it and is only moved into place once it's written to disk.
+    Postgres archives a segment again if it didn't hear that we finished, which is fine if it's the same segment,
+    but we complain if the archive already has a different segment with that name.
+    """
+    name = os.path.basename(wal_path)
+    location = os.path.join(archive_dir, "{0}.gpg".format(name))
+    result = Result(location)
+
+    if os.path.exists(location):
+        manifest = Manifest(location, StreamHash.of_file(wal_path))
+        try:
+            manifest.check(manifest.read(gpg_home), "plaintext")
+        except FailedVerification:
+            raise BadBackupDir("The WAL archive at '{0}' already has a different {1}".format(archive_dir, name))
+        return result
+
+    encryptor = ChunkedEncryptor() if chunked else Encryptor()
+    codec = find_codec(compression) if compression else None
+
+    checks = [lambda: encryptor.check_recipients(recipients, gpg_home), lambda: check_writable(archive_dir)]
+    if codec:
+        checks.append(lambda: codec.check_commands("compress"))
+    run_concurrently(*checks)
+
+    manifest = Manifest(location)
+    temporary = os.path.join(archive_dir, ".{0}.tmp".format(name))
+    try:
+        reader = ProcessStage("cat", pipes.quote(wal_path), "Reading the WAL segment")
+        stages = backup_stages(reader, encryptor, [(recipients, temporary)], gpg_home, codec, manifests=[manifest])
+        Pipeline(stages, idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=result.collector(metrics)).run()
+
+        manifest.write()
+        sync(temporary)
+        os.rename(temporary, location)
+        sync(archive_dir)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return result
+
+def restore_wal(name, destination, archive_dir, gpg_home=None, password=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None):
+    """
+    Decrypt the WAL segment called name from archive_dir into destination, for use as postgres' restore_command
+    (see db_backup.wal), and return a Result saying where it came from
+
+    Raise BadBackupFile if the archive doesn't have it, which is how postgres knows it has reached the end of the WAL
+    """
+    location = os.path.join(archive_dir, "{0}.gpg".format(name))
+    if not os.path.exists(location):
+        raise BadBackupFile("The WAL archive at '{0}' has no {1}".format(archive_dir, name))
+
+    result = Result(location)
+    temporary = "{0}.tmp".format(destination)
+    try:
+        stages = encryptor_for(location).decrypt_stages(location, gpg_home=gpg_home, password=password)
+        stages.append(StreamHash().writer(temporary, "Writing the WAL segment"))
+        Pipeline(stages, idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=result.collector()).run()
+        os.rename(temporary, destination)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return result
+
+def point_in_time_restore(restore_from, data_dir, archive_dir, target_time=None, gpg_home=None
+    , idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None
+    ):
+    """
+    Unpack the base backup at restore_from into an empty postgres data_dir and set it up to replay
+    the WAL in archive_dir up to target_time when postgres starts, and return a Result saying what each process cost
+
+    target_time is a datetime (in UTC unless it says otherwise) or a string postgres understands,
+    or None to replay all of the WAL we have. This needs postgres 12 or newer.
+    """
+    location = sanitise_path(restore_from)
+    if not os.path.exists(location):
+        raise BadBackupFile("The backup file at '{0}' doesn't exist".format(location))
+
+    if os.path.exists(data_dir) and os.listdir(data_dir):
+        raise NonEmptyDatabase("Sorry, won't restore into a data directory that isn't empty")
+
+    run_concurrently(
+          lambda: check_for_command("tar", "Unpacking the base backup")
+        , lambda: check_for_command("gpg", "Decrypting something")
+        )
+
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    # Postgres won't start if anyone else can read the data directory
+    os.chmod(data_dir, 0700)
+
+    result = Result(location)
+    stages = encryptor_for(location).decrypt_stages(location, gpg_home=gpg_home)
+    stages.append(ProcessStage("tar", "-C {0} -xf -".format(pipes.quote(data_dir)), "Unpacking the base backup"))
+    Pipeline(stages, idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=result.collector(metrics)).run()
+
+    write_recovery_settings(data_dir, archive_dir, target_time, gpg_home)
+    return result
+
+def write_recovery_settings(data_dir, archive_dir, target_time=None, gpg_home=None):
+    """Tell the postgres in data_dir to fetch WAL from archive_dir with db_backup.wal until target_time"""
+    command = [sys.executable, "-m", "db_backup.wal", "restore", "%f", "%p", "--archive-dir", os.path.abspath(archive_dir)]
+    if gpg_home:
+        command.extend(["--gpg-home", os.path.abspath(gpg_home)])
+
+    settings = [("restore_command", ' '.join(pipes.quote(part) for part in command))]
+    if target_time is not None:
+        if not isinstance(target_time, basestring):
+            if target_time.tzinfo is None:
+                target_time = "{0}+00".format(target_time.strftime("%Y-%m-%d %H:%M:%S.%f"))
+            else:
+                target_time = target_time.isoformat(" ")
+        settings.extend([("recovery_target_time", target_time), ("recovery_target_action", "promote")])
+
+    with open(os.path.join(data_dir, "postgresql.auto.conf"), "a") as fle:
+        fle.write("\n# Added by db_backup to replay archived WAL\n")
+        for key, value in settings:
+            fle.write("{0} = '{1}'\n".format(key, value.replace("'", "''")))
+
+    # Postgres only does a targeted recovery when this file exists
+    open(os.path.join(data_dir, "recovery.signal"), "w").close()
+
+def sync(location):
+    """Make sure what we wrote to a file or directory is on disk"""
+    handle = os.open(location, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+def check_writable(directory):
+    """Complain if we can't write a backup into this directory"""
+    if not os.path.isdir(directory):
+        raise BadBackupDir("The backup directory at '{0}' doesn't exist".format(directory))
+    if not os.access(directory, os.W_OK | os.X_OK):
+        raise BadBackupDir("Can't write to the backup directory at '{0}'".format(directory))
 
 def sanitise_path(path):
     """Remove file:// scheme from a path if it has one"""
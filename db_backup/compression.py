@@ -0,0 +1,57 @@
+from db_backup.processes import ProcessStage, check_for_command
+from db_backup.errors import UnknownCompression
+
+class Codec(object):
+    """
+    A compressor that we run as a command between the dump and gpg
+
+    compress and decompress are (command, options) that read from stdin and write to stdout.
+    magic is the bytes that anything it compresses starts with,
+    which is how restore knows which codec a backup was compressed with.
+    """
+    def __init__(self, name, magic, compress, decompress):
+        self.name = name
+        self.magic = magic
+        self.compress = compress
+        self.decompress = decompress
+
+    def compress_stage(self):
+        """Return a ProcessStage that compresses whatever the stage before it produces"""
+        command, options = self.compress
+        return ProcessStage(command, options, "Compressing with {0}".format(self.name))
+
+    def decompress_stage(self):
+        """Return a ProcessStage that decompresses whatever the stage before it produces"""
+        command, options = self.decompress
+        return ProcessStage(command, options, "Decompressing with {0}".format(self.name))
+
+    def check_commands(self, *actions):
+        """Make sure we have the commands for these actions (i.e. "compress", "decompress") before we need them"""
+        for action in actions:
+            command, _ = getattr(self, action)
+            check_for_command(command, "{0}ing with {1}".format(action.capitalize(), self.name))
+
+# The codecs we know about, in the order we look for them when detecting what a backup used
+# pigz makes the same format as gzip, so backups from either are decompressed with gzip
+CODECS = [
+      Codec("zstd", "\x28\xb5\x2f\xfd", ("zstd", "-T0 -q -c"), ("zstd", "-d -q -c"))
+    , Codec("xz", "\xfd7zXZ\x00", ("xz", "-T0 -c"), ("xz", "-d -c"))
+    , Codec("gzip", "\x1f\x8b", ("gzip", "-c"), ("gzip", "-d -c"))
+    , Codec("pigz", "\x1f\x8b", ("pigz", "-c"), ("pigz", "-d -c"))
+    ]
+
+# How much of the start of a backup we need to see to detect the codec
+MAGIC_SIZE = max(len(codec.magic) for codec in CODECS)
+
+def find_codec(name):
+    """Return the codec with this name or complain if we don't know it"""
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    raise UnknownCompression("Don't know how to compress with {0}, choose from {1}".format(name, ", ".join(codec.name for codec in CODECS)))
+
+def detect_codec(head):
+    """Return the codec that made a stream starting with head, or None if it doesn't look compressed"""
+    for codec in CODECS:
+        if head.startswith(codec.magic):
+            return codec
@@ -0,0 +1,114 @@
+"""
+Talk to databases with their python libraries (when they're installed) rather than starting their command line clients
+
+Connections are kept in a small pool for each DatabaseInfo so asking about the same database again doesn't connect again.
+"""
+from db_backup.errors import FailedToRun
+
+from contextlib import contextmanager
+import threading
+import logging
+
+log = logging.getLogger("db_backup")
+
+# How many idle connections we keep for each database
+POOL_SIZE = 2
+
+def optional_import(*names):
+    """Return the first of these modules that we can import or None if we can't import any of them"""
+    for name in names:
+        try:
+            return __import__(name)
+        except ImportError:
+            pass
+
+class ConnectionPool(object):
+    """Idle DB-API connections kept for each DatabaseInfo"""
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, database_info, connect, size=None, fresh=False):
+        """
+        Yield an idle connection to this database (unless we want a fresh one) or a new one from connect
+        and keep it for next time unless something went wrong with it
+
+        size overrides how many idle connections we keep for this database (0 means we close it when we're done)
+        """
+        connection = None
+        if not fresh:
+            with self.lock:
+                idle = self.idle.get(database_info, [])
+                connection = idle.pop() if idle else None
+        if connection is None:
+            connection = connect()
+
+        try:
+            yield connection
+        except:
+            self.discard(connection)
+            raise
+
+        with self.lock:
+            if len(self.idle.get(database_info, [])) < (self.size if size is None else size):
+                self.idle.setdefault(database_info, []).append(connection)
+                connection = None
+        if connection is not None:
+            self.discard(connection)
+
+    def discard(self, connection):
+        """Close a connection we aren't keeping, ignoring any complaints about it"""
+        try:
+            connection.close()
+        except Exception as error:
+            log.debug("Failed to close a connection: %s", error)
+
+    def clear(self):
+        """Close all the idle connections"""
+        with self.lock:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle = {}
+        for connection in connections:
+            self.discard(connection)
+
+# The pool the database drivers share
+pool = ConnectionPool()
+
+def query(database_info, connect, sql, params, desc, size=None):
+    """
+    Return the rows from running sql with params on a pooled connection to this database
+
+    A connection that sat in the pool may have been closed by the database since (i.e. mysql's wait_timeout
+    or postgres restarting), so if one of those fails we try once more with a new connection
+
+    Raise FailedToRun (like the command line client would) if the database complains
+    """
+    made = []
+    def connecting():
+        made.append(connect())
+        return made[-1]
+
+    try:
+        for fresh in (False, True):
+            try:
+                with pool.connection(database_info, connecting, size=size, fresh=fresh) as connection:
+                    return execute(connection, sql, params)
+            except Exception as error:
+                if made:
+                    raise
+                log.debug("%s failed on a pooled connection, trying a new one: %s", desc, error)
+    except FailedToRun:
+        raise
+    except Exception as error:
+        raise FailedToRun("{0} failed: {1}".format(desc, error), exit_code=None)
+
+def execute(connection, sql, params):
+    """Return the rows from running sql with params on this connection"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
@@ -1,21 +1,39 @@
-from db_backup.processes import stdout_chunks, check_and_start_process, feed_process
-from db_backup.errors import NoDBDriver, NoDatabase
+from db_backup.processes import (
+      stdout_chunks, stdout_views, check_and_start_process, check_for_command, feed_process
+    , ProcessStage, PythonStage, Watchdog, DEFAULT_IDLE_TIMEOUT
+    )
+from db_backup.errors import NoDBDriver, NoDatabase, NotIncremental, NoTableIndex, UnknownProfile, BadBackupFile
+from db_backup.connections import optional_import, query
+from db_backup.tables import TableIndex
+from db_backup import mysql_binlog
 
 from contextlib import contextmanager
 import tempfile
 import logging
+import sqlite3
+import shutil
+import pipes
+import sys
 import os
 
 log = logging.getLogger("db_backup")
 
+# The script SqliteFileDriver runs to copy sqlite databases
+SQLITE_BACKUP = pipes.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sqlite_backup.py"))
+
+# The script MysqlDriver runs to make incremental backups from the binlog
+MYSQL_BINLOG = pipes.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mysql_binlog.py"))
+
 class DatabaseInfo(object):
-    ATTRS = ("engine", "name", "user", "password", "port", "host")
+    ATTRS = ("engine", "name", "user", "password", "port", "host", "jobs", "profile")
 
-    def __init__(self, engine, name, user=None, password=None, port=None, host=None):
+    def __init__(self, engine, name, user=None, password=None, port=None, host=None, jobs=None, profile=None):
         self.name = name
         self.user = user or ""
         self.port = port or ""
         self.host = host or ""
+        self.jobs = jobs or ""
+        self.profile = profile or ""
         self.engine = engine
         self.password = password or ""
 
@@ -30,6 +48,15 @@ class DatabaseInfo(object):
         have = dict((key, lowered[key]) for key in DatabaseInfo.ATTRS if key in lowered)
         return DatabaseInfo(**have)
 
+    def __eq__(self, other):
+        return isinstance(other, DatabaseInfo) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.as_dict().items())))
+
 class DatabaseDriver(object):
     """
     Base class for the database drivers
@@ -40,6 +67,32 @@ class DatabaseDriver(object):
     Also provided is a PASSWORD_FILE value which holds a temporary file with the file_contents string
     file_contents is also formatted with database values.
     Stdin if specified (also formatted with database values) is fed into the stdin of the process
+
+    directory_dump_template and directory_restore_template are used instead of the dump and restore templates
+    when the database_info asks for more than one job. They dump into and restore from a directory at DUMP_DIR
+    and that directory is sent through the rest of the pipeline as a tar. Restoring goes by the dump_format of
+    the backup ("directory" or "plain") when we know it rather than how many jobs we would dump with now.
+
+    incremental_dump_template, if the engine can do it, dumps only what changed since the backup with the
+    state file at SINCE (or everything if SINCE is empty) and remembers what it dumped in the state file at STATE
+    (see db_backup.incremental). The restore_template must be able to restore both kinds of dump.
+
+    dump_profiles are {name: [(flag, val), ...]} of options that go before the dump_template's own options
+    when the database_info asks for that profile (i.e. "online" for a dump that doesn't get in the way of a busy database).
+    directory_dump_profiles are the same for the directory_dump_template, which uses dump_profiles if they aren't specified.
+    Incremental and base backups don't use the profiles.
+
+    base_backup_template, if the engine can do it, copies the whole cluster the database lives in as a tar
+    to restore with the WAL that's been archived since (see db_backup.commands.point_in_time_restore).
+
+    is_empty_query and size_query are (sql, [param, ...]) where each param is formatted with the database info
+    and they are run on a connection from native_connect instead of the is_empty_template and size_template
+    when the engine's python library is installed (see db_backup.connections).
+    is_empty_query only needs to return a row if there is a table. row_counts_query returns (table, rows) for each table,
+    which may be the estimates the database keeps rather than an actual count.
+
+    table_markers, if the dump_template makes sql we can find the tables in, are regexes for the lines that start
+    each section of the dump with the name of the table the section is for in a group (see db_backup.tables).
     """
 
     aliases = ()
@@ -48,6 +101,22 @@ class DatabaseDriver(object):
     dump_template = ("", "")
     restore_template = ("", "")
     is_empty_template = ("", "")
+    size_template = None
+
+    is_empty_query = None
+    size_query = None
+    row_counts_query = None
+    pool_size = None
+
+    table_markers = None
+
+    dump_profiles = None
+    directory_dump_template = None
+    directory_dump_profiles = None
+    directory_restore_template = None
+
+    incremental_dump_template = None
+    base_backup_template = None
 
     def __init__(self, database_info):
         self.database_info = database_info
@@ -68,7 +137,18 @@ class DatabaseDriver(object):
                 os.remove(filename)
 
     @contextmanager
-    def fill_out(self, template):
+    def a_temp_directory(self):
+        """Yield a temporary directory and ensure it gets deleted along with everything in it"""
+        directory = None
+        try:
+            directory = tempfile.mkdtemp()
+            yield directory
+        finally:
+            if directory and os.path.exists(directory):
+                shutil.rmtree(directory)
+
+    @contextmanager
+    def fill_out(self, template, **extra):
         """
         Fill out a template with the database_info
         Assume the template is [<command>, <options>]
@@ -77,6 +157,7 @@ class DatabaseDriver(object):
         and options is [(<flag>, <val>), ...]
 
         If val formatted with the database_info is empty then that flag is ignored.
+        Any extra values are available to the template as well.
         """
         opts = []
         stdin = None
@@ -84,10 +165,14 @@ class DatabaseDriver(object):
         file_contents = None
 
         values = self.database_info.as_dict()
+        values.update(extra)
         command, argv = template
 
         if isinstance(argv, basestring):
             argv = [("", argv)]
+        else:
+            # Don't change the template itself when we add the password option
+            argv = list(argv)
 
         if self.database_info.password and self.password_option:
             env, option, file_contents, stdin = self.password_option
@@ -118,32 +203,192 @@ class DatabaseDriver(object):
 
             yield (command, " ".join(opts), environment, stdin)
 
+    @property
+    def parallel(self):
+        """Whether we dump and restore with more than one job through a directory"""
+        return self.directory_dump_template is not None and int(self.database_info.jobs or 1) > 1
+
     @contextmanager
     def dump_command(self):
         """Return us the command for dumping as (program, options)"""
-        with self.fill_out(self.dump_template) as info:
-            yield info
+        if self.parallel:
+            with self.directory_command(self.profiled(self.directory_dump_template), "dump") as info:
+                yield info
+        else:
+            with self.fill_out(self.profiled(self.dump_template)) as info:
+                yield info
+
+    def profiled(self, template):
+        """Return a dump template with the options for the dump profile the database_info asks for"""
+        profile = self.database_info.profile
+        if not profile:
+            return template
+
+        profiles = self.dump_profiles
+        if self.parallel and self.directory_dump_profiles is not None:
+            profiles = self.directory_dump_profiles
+
+        if not profiles:
+            raise UnknownProfile("Can't choose a dump profile for {0} databases".format(self.database_info.engine))
+        if profile not in profiles:
+            raise UnknownProfile("Don't know the {0} dump profile for {1} databases, choose from {2}".format(
+                profile, self.database_info.engine, ", ".join(sorted(profiles))
+            ))
+
+        command, argv = template
+        if isinstance(argv, basestring):
+            argv = [("", argv)]
+        return (command, list(profiles[profile]) + list(argv))
+
+    @property
+    def dump_format(self):
+        """What dump_command dumps, "directory" for a tar of a directory dump and "plain" otherwise"""
+        return "directory" if self.parallel else "plain"
+
+    def restores_directory(self, dump_format=None):
+        """
+        Whether restoring a dump_format dump means restoring a tar of a directory dump,
+        going by whether we would dump that way now if we don't know the dump_format
+        """
+        if dump_format is None:
+            return self.parallel
+        if dump_format == "directory" and self.directory_restore_template is None:
+            raise BadBackupFile("Can't restore a directory dump into a {0} database".format(self.database_info.engine))
+        return dump_format == "directory"
 
     @contextmanager
-    def restore_command(self):
+    def restore_command(self, dump_format=None):
         """
         Return us the command for restoring from a backup as (program, options)
         This command should accept the output of the dump_command as input
         (The encrypted output of the dump_command output is decrypted when the restore command is run)
+
+        dump_format is what the backup's dump_format was, if we know it
+        """
+        if self.restores_directory(dump_format):
+            with self.directory_command(self.directory_restore_template, "restore") as info:
+                yield info
+        else:
+            with self.fill_out(self.restore_template) as info:
+                yield info
+
+    @contextmanager
+    def incremental_dump_command(self, state, since=None):
+        """Return us the command for dumping what changed since the backup with the since state file"""
+        if self.incremental_dump_template is None:
+            raise NotIncremental("Can't make incremental backups of {0} databases".format(self.database_info.engine))
+        with self.fill_out(self.incremental_dump_template, STATE=pipes.quote(state), SINCE=pipes.quote(since) if since else "") as info:
+            yield info
+
+    def stop_at_stage(self, stop_at):
         """
-        with self.fill_out(self.restore_template) as info:
+        Return a stage that only lets through what an incremental dump did up to stop_at,
+        a naive datetime in UTC
+        """
+        raise NotIncremental("Can't stop restoring {0} backups part way through".format(self.database_info.engine))
+
+    @contextmanager
+    def base_backup_command(self):
+        """Return us the command for copying the whole cluster the database lives in"""
+        if self.base_backup_template is None:
+            raise NotIncremental("Can't make base backups of {0} databases".format(self.database_info.engine))
+        with self.fill_out(self.base_backup_template) as info:
             yield info
 
+    @contextmanager
+    def directory_command(self, template, action):
+        """
+        Return us a shell command that runs a directory template for an action (i.e. "dump", "restore")
+        with a tar of the directory as it's output or input
+
+        The directory only lasts until we're done with the command
+        """
+        with self.a_temp_directory() as directory:
+            # We restore a directory dump even without jobs if that's what the backup is
+            jobs = self.database_info.jobs or 1
+            with self.fill_out(template, DUMP_DIR=os.path.join(directory, "dump"), jobs=jobs) as (command, options, env, stdin):
+                if action == "dump":
+                    script = '"$@" && exec tar -C {0} -cf - dump'.format(pipes.quote(directory))
+                else:
+                    script = 'tar -C {0} -xf - && exec "$@"'.format(pipes.quote(directory))
+                yield ("sh", "-c {0} sh {1} {2}".format(pipes.quote(script), command, options), env, stdin)
+
+    def commands_for(self, action, dump_format=None):
+        """
+        Return the commands we need for an action (i.e. "dump", "restore", "base_backup")
+        and for restoring, the dump_format of the backup if we know it
+        """
+        if action == "dump":
+            # Complain about a profile we don't know before we start dumping
+            self.profiled(self.dump_template)
+
+        if (action == "dump" and self.parallel) or (action == "restore" and self.restores_directory(dump_format)):
+            command, _ = getattr(self, "directory_{0}_template".format(action))
+            return [command, "tar"]
+
+        template = getattr(self, "{0}_template".format(action))
+        if template is None:
+            return []
+        command, _ = template
+        return [command]
+
+    def row_counts(self):
+        """Return {table: rows} for the tables in the database or None if we can't ask natively"""
+        rows = self.native_query(self.row_counts_query, "Count rows")
+        if rows is None:
+            return None
+        return dict((name, int(count)) for name, count in rows if count is not None)
+
+    def table_index(self):
+        """Return a TableIndex for the sections of what dump_command dumps"""
+        if self.table_markers is None or self.parallel:
+            raise NoTableIndex("Can't find the tables in dumps of {0} databases".format(self.database_info.engine))
+        return TableIndex(self.table_markers)
+
+    def native_connect(self):
+        """Return a function that connects to the database with it's python library or None if that isn't installed"""
+        return None
+
+    def native_query(self, template, desc):
+        """Return the rows from running a query template for this database natively or None if we can't"""
+        connect = self.native_connect() if template else None
+        if connect is None:
+            return None
+
+        sql, params = template
+        values = self.database_info.as_dict()
+        params = tuple(param.format(**values) for param in params)
+        return query(self.database_info, connect, sql, params, desc, size=self.pool_size)
+
     def is_empty(self):
         """See that there are no tables under this database"""
+        rows = self.native_query(self.is_empty_query, "Find number of tables")
+        if rows is not None:
+            log.info("The database has %s", "tables" if rows else "no tables")
+            return not rows
+
         result = self.run_template(self.is_empty_template, "Find number of tables")
         log.info("The database has %s tables", result)
         return result == "0"
 
+    def estimated_size(self):
+        """Return roughly how many bytes the database takes up or None if we can't tell"""
+        rows = self.native_query(self.size_query, "Find size of database")
+        if rows is None:
+            if self.size_template is None:
+                return None
+            rows = [[self.run_template(self.size_template, "Find size of database")]]
+
+        if rows and rows[0][0] not in (None, "", "NULL"):
+            return int(rows[0][0])
+
     def run_template(self, template, desc):
         """Run a template and return it's stdout"""
+        output = bytearray()
         with self.fill_out(template) as (command, options, env, stdin):
-            return '\n'.join(stdout_chunks(command, options, desc, env=env, stdin=stdin)).strip()
+            for view in stdout_views(command, options, desc, env=env, stdin=stdin):
+                output.extend(view)
+        return str(output).strip()
 
 class PsqlDriver(DatabaseDriver):
     aliases = ('psql', 'django.db.backends.postgresql_psycopg2', )
@@ -153,8 +398,68 @@ class PsqlDriver(DatabaseDriver):
           ("-U", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("", "{name}")
         , ("", "-c \"select count(*) from information_schema.tables where table_schema = 'public'\" -t -A")
         ])
+    size_template = ('psql', [
+          ("-U", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("", "{name}")
+        , ("", "-c \"select pg_database_size(current_database())\" -t -A")
+        ])
     password_option = ({"PGPASSFILE": "{PASSWORD_FILE}"}, None, "localhost:*:*:{user}:{password}", None)
 
+    is_empty_query = ("select 1 from information_schema.tables where table_schema = 'public' limit 1", [])
+
+    # pg_dump puts a comment before every object, naming the table first for the ones that belong to a table
+    # and as "TABLE x" or "COLUMN x.y" for grants and comments. The comments for indexes and the sequences
+    # a table owns only name the index or sequence, so their section starts at the statement, which names the table
+    table_markers = [
+          r"-- (?:Data for )?Name: ([^ ;]+)[^;]*; Type: (?:TABLE|TABLE DATA|DEFAULT|CONSTRAINT|FK CONSTRAINT|TRIGGER|POLICY|ROW SECURITY|VIEW|MATERIALIZED VIEW);"
+        , r"-- Name: (?:TABLE|COLUMN) ([^ .;]+)[^;]*; Type: (?:ACL|COMMENT);"
+        , r"-- (?:Data for )?Name: "
+        , r"-- PostgreSQL database dump complete"
+        , r'CREATE (?:UNIQUE )?INDEX [^\n]*? ON (?:ONLY )?(?:(?:"[^"]+"|[^\s".;(]+)\.)?(?:"([^"]+)"|([^\s".;(]+))'
+        , r'ALTER SEQUENCE [^\n]*? OWNED BY (?:(?:"[^"]+"|[^\s".;(]+)\.)?(?:"([^"]+)"|([^\s".;(]+))\.'
+        ]
+    size_query = ("select pg_database_size(current_database())", [])
+    row_counts_query = ("select c.relname, greatest(c.reltuples, 0)::bigint from pg_catalog.pg_class c"
+        " join pg_catalog.pg_namespace n on n.oid = c.relnamespace where n.nspname = 'public' and c.relkind in ('r', 'p')", [])
+
+    # pg_dump reads from one snapshot without blocking writes, but it waits in line for a share lock on each table
+    # and everything after it in that line waits as well, so the profiles give up rather than wait behind a slow ALTER
+    # "online" waits a little, "minimal-lock" barely waits and "fast" also doesn't fsync a directory dump we tar straight away
+    dump_profiles = {
+          "online": [("--lock-wait-timeout", "60s")]
+        , "minimal-lock": [("--lock-wait-timeout", "5s")]
+        , "fast": [("--lock-wait-timeout", "60s"), ("", "--no-sync")]
+        }
+
+    directory_dump_template = ('pg_dump', [
+          ("", "--format=directory"), ("--jobs", "{jobs}"), ("--file", "{DUMP_DIR}")
+        , ("-U", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("", "{name}")
+        ])
+    directory_restore_template = ('pg_restore', [
+          ("--jobs", "{jobs}"), ("-U", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("-d", "{name}"), ("", "{DUMP_DIR}")
+        ])
+
+    # A tar of the whole cluster on stdout, with the WAL needed to make it consistent
+    base_backup_template = ('pg_basebackup', [
+          ("-U", "{user}"), ("--host", "{host}"), ("--port", "{port}")
+        , ("", "--pgdata=- --format=tar --wal-method=fetch --checkpoint=fast")
+        ])
+
+    def native_connect(self):
+        """Connect with psycopg2 (or psycopg) if it's installed"""
+        psycopg = optional_import("psycopg2", "psycopg")
+        if psycopg is None:
+            return None
+
+        info = self.database_info
+        options = {"dbname": info.name, "user": info.user, "password": info.password, "host": info.host, "port": info.port}
+        options = dict((key, val) for key, val in options.items() if val)
+
+        def connect():
+            connection = psycopg.connect(**options)
+            connection.autocommit = True
+            return connection
+        return connect
+
 class MysqlDriver(DatabaseDriver):
     aliases = ('mysql', 'django.db.backends.mysql', )
     dump_template = ('mysqldump', [("--user", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("", "{name}")])
@@ -163,20 +468,156 @@ class MysqlDriver(DatabaseDriver):
           ("--user", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("-D", "{name}")
         , ("", "-e \"select count(*) from information_schema.tables where table_schema = '{name}'\" --batch -s")
         ])
+    size_template = ('mysql', [
+          ("--user", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("-D", "{name}")
+        , ("", "-e \"select sum(data_length + index_length) from information_schema.tables where table_schema = '{name}'\" --batch -s")
+        ])
     password_option = (None, ("", "--defaults-extra-file={PASSWORD_FILE}"), "[client]\nuser={user}\npassword={password}", None)
 
+    # Counting information_schema.tables opens every table in the schema, so we only look for one
+    is_empty_query = ("select 1 from information_schema.tables where table_schema = %s limit 1", ["{name}"])
+
+    # mysqldump puts a comment before each table and view and resets the session at the end
+    table_markers = [
+          r"-- (?:Table structure for table|Dumping data for table|Temporary (?:table|view) structure for view|Final view structure for view) `(.+)`"
+        , r"-- Dumping (?:routines|events) for database"
+        , r"/\*!40103 SET TIME_ZONE=@OLD_TIME_ZONE \*/;"
+        ]
+    size_query = ("select sum(data_length + index_length) from information_schema.tables where table_schema = %s", ["{name}"])
+    row_counts_query = ("select table_name, table_rows from information_schema.tables where table_schema = %s and table_type = 'BASE TABLE'", ["{name}"])
+
+    # mysqldump locks each table it dumps by default, --single-transaction reads them all from one InnoDB snapshot instead
+    # and --quick streams rows rather than holding each table in memory first. "minimal-lock" also leaves the
+    # LOCK TABLES out of the dump so restoring it doesn't lock each table while it's rows go in and "fast" makes
+    # bigger multi row inserts so restoring runs fewer statements
+    dump_profiles = {
+          "online": [("", "--single-transaction --quick")]
+        , "minimal-lock": [("", "--single-transaction --quick --skip-lock-tables --skip-add-locks")]
+        , "fast": [("", "--single-transaction --quick"), ("--net-buffer-length", "1048576")]
+        }
+
+    # mydumper takes one consistent snapshot and dumps the tables from it in parallel
+    # with a file for each table and myloader loads those files in parallel
+    directory_dump_template = ('mydumper', [
+          ("--threads", "{jobs}"), ("--outputdir", "{DUMP_DIR}")
+        , ("--user", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("--database", "{name}")
+        ])
+
+    # mydumper locks everything while it's threads start their transactions, --trx-consistency-only lets go
+    # once they have instead of holding the lock for the non InnoDB tables and --no-locks doesn't lock at all,
+    # which means only the InnoDB tables are consistent. --rows splits big tables so the threads can share them
+    directory_dump_profiles = {
+          "online": [("", "--trx-consistency-only")]
+        , "minimal-lock": [("", "--no-locks")]
+        , "fast": [("", "--trx-consistency-only"), ("--rows", "500000")]
+        }
+
+    directory_restore_template = ('myloader', [
+          ("--threads", "{jobs}"), ("--directory", "{DUMP_DIR}")
+        , ("--user", "{user}"), ("--host", "{host}"), ("--port", "{port}"), ("--database", "{name}")
+        ])
+
+    # The options for the mysql commands that mysql_binlog.py runs
+    # A full backup is a mysqldump that knows where the binlog was and an incremental backup is the binlog since then
+    incremental_dump_template = ('mysql', [("--user", "{user}"), ("--host", "{host}"), ("--port", "{port}")])
+
+    @contextmanager
+    def incremental_dump_command(self, state, since=None):
+        """Run mysql_binlog.py with the options for the mysql commands last, so the password file stays first for them"""
+        with super(MysqlDriver, self).incremental_dump_command(state, since) as (_, options, env, stdin):
+            script = [MYSQL_BINLOG, "dump", "--database", pipes.quote(self.database_info.name), "--state", pipes.quote(state)]
+            if since:
+                script.extend(["--since", pipes.quote(since)])
+            yield (sys.executable, "{0} -- {1}".format(" ".join(script), options), env, stdin)
+
+    def stop_at_stage(self, stop_at):
+        """Stop replaying the binlog at the first event after stop_at"""
+        return PythonStage(lambda chunks: mysql_binlog.events_until(chunks, stop_at), "Stopping at {0} UTC".format(stop_at))
+
+    def native_connect(self):
+        """Connect with PyMySQL if it's installed"""
+        pymysql = optional_import("pymysql")
+        if pymysql is None:
+            return None
+
+        info = self.database_info
+        options = {"database": info.name, "user": info.user, "password": info.password, "host": info.host, "autocommit": True}
+        options = dict((key, val) for key, val in options.items() if val)
+        if info.port:
+            options["port"] = int(info.port)
+        return lambda: pymysql.connect(**options)
+
 class SqliteDriver(DatabaseDriver):
     aliases = ('sqlite3', 'django.db.backends.sqlite3', )
     dump_template = ('sqlite3', "{name} .dump")
     restore_template = ('sqlite3', "{name}")
     is_empty_template = ('sqlite3', "{name} \"select count(*) from sqlite_master where type='table'\"")
 
+    is_empty_query = ("select 1 from sqlite_master where type = 'table' limit 1", [])
+
+    # .dump writes each table followed by it's rows and then the indexes, triggers and views
+    # sqlite only makes the CREATE keywords upper case in what it remembers of the sql
+    table_markers = [
+          r'CREATE TABLE (?:IF NOT EXISTS )?(?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|\'([^\']+)\'|([^\s(]+))'
+        , r'CREATE (?:UNIQUE )?INDEX [^\n]*? [Oo][Nn] (?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|\'([^\']+)\'|([^\s(]+))'
+        , r'CREATE TRIGGER [^\n]*? [Oo][Nn] (?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|\'([^\']+)\'|([^\s(]+))'
+        , r'CREATE VIEW (?:IF NOT EXISTS )?(?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|\'([^\']+)\'|([^\s(]+))'
+        , r'(?:DELETE FROM|INSERT INTO) "?(sqlite_sequence)\b'
+        , r'COMMIT;'
+        ]
+
+    row_counts_query = ("select tbl, max(cast(stat as integer)) from sqlite_stat1 where tbl not like 'sqlite_%' group by tbl", [])
+
+    # Connecting to sqlite is cheap and a connection we kept would still have the file open after a restore replaces it
+    pool_size = 0
+
     def is_empty(self):
         """Complain if the database doesn't exist to be consistent with other drivers"""
         if not os.path.exists(self.database_info.name):
             raise NoDatabase("There was no sqlite database at {0}".format(self.database_info.name))
         return super(SqliteDriver, self).is_empty()
 
+    def native_connect(self):
+        """python always has sqlite3"""
+        return lambda: sqlite3.connect(self.database_info.name, check_same_thread=False)
+
+    def estimated_size(self):
+        """The database is the file"""
+        if os.path.exists(self.database_info.name):
+            return os.path.getsize(self.database_info.name)
+
+    def row_counts(self):
+        """
+        Use the row counts ANALYZE keeps in sqlite_stat1 (the first number of each stat) like the estimates
+        of the other databases, counting them ourselves would read the whole database on every backup
+
+        Return None if there is no database or ANALYZE hasn't been run on it
+        """
+        if not os.path.exists(self.database_info.name):
+            return None
+        if not self.native_query(("select 1 from sqlite_master where type = 'table' and name = 'sqlite_stat1'", []), "Find sqlite_stat1"):
+            return None
+        return super(SqliteDriver, self).row_counts()
+
+class SqliteFileDriver(SqliteDriver):
+    """
+    Dump and restore sqlite databases as a copy of the database file rather than as sql
+
+    The database file is read by python's own sqlite3 module (see db_backup.sqlite_backup),
+    so we don't need the sqlite3 command and restoring is just writing the file.
+    It can still restore backups made with the sqlite3 engine.
+
+    Dumps read the database file a page at a time straight into the pipeline and incremental backups
+    only dump the pages that changed. Nothing else can write to the database while that happens.
+    """
+    aliases = ('sqlite3_file', )
+    table_markers = None
+    dump_template = (sys.executable, [("", SQLITE_BACKUP), ("", "dump"), ("", "{name}")])
+    restore_template = (sys.executable, [("", SQLITE_BACKUP), ("", "restore"), ("", "{name}")])
+    incremental_dump_template = (sys.executable, [
+          ("", SQLITE_BACKUP), ("", "dump"), ("", "{name}"), ("--pages", "{STATE}"), ("--since", "{SINCE}")
+        ])
+
 class DatabaseHandler(object):
     def __init__(self, database_info, database_driver=None):
         self.drivers = {}
@@ -195,22 +636,97 @@ class DatabaseHandler(object):
                 self._db_driver = self.given_database_driver
         return self._db_driver
 
-    def dump(self):
-        """Dump the contents of the database and yield a chunk at a time without hitting the disk"""
+    def dump(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None):
+        """
+        Dump the contents of the database and yield a chunk at a time without hitting the disk
+
+        The dump is killed if it goes idle_timeout seconds without output or takes longer than total_timeout seconds
+        and metrics is called with it's ProcessStats when it's done
+        """
         with self.db_driver.dump_command() as (command, options, env, stdin):
-            for chunk in stdout_chunks(command, options, "Dump command", env=env, stdin=stdin):
+            for chunk in stdout_chunks(command, options, "Dump command", env=env, stdin=stdin
+                , idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=metrics
+                ):
                 yield chunk
 
-    def restore(self, food):
-        """Restore from the provided chunks"""
-        with self.db_driver.restore_command() as (command, options, env, stdin):
+    @contextmanager
+    def dump_stage(self, state=None, since=None, base_backup=False):
+        """
+        Yield a ProcessStage for the dump command so it's output can go to the rest of a Pipeline
+
+        With state we make an incremental dump of what changed since the backup with the since state file
+        and remember what we dumped in state. With base_backup we copy the whole cluster instead.
+
+        The stage is only good until we're done because the command may need a temporary password file
+        """
+        if base_backup:
+            dump_command = self.db_driver.base_backup_command()
+        elif state is None:
+            dump_command = self.db_driver.dump_command()
+        else:
+            dump_command = self.db_driver.incremental_dump_command(state, since)
+
+        with dump_command as (command, options, env, stdin):
+            yield ProcessStage(command, options, "Dump command", env=env, stdin=stdin)
+
+    def dump_format(self, state=None, base_backup=False):
+        """Return what dump_stage dumps with these options ("directory" or "plain") or None for a base backup"""
+        if base_backup:
+            return None
+        return "plain" if state is not None else self.db_driver.dump_format
+
+    @contextmanager
+    def restore_stage(self, dump_format=None):
+        """
+        Yield a ProcessStage for the restore command so it can take it's input from the rest of a Pipeline
+        where dump_format is what the backup's dump_format was, if we know it
+
+        The stage is only good until we're done because the command may need a temporary password file
+        """
+        with self.db_driver.restore_command(dump_format) as (command, options, env, stdin):
+            yield ProcessStage(command, options, "Restore command", env=env, stdin=stdin)
+
+    def restore(self, food, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None, dump_format=None):
+        """
+        Restore from the provided chunks
+
+        The restore is killed if it goes idle_timeout seconds without progress or takes longer than total_timeout seconds
+        and metrics is called with it's ProcessStats when it's done
+        """
+        with self.db_driver.restore_command(dump_format) as (command, options, env, stdin):
             restorer = check_and_start_process(command, options, "Restore command", env=env, capture_stdin=True, stdin=stdin)
-            feed_process(restorer, "Restoring database", food)
+            watchdog = Watchdog("Restoring database", idle_timeout=idle_timeout, total_timeout=total_timeout)
+            feed_process(restorer, "Restoring database", food, watchdog=watchdog, metrics=metrics)
 
     def is_empty(self):
         """Work out if the database is empty"""
         return self.db_driver.is_empty()
 
+    def estimated_size(self):
+        """Return roughly how many bytes the database takes up or None if we can't tell"""
+        return self.db_driver.estimated_size()
+
+    def table_index(self):
+        """Return a TableIndex for finding the tables in a dump"""
+        return self.db_driver.table_index()
+
+    def row_counts(self):
+        """Return {table: rows} for the tables in the database or None if we can't tell"""
+        return self.db_driver.row_counts()
+
+    def stop_at_stage(self, stop_at):
+        """Return a stage that only lets through what an incremental dump did up to stop_at"""
+        return self.db_driver.stop_at_stage(stop_at)
+
+    def check_commands(self, *actions, **options):
+        """
+        Make sure we have the commands for these actions (i.e. "dump", "restore") before we need them
+        options are passed onto commands_for (i.e. the dump_format of what we're restoring)
+        """
+        for action in actions:
+            for command in self.db_driver.commands_for(action, **options):
+                check_for_command(command, "{0} command".format(action.capitalize()))
+
     def driver_for(self, database_info):
         """
         Find us a DBDriver object for this database.
@@ -236,6 +752,6 @@ class DatabaseHandler(object):
 
     def load_default_drivers(self):
         """Add the default database drivers we know about"""
-        for driver in (PsqlDriver, MysqlDriver, SqliteDriver):
+        for driver in (PsqlDriver, MysqlDriver, SqliteDriver, SqliteFileDriver):
             self.add_db_driver(driver)
 
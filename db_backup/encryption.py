@@ -1,12 +1,214 @@
-from db_backup.processes import feed_process, check_and_start_process, until, stdout_chunks, print_process
-from db_backup.errors import GPGFailedToStart
+from db_backup.processes import (
+      feed_process, check_and_start_process, stdout_chunks, head_of, communicate, regroup, map_in_order, run_concurrently
+    , ProcessStage, PythonStage, Watchdog, DEFAULT_IDLE_TIMEOUT
+    )
+from db_backup.compression import find_codec, detect_codec, MAGIC_SIZE
+from db_backup.errors import GPGFailedToStart, FailedToRun, BadBackupFile
+from db_backup.tables import keep_ranges, with_offsets
+from db_backup.chunking import content_defined
+
+from itertools import izip
+import multiprocessing
+import tempfile
+import hashlib
+import struct
+import pipes
+import errno
+import json
+import hmac
+import time
+import os
+
+# The first line of a chunked backup, which is how we tell it apart from a backup gpg made by itself
+CHUNKED_MAGIC = "db_backup chunked 1\n"
+
+# How much of a chunked backup each gpg encrypts
+CONTAINER_CHUNK_SIZE = 16 * 1024 * 1024
+
+# The first line of a deduplicated backup, which is followed by it's index encrypted by gpg
+DEDUP_MAGIC = "db_backup dedup 1\n"
+
+# The file next to deduplicated backups with the key that chunks are named with
+DEDUP_SETTINGS = ".db_backup_dedup"
+
+# The end of a chunked backup says how long it's index and encrypted data key are
+TRAILER = struct.Struct(">QQ")
+
+# The version of each gpg we've asked, keyed by it's homedir
+gpg_versions = {}
+
+# The files in a gpg homedir that change when it's keys do
+KEYRING_FILES = ["pubring.kbx", "pubring.gpg", "trustdb.gpg", os.path.join("public-keys.d", "pubring.db")]
+
+# The keys gpg gave us for each (recipient, gpg_home) and the keyring_state they came from
+recipient_keys = {}
+
+def encryptor_for(location):
+    """Return an Encryptor that can decrypt the backup at location"""
+    with open(location, "rb") as fle:
+        head = fle.read(max(len(CHUNKED_MAGIC), len(DEDUP_MAGIC)))
+    if head.startswith(CHUNKED_MAGIC):
+        return ChunkedEncryptor()
+    if head.startswith(DEDUP_MAGIC):
+        return DedupEncryptor()
+    return Encryptor()
+
+def gpg_version(gpg_home=None):
+    """Return the version of gpg as a tuple of numbers"""
+    if gpg_home not in gpg_versions:
+        options = "--version"
+        if gpg_home: options = "--homedir {0} --version".format(gpg_home)
+        first_line = ''.join(stdout_chunks("gpg", options, "Finding gpg version")).split("\n")[0]
+        gpg_versions[gpg_home] = tuple(int(part) for part in first_line.split()[-1].split(".") if part.isdigit())
+    return gpg_versions[gpg_home]
+
+def keyring_state(gpg_home=None):
+    """Return something about the keyring in gpg_home that changes whenever it's keys do"""
+    if gpg_home is None:
+        gpg_home = os.environ.get("GNUPGHOME") or os.path.expanduser("~/.gnupg")
+
+    state = []
+    for name in KEYRING_FILES:
+        try:
+            info = os.stat(os.path.join(gpg_home, name))
+        except OSError:
+            continue
+        state.append((name, info.st_mtime, info.st_size))
+    return tuple(state)
+
+def parse_keys(output):
+    """Return the GPGKeys in the output of gpg --list-keys --with-colons"""
+    keys = []
+    current = None
+    for line in output.split("\n"):
+        fields = line.split(":")
+        if fields[0] in ("pub", "sub") and len(fields) > 11:
+            current = GPGKey(fields[1], int(fields[6]) if fields[6] else None, fields[11])
+            if fields[0] == "pub":
+                keys.append(current)
+            elif keys:
+                keys[-1].subkeys.append(current)
+        elif fields[0] == "fpr" and len(fields) > 9 and current is not None and current.fingerprint is None:
+            current.fingerprint = fields[9]
+    return keys
+
+class GPGKey(object):
+    """
+    A key from gpg's keyring
+
+    validity is the letter gpg gives it, expires is when it expires (or None) and capabilities is
+    the letters for what it can do. Subkeys are GPGKeys as well.
+    """
+    def __init__(self, validity, expires, capabilities, fingerprint=None):
+        self.validity = validity
+        self.expires = expires
+        self.fingerprint = fingerprint
+        self.capabilities = capabilities
+        self.subkeys = []
+
+    def valid(self, now):
+        """Say whether this key hasn't been revoked, disabled or expired by now"""
+        return self.validity not in ("r", "d", "i", "e") and not (self.expires and self.expires <= now)
+
+    def problem(self, capability="e", now=None):
+        """Return why this key can't be used for capability ("e" to encrypt, "s" to sign) or None if it can"""
+        if now is None:
+            now = time.time()
+
+        if self.validity == "r":
+            return "has been revoked"
+        elif self.validity == "d":
+            return "has been disabled"
+        elif self.validity == "i":
+            return "is invalid"
+        elif self.expires and self.expires <= now:
+            return "expired at {0}".format(time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(self.expires)))
+        elif self.validity == "e":
+            return "has expired"
+
+        if not any(key.valid(now) and capability in key.capabilities for key in [self] + self.subkeys):
+            return "has no usable subkey that can {0}".format({"e": "encrypt", "s": "sign"}.get(capability, capability))
 
 class Encryptor(object):
     """Used to encrypt and decrypt with gpg"""
 
-    def encrypt(self, input_iterator, recipients, destination, gpg_home=None):
-        """Encrypt chunks from the provided iterator"""
+    def check_recipients(self, recipients, gpg_home=None):
+        """
+        Make sure gpg has a key that can encrypt for each of our recipients and return their fingerprints
+        raising GPGFailedToStart if it doesn't
+
+        Encrypting for the fingerprints means gpg uses exactly the keys we checked
+        """
+        found = run_concurrently(*[lambda recipient=recipient: self.find_key(recipient, gpg_home) for recipient in recipients])
+        return [key.fingerprint for key in found]
+
+    def find_key(self, recipient, gpg_home=None, capability="e"):
+        """
+        Return the first GPGKey for recipient that can be used for capability or raise GPGFailedToStart if there isn't one
+
+        We remember what gpg told us about the recipient until the keyring changes,
+        but whether the key has expired is checked every time
+        """
+        state = keyring_state(gpg_home)
+        cached_state, keys = recipient_keys.get((recipient, gpg_home), (None, None))
+        if cached_state != state or not state:
+            options = ["--list-keys", "--with-colons", "--with-fingerprint", "--batch"]
+            if gpg_home: options.extend(["--homedir", gpg_home])
+            options.append(pipes.quote(recipient))
+
+            try:
+                keys = parse_keys(''.join(stdout_chunks("gpg", ' '.join(options), "Finding recipient keys")))
+            except FailedToRun:
+                keys = []
+            recipient_keys[(recipient, gpg_home)] = (state, keys)
+
+        if not keys:
+            raise GPGFailedToStart("GPG didn't even start: couldn't find a key for {0}".format(recipient))
+
+        for key in keys:
+            if key.problem(capability) is None:
+                return key
+        raise GPGFailedToStart("GPG didn't even start: the key for {0} ({1}) {2}".format(recipient, keys[0].fingerprint, keys[0].problem(capability)))
+
+    def encrypt(self, input_iterator, recipients, destination, gpg_home=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None):
+        """
+        Encrypt chunks from the provided iterator
+
+        gpg is killed if it goes idle_timeout seconds without progress or takes longer than total_timeout seconds
+        and metrics is called with it's ProcessStats when it's done
+        """
         desc = "Encrypting something"
+        process = self.start_encrypting(recipients, destination, desc, gpg_home=gpg_home, capture_stdin=True)
+        watchdog = Watchdog(desc, idle_timeout=idle_timeout, total_timeout=total_timeout)
+        feed_process(process, desc, input_iterator, watchdog=watchdog, metrics=metrics)
+
+    def encrypt_stage(self, recipients, destination, gpg_home=None, codec=None):
+        """
+        Return a ProcessStage that encrypts whatever the stage before it produces into destination
+        complaining first if we don't know the recipients
+
+        codec is the Codec that already compressed what we're given, so gpg doesn't compress it again
+        """
+        fingerprints = self.check_recipients(recipients, gpg_home)
+        return ProcessStage("gpg", self.encrypt_options(fingerprints, destination, gpg_home, compress=codec is None), "Encrypting something")
+
+    def encrypt_stages(self, recipients, destination, gpg_home=None, codec=None, hasher=None):
+        """
+        Return the stages for a Pipeline that encrypt whatever comes before them into destination
+
+        If we have a hasher (a StreamHash) then gpg gives us what it encrypted so the hasher sees it on the way into destination
+        """
+        if hasher is None:
+            return [self.encrypt_stage(recipients, destination, gpg_home, codec)]
+        return [self.encrypt_stage(recipients, "-", gpg_home, codec), hasher.writer(destination)]
+
+    def start_encrypting(self, recipients, destination, desc, gpg_home=None, **start_args):
+        """Start gpg encrypting it's stdin for our recipients, complaining first if we don't know them"""
+        fingerprints = self.check_recipients(recipients, gpg_home)
+        return check_and_start_process("gpg", self.encrypt_options(fingerprints, destination, gpg_home), desc, **start_args)
+
+    def encrypt_options(self, recipients, destination, gpg_home=None, compress=True):
+        """Return the options for gpg to encrypt it's stdin into destination for our recipients"""
         options = [
             "--trust-model", "always"
           , "-r", " -r ".join(recipients)
@@ -14,21 +216,361 @@ class Encryptor(object):
           , "-e"
           ]
         if gpg_home: options.extend(["--homedir", gpg_home])
+        if not compress: options.extend(["--compress-algo", "none"])
+        return ' '.join(options)
+
+    def decrypt(self, location, gpg_home=None, password=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, metrics=None):
+        """
+        Decrypt provided location and yield chunks of decrypted data
 
-        process = check_and_start_process("gpg", ' '.join(options), desc, capture_stdin=True)
+        gpg is killed if it goes idle_timeout seconds without output or takes longer than total_timeout seconds
+        and metrics is called with it's ProcessStats when it's done
+        """
+        return stdout_chunks("gpg", self.decrypt_options(location, gpg_home, password), "Decrypting something", interaction=password
+            , idle_timeout=idle_timeout, total_timeout=total_timeout, metrics=metrics
+            )
 
-        # See if it fails to start (i.e. bad recipients)
-        for _ in until(timeout=0.5):
-            print_process(process, desc)
-            if process.poll() not in (None, 0):
-                raise GPGFailedToStart("GPG didn't even start")
+    def decrypt_stages(self, location, gpg_home=None, password=None, ranges=None):
+        """
+        Return the stages for a Pipeline that decrypt the location and decompress it if it was compressed
 
-        feed_process(process, desc, input_iterator)
+        Compressed backups start with the magic bytes of whatever compressed them
 
-    def decrypt(self, location, gpg_home=None, password=None):
-        """Decrypt provided location and yield chunks of decrypted data"""
+        ranges is a list of (start, end) in what was encrypted to let through instead of all of it
+        """
+        stages = [self.decrypt_stage(location, gpg_home, password)]
+        codec = detect_codec(self.decrypted_head(location, MAGIC_SIZE, gpg_home, password))
+        if codec:
+            stages.append(codec.decompress_stage())
+        if ranges is not None:
+            stages.append(self.ranges_stage(ranges))
+        return stages
+
+    def ranges_stage(self, ranges):
+        """Return a PythonStage that only lets through the (start, end) ranges of what it's given"""
+        return PythonStage(lambda chunks: keep_ranges(with_offsets(chunks), ranges), "Skipping other tables")
+
+    def decrypt_stage(self, location, gpg_home=None, password=None):
+        """Return a ProcessStage that decrypts the provided location for the stages after it"""
+        return ProcessStage("gpg", self.decrypt_options(location, gpg_home, password), "Decrypting something", interaction=password)
+
+    def decrypted_head(self, location, size, gpg_home=None, password=None):
+        """Return the first size bytes of the decrypted location without decrypting the rest of it"""
+        return head_of("gpg", self.decrypt_options(location, gpg_home, password), "Peeking at something", size, interaction=password)
+
+    def decrypt_options(self, location, gpg_home=None, password=None):
+        """Return the options for gpg to decrypt location to it's stdout"""
         options = ["--trust-model", "always", "-d", "--no-tty"]
         if gpg_home: options.extend(["--homedir", gpg_home])
         if password: options.extend(["--passphrase-file", "/dev/stdin"])
         options.append(location)
-        return stdout_chunks("gpg", ' '.join(options), "Decrypting something", interaction=password)
+        return ' '.join(options)
+
+    def encrypt_for_us(self, data, recipients, desc, gpg_home=None):
+        """Return something small encrypted for our recipients"""
+        fingerprints = self.check_recipients(recipients, gpg_home)
+        return communicate("gpg", self.encrypt_options(fingerprints, "-", gpg_home), desc, data)
+
+    def decrypt_for_us(self, encrypted, desc, gpg_home=None, password=None):
+        """Return something small that was encrypted for our recipients, decrypted"""
+        options = "--trust-model always -d --no-tty --batch"
+        if gpg_home: options = "{0} --homedir {1}".format(options, gpg_home)
+        if password:
+            options = self.symmetric_options(gpg_home, "--trust-model", "always", "-d")
+            encrypted = "{0}\n{1}".format(password, encrypted)
+        return communicate("gpg", options, desc, encrypted)
+
+    def symmetric_options(self, gpg_home=None, *extra):
+        """Return options for gpg that take a passphrase from the first line of stdin"""
+        options = ["--batch", "--quiet", "--no-tty", "--passphrase-fd", "0"]
+        if gpg_home: options.extend(["--homedir", gpg_home])
+
+        # Newer gpg asks an agent for passphrases unless we tell it not to
+        if gpg_version(gpg_home) >= (2, 1):
+            options.extend(["--pinentry-mode", "loopback"])
+
+        options.extend(extra)
+        return ' '.join(options)
+
+class ChunkedEncryptor(Encryptor):
+    """
+    Encrypt into a container of chunks that are encrypted and decrypted in parallel
+
+    Each chunk is encrypted by it's own gpg with a passphrase made from a random data key and the position of the chunk
+    and gpg only encrypts that data key for our recipients, so we use as many cores as we have workers.
+
+    The container is CHUNKED_MAGIC, the encrypted chunks, an index of where each chunk is,
+    the encrypted data key (along with how many chunks there are and the codec that compressed them)
+    and then TRAILER with the lengths of the index and the data key so we can find them from the end.
+    """
+    def __init__(self, chunk_size=CONTAINER_CHUNK_SIZE, workers=None):
+        super(ChunkedEncryptor, self).__init__()
+        self.chunk_size = chunk_size
+        self.workers = workers or multiprocessing.cpu_count()
+
+    def encrypt_stage(self, recipients, destination, gpg_home=None, codec=None, hasher=None):
+        """
+        Return a PythonStage that encrypts whatever the stage before it produces into a container at destination
+        complaining first if we don't know the recipients
+
+        codec is the Codec that already compressed what we're given, so gpg doesn't compress it again
+        and hasher is a StreamHash that sees everything we write to destination
+        """
+        self.check_recipients(recipients, gpg_home)
+
+        def encrypt(chunks):
+            self.write_container(chunks, recipients, destination, gpg_home, codec, hasher)
+            return iter(())
+        return PythonStage(encrypt, "Encrypting chunks")
+
+    def encrypt_stages(self, recipients, destination, gpg_home=None, codec=None, hasher=None):
+        """Return the stages for a Pipeline that encrypt whatever comes before them into a container at destination"""
+        return [self.encrypt_stage(recipients, destination, gpg_home, codec, hasher)]
+
+    def write_container(self, chunks, recipients, destination, gpg_home=None, codec=None, hasher=None):
+        """Encrypt the chunks into a container at destination, giving what we write to the hasher if there is one"""
+        fingerprints = self.check_recipients(recipients, gpg_home)
+        key = os.urandom(32)
+
+        def encrypt(numbered):
+            number, piece = numbered
+            passphrase = self.chunk_passphrase(key, number)
+            # The passphrase is already as random as it gets, so making it slow to guess would only slow us down
+            options = self.symmetric_options(gpg_home
+                , "--symmetric", "--cipher-algo", "AES256", "--s2k-digest-algo", "SHA256", "--s2k-count", "1024", "--output", "-"
+                )
+            if codec: options = "{0} --compress-algo none".format(options)
+            return communicate("gpg", options, "Encrypting chunk {0}".format(number), "{0}\n{1}".format(passphrase, piece))
+
+        index = []
+        with open(destination, "wb") as fle:
+            def write(data):
+                fle.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+
+            write(CHUNKED_MAGIC)
+            for encrypted in map_in_order(encrypt, enumerate(regroup(chunks, self.chunk_size)), self.workers):
+                index.append([fle.tell(), len(encrypted)])
+                write(encrypted)
+
+            header = json.dumps({"key": key.encode("hex"), "chunks": len(index), "chunk_size": self.chunk_size, "codec": codec.name if codec else None})
+            wrapped = communicate("gpg", self.encrypt_options(fingerprints, "-", gpg_home), "Encrypting the data key", header)
+
+            index = json.dumps(index)
+            write(index)
+            write(wrapped)
+            write(TRAILER.pack(len(index), len(wrapped)))
+
+    def decrypt_stages(self, location, gpg_home=None, password=None, ranges=None):
+        """
+        Return the stages for a Pipeline that decrypt the container at location and decompress it if it was compressed
+
+        If we only want some ranges of it and it wasn't compressed then we only decrypt the chunks those ranges are in
+        """
+        header, index = self.read_container(location, gpg_home, password)
+        if ranges is not None and not header["codec"] and header.get("chunk_size"):
+            size = header["chunk_size"]
+            numbers = sorted(set(number for start, end in ranges for number in range(start // size, (end - 1) // size + 1) if number < len(index)))
+            pieces = lambda: izip([number * size for number in numbers], self.decrypt_chunks(location, header, index, gpg_home, numbers))
+            return [PythonStage(lambda _: keep_ranges(pieces(), ranges), "Decrypting chunks")]
+
+        stages = [PythonStage(lambda _: self.decrypt_chunks(location, header, index, gpg_home), "Decrypting chunks")]
+        if header["codec"]:
+            stages.append(find_codec(header["codec"]).decompress_stage())
+        if ranges is not None:
+            stages.append(self.ranges_stage(ranges))
+        return stages
+
+    def read_container(self, location, gpg_home=None, password=None):
+        """Return the decrypted header and the index from the container at location"""
+        with open(location, "rb") as fle:
+            if fle.read(len(CHUNKED_MAGIC)) != CHUNKED_MAGIC:
+                raise BadBackupFile("The backup file at '{0}' isn't a chunked backup".format(location))
+
+            try:
+                fle.seek(-TRAILER.size, os.SEEK_END)
+                index_length, wrapped_length = TRAILER.unpack(fle.read(TRAILER.size))
+                fle.seek(-(TRAILER.size + index_length + wrapped_length), os.SEEK_END)
+                index = json.loads(fle.read(index_length))
+                wrapped = fle.read(wrapped_length)
+            except (IOError, ValueError, struct.error) as error:
+                raise BadBackupFile("Couldn't find the index of the backup at '{0}': {1}".format(location, error))
+
+        header = json.loads(self.decrypt_for_us(wrapped, "Decrypting the data key", gpg_home, password))
+        if len(index) != header["chunks"]:
+            raise BadBackupFile("The backup file at '{0}' has {1} chunks but should have {2}".format(location, len(index), header["chunks"]))
+        return header, index
+
+    def decrypt_chunks(self, location, header, index, gpg_home=None, numbers=None):
+        """Yield the decrypted chunks of the container at location in order, only the chunks with these numbers if we have them"""
+        key = header["key"].decode("hex")
+        if numbers is None:
+            numbers = range(len(index))
+
+        def decrypt(numbered):
+            number, (offset, length) = numbered
+            with open(location, "rb") as fle:
+                fle.seek(offset)
+                encrypted = fle.read(length)
+
+            passphrase = self.chunk_passphrase(key, number)
+            options = self.symmetric_options(gpg_home, "-d")
+            return communicate("gpg", options, "Decrypting chunk {0}".format(number), "{0}\n{1}".format(passphrase, encrypted))
+
+        for piece in map_in_order(decrypt, [(number, index[number]) for number in numbers], self.workers):
+            yield piece
+
+    def chunk_passphrase(self, key, number):
+        """The passphrase for a chunk depends on where it is so chunks can't be moved around"""
+        return hmac.new(key, "chunk {0}".format(number), hashlib.sha256).hexdigest()
+
+class DedupEncryptor(ChunkedEncryptor):
+    """
+    Encrypt into chunks that are shared with every other deduplicated backup in the same directory
+
+    The dump is split where it's content says to (see db_backup.chunking) so a change only changes the chunks around it
+    and each chunk is encrypted by gpg for our recipients into chunks/ in the backup directory, named after it's content.
+    A chunk that is already there isn't written again, so the backup itself is only DEDUP_MAGIC
+    and then the names of it's chunks encrypted for our recipients.
+
+    Chunks are named with a key from DEDUP_SETTINGS and the recipients, so names can't be matched between directories
+    and chunks for different recipients are kept apart. Chunks are never removed, even when no backup needs them anymore.
+
+    Each chunk has the sha256 and size of it's encrypted self in a .sha256 file next to it (written after the chunk),
+    so we know what a chunk we didn't write should look like without reading it. digests has those for the chunks of each destination we wrote
+    so they can go in it's manifest and verify can check the chunks as well as the backup file.
+    """
+    def __init__(self, *args, **kwargs):
+        super(DedupEncryptor, self).__init__(*args, **kwargs)
+        self.digests = {}
+
+    def encrypt_stage(self, recipients, destination, gpg_home=None, codec=None, hasher=None):
+        """
+        Return a PythonStage that stores whatever the stage before it produces as chunks next to destination
+        and writes the index of those chunks into destination, complaining first if we don't know the recipients
+
+        The chunks are compressed by gpg, so codec is ignored
+        """
+        self.check_recipients(recipients, gpg_home)
+
+        def encrypt(chunks):
+            self.write_index(chunks, recipients, destination, gpg_home, hasher)
+            return iter(())
+        return PythonStage(encrypt, "Deduplicating chunks")
+
+    def write_index(self, chunks, recipients, destination, gpg_home=None, hasher=None):
+        """Store the chunks that aren't already stored and write the index of all of them into destination"""
+        fingerprints = sorted(self.check_recipients(recipients, gpg_home))
+        directory = os.path.dirname(os.path.abspath(destination))
+        naming_key = hmac.new(self.settings(directory)["key"].decode("hex"), " ".join(fingerprints), hashlib.sha256).digest()
+
+        def store(piece):
+            name = hmac.new(naming_key, piece, hashlib.sha256).hexdigest()
+            location = self.chunk_path(directory, name)
+            if not os.path.exists(location):
+                # The same chunk can be stored by another thread (or backup) at the same time and the first one wins,
+                # so the digest is only ours to write if it was our chunk that got there
+                encrypted = communicate("gpg", self.encrypt_options(fingerprints, "-", gpg_home), "Encrypting chunk {0}".format(name), piece)
+                if write_atomically(location, encrypted, replace=False):
+                    write_atomically(self.digest_path(location), json.dumps({"sha256": hashlib.sha256(encrypted).hexdigest(), "size": len(encrypted)}))
+            return name, self.chunk_digest(location)
+
+        stored = list(map_in_order(store, content_defined(chunks), self.workers))
+        names = [name for name, _ in stored]
+        self.digests[destination] = dict(stored)
+        wrapped = communicate("gpg", self.encrypt_options(fingerprints, "-", gpg_home), "Encrypting the index", json.dumps({"chunks": names}))
+
+        with open(destination, "wb") as fle:
+            for data in (DEDUP_MAGIC, wrapped):
+                fle.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+
+    def decrypt_stages(self, location, gpg_home=None, password=None, ranges=None):
+        """Return the stages for a Pipeline that decrypt the chunks of the backup at location in order"""
+        names = self.read_index(location, gpg_home, password)
+        directory = os.path.dirname(os.path.abspath(location))
+
+        def decrypt(name):
+            chunk_location = self.chunk_path(directory, name)
+            if not os.path.exists(chunk_location):
+                raise BadBackupFile("The backup file at '{0}' needs a chunk that doesn't exist: {1}".format(location, name))
+            with open(chunk_location, "rb") as fle:
+                return self.decrypt_for_us(fle.read(), "Decrypting chunk {0}".format(name), gpg_home, password)
+
+        stages = [PythonStage(lambda _: map_in_order(decrypt, names, self.workers), "Decrypting chunks")]
+        if ranges is not None:
+            stages.append(self.ranges_stage(ranges))
+        return stages
+
+    def read_index(self, location, gpg_home=None, password=None):
+        """Return the names of the chunks in the backup at location"""
+        with open(location, "rb") as fle:
+            if fle.read(len(DEDUP_MAGIC)) != DEDUP_MAGIC:
+                raise BadBackupFile("The backup file at '{0}' isn't a deduplicated backup".format(location))
+            wrapped = fle.read()
+        return json.loads(self.decrypt_for_us(wrapped, "Decrypting the index", gpg_home, password))["chunks"]
+
+    def settings(self, directory):
+        """Return the settings for deduplicated backups in directory, making them if they don't exist yet"""
+        location = os.path.join(directory, DEDUP_SETTINGS)
+        if not os.path.exists(location):
+            write_atomically(location, json.dumps({"version": 1, "key": os.urandom(32).encode("hex")}), replace=False)
+        with open(location) as fle:
+            return json.load(fle)
+
+    def chunk_path(self, directory, name):
+        """Where the chunk with this name lives"""
+        return os.path.join(directory, "chunks", name[:2], name)
+
+    def digest_path(self, location):
+        """Where the sha256 and size of the chunk at location lives"""
+        return "{0}.sha256".format(location)
+
+    def chunk_digest(self, location):
+        """Return {sha256, size} for the chunk at location, hashing it if it was stored before we kept them or is still being stored"""
+        digest_location = self.digest_path(location)
+        if not os.path.exists(digest_location):
+            with open(location, "rb") as fle:
+                data = fle.read()
+            write_atomically(digest_location, json.dumps({"sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}))
+        with open(digest_location) as fle:
+            return json.load(fle)
+
+def write_atomically(location, data, replace=True):
+    """
+    Write data into a file next to location and then move it into place, so location is never half written
+
+    Without replace we leave location alone if something else got there first
+    Return whether it was our data that ended up at location
+    """
+    directory = os.path.dirname(location)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another thread made it first
+            if not os.path.isdir(directory):
+                raise
+
+    handle, temporary = tempfile.mkstemp(dir=directory, prefix=".{0}.".format(os.path.basename(location)))
+    try:
+        with os.fdopen(handle, "wb") as fle:
+            fle.write(data)
+        if replace:
+            os.rename(temporary, location)
+        elif os.path.exists(location):
+            return False
+        else:
+            try:
+                os.link(temporary, location)
+            except OSError as error:
+                # Something else got there between us looking and linking
+                if error.errno != errno.EEXIST:
+                    raise
+                return False
+        return True
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
@@ -28,3 +28,23 @@ class NoDBDriver(FailedBackup):
 class NoDatabase(FailedBackup):
     """Exception for when we don't have a Database to work with"""
 
+class TimedOut(FailedBackup):
+    """Exception for when a process stops making progress or runs out of time"""
+
+class BadBackupDir(FailedBackup):
+    """Exception for when we can't put a backup in the backup directory"""
+
+class UnknownCompression(FailedBackup):
+    """Exception for when we're asked to compress with something we don't know"""
+
+class FailedVerification(FailedBackup):
+    """Exception for when a backup isn't what it's manifest says it should be"""
+
+class NotIncremental(FailedBackup):
+    """Exception for when we're asked for an incremental or base backup of something that can't do them"""
+
+class NoTableIndex(FailedBackup):
+    """Exception for when we're asked to index the tables of a dump we can't find them in"""
+
+class UnknownProfile(FailedBackup):
+    """Exception for when we're asked to dump with a profile the database driver doesn't have"""
@@ -0,0 +1,101 @@
+from db_backup.errors import BadBackupFile
+
+import json
+import time
+import os
+
+class ChainLink(object):
+    """
+    A backup in a chain of incremental backups, where each backup only has what changed since the one before it
+
+    The .chain file next to the backup says which database it is of and which backups in the same directory
+    are needed to restore it, starting from the full backup at the start of the chain.
+    The .state file next to it is written by the dump and remembers what the database looked like
+    (i.e. the keyed digest of every page for sqlite or the binlog position for mysql) so the next backup knows what changed.
+    It starts with a line of json that says whether the dump was "full" or "incremental".
+    """
+    def __init__(self, location, database, previous=None, kind="full", created=None):
+        self.kind = kind
+        self.location = location
+        self.database = database
+        self.previous = list(previous or [])
+        self.created = created or time.time()
+
+    @property
+    def path(self):
+        """Where the chain file for this backup lives"""
+        return "{0}.chain".format(self.location)
+
+    @property
+    def state_path(self):
+        """Where the state file for this backup lives"""
+        return "{0}.state".format(self.location)
+
+    @property
+    def chain(self):
+        """The locations of every backup needed to restore this one, starting with the full backup"""
+        directory = os.path.dirname(self.location)
+        return [os.path.join(directory, name) for name in self.previous] + [self.location]
+
+    def after(self, location):
+        """Return the ChainLink for a backup at location that comes after this one"""
+        previous = self.previous + [os.path.basename(self.location)]
+        return self.__class__(location, self.database, previous, kind="incremental")
+
+    def write(self):
+        """
+        Write the chain file for this backup
+
+        The dump decides whether it could make an incremental backup and says so in the state file,
+        so a full backup starts a new chain
+        """
+        with open(self.state_path) as fle:
+            self.kind = json.loads(fle.readline())["kind"]
+        if self.kind == "full":
+            self.previous = []
+
+        with open(self.path, "w") as fle:
+            json.dump(self.as_dict(), fle, indent=4, sort_keys=True)
+
+    def as_dict(self):
+        """Return what goes into the chain file"""
+        return {
+              "version": 1
+            , "kind": self.kind
+            , "created": self.created
+            , "database": self.database
+            , "chain": [os.path.basename(location) for location in self.chain]
+            }
+
+    @classmethod
+    def of(kls, location):
+        """Return the ChainLink for the backup at location or None if it isn't part of a chain"""
+        path = "{0}.chain".format(location)
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as fle:
+            try:
+                info = json.load(fle)
+            except ValueError as error:
+                raise BadBackupFile("Couldn't read the chain file for the backup at '{0}': {1}".format(location, error))
+        return kls(location, info["database"], info["chain"][:-1], kind=info["kind"], created=info["created"])
+
+    @classmethod
+    def latest(kls, backup_dir, database):
+        """Return the newest ChainLink in backup_dir for this database or None if there isn't one"""
+        links = []
+        for filename in os.listdir(backup_dir):
+            if filename.endswith(".chain"):
+                link = kls.of(os.path.join(backup_dir, filename[:-len(".chain")]))
+                if link.database == database and os.path.exists(link.state_path):
+                    links.append(link)
+
+        if links:
+            return sorted(links, key=lambda link: link.created)[-1]
+
+    def check(self):
+        """Complain if any of the backups needed to restore this one are missing"""
+        for location in self.chain:
+            if not os.path.exists(location):
+                raise BadBackupFile("The backup at '{0}' needs '{1}' which doesn't exist".format(self.location, location))
@@ -0,0 +1,197 @@
+from db_backup.processes import PythonStage, stdout_chunks, CHUNK_SIZE
+from db_backup.errors import FailedVerification, FailedToRun
+from db_backup.encryption import DedupEncryptor, parse_keys
+
+import hashlib
+import pipes
+import json
+import time
+import os
+
+class StreamHash(object):
+    """The sha256 and size of a stream that we see a chunk at a time"""
+    def __init__(self):
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def update(self, chunk):
+        """Add a chunk to the hash"""
+        self.size += len(chunk)
+        self.hash.update(chunk)
+
+    def hexdigest(self):
+        """Return the hash of what we've seen so far"""
+        return self.hash.hexdigest()
+
+    def stage(self, desc):
+        """Return a PythonStage that hashes what goes through it"""
+        def hash_chunks(chunks):
+            for chunk in chunks:
+                self.update(chunk)
+                yield chunk
+        return PythonStage(hash_chunks, desc)
+
+    def sink(self, desc):
+        """Return a PythonStage that hashes what it is given and goes no further"""
+        def hash_chunks(chunks):
+            for chunk in chunks:
+                self.update(chunk)
+            return iter(())
+        return PythonStage(hash_chunks, desc)
+
+    def writer(self, destination, desc="Writing the backup"):
+        """Return a PythonStage that writes what it is given into destination and hashes it on the way"""
+        def write(chunks):
+            with open(destination, "wb") as fle:
+                for chunk in chunks:
+                    self.update(chunk)
+                    fle.write(chunk)
+            return iter(())
+        return PythonStage(write, desc)
+
+    @classmethod
+    def of_file(kls, location):
+        """Return a StreamHash of everything in a file"""
+        hasher = kls()
+        with open(location, "rb") as fle:
+            while True:
+                chunk = fle.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        return hasher
+
+class Manifest(object):
+    """
+    What a backup should look like, so it can be checked without restoring it
+
+    plaintext is a StreamHash of the dump and ciphertext is a StreamHash of the backup file.
+    chunks is {name: {sha256, size}} of the encrypted chunks a deduplicated backup needs besides the backup file.
+    The manifest is written as json next to the backup with a detached gpg signature if we have a signer.
+    """
+    def __init__(self, location, plaintext=None, ciphertext=None, chunks=None):
+        self.chunks = chunks
+        self.location = location
+        self.plaintext = plaintext or StreamHash()
+        self.ciphertext = ciphertext or StreamHash()
+
+    @property
+    def path(self):
+        """Where the manifest for this backup lives"""
+        return "{0}.manifest".format(self.location)
+
+    @property
+    def signature_path(self):
+        """Where the signature for the manifest lives"""
+        return "{0}.asc".format(self.path)
+
+    def as_dict(self):
+        """Return what goes into the manifest"""
+        info = {
+              "version": 1
+            , "created": time.time()
+            , "file": os.path.basename(self.location)
+            , "plaintext": {"sha256": self.plaintext.hexdigest(), "size": self.plaintext.size}
+            , "ciphertext": {"sha256": self.ciphertext.hexdigest(), "size": self.ciphertext.size}
+            }
+        if self.chunks is not None:
+            info["chunks"] = self.chunks
+        return info
+
+    def write(self, signer=None, gpg_home=None):
+        """Write the manifest next to the backup and sign it if we have a signer"""
+        with open(self.path, "w") as fle:
+            json.dump(self.as_dict(), fle, indent=4, sort_keys=True)
+
+        if signer:
+            options = ["--batch", "--yes", "--armor", "--detach-sign", "--local-user", pipes.quote(signer), "--output", self.signature_path]
+            if gpg_home: options.extend(["--homedir", gpg_home])
+            options.append(self.path)
+            list(stdout_chunks("gpg", ' '.join(options), "Signing the manifest"))
+
+    def read(self, gpg_home=None, signer=None):
+        """
+        Return what the manifest for this backup says, checking it's signature if it has one
+
+        With a signer (a uid or fingerprint) the manifest has to be signed and by that key,
+        otherwise anyone who can change the manifest could remove the signature or sign it themselves
+
+        Raise FailedVerification if there is no manifest or it's signature is bad
+        """
+        if not os.path.exists(self.path):
+            raise FailedVerification("There is no manifest for the backup at '{0}'".format(self.location))
+
+        if signer and not os.path.exists(self.signature_path):
+            raise FailedVerification("The manifest for the backup at '{0}' isn't signed".format(self.location))
+
+        if os.path.exists(self.signature_path):
+            signed_by = self.check_signature(gpg_home)
+            if signer and not signed_by & self.fingerprints_for(signer, gpg_home):
+                raise FailedVerification("The manifest for the backup at '{0}' wasn't signed by {1}".format(self.location, signer))
+
+        with open(self.path) as fle:
+            try:
+                return json.load(fle)
+            except ValueError as error:
+                raise FailedVerification("Couldn't read the manifest for the backup at '{0}': {1}".format(self.location, error))
+
+    def check_signature(self, gpg_home=None):
+        """
+        Return the fingerprints of the key (and it's primary key) that made the good signature of the manifest
+
+        gpg tells us about a good signature with a VALIDSIG line on it's status-fd
+        """
+        options = ["--batch", "--status-fd", "1", "--verify"]
+        if gpg_home: options.extend(["--homedir", gpg_home])
+        options.extend([self.signature_path, self.path])
+        try:
+            status = ''.join(stdout_chunks("gpg", ' '.join(options), "Checking the manifest signature"))
+        except FailedToRun:
+            raise FailedVerification("The manifest for the backup at '{0}' has a bad signature".format(self.location))
+
+        signed_by = set()
+        for line in status.split("\n"):
+            fields = line.split()
+            if fields[:2] == ["[GNUPG:]", "VALIDSIG"] and len(fields) > 2:
+                signed_by.update([fields[2], fields[-1]])
+        if not signed_by:
+            raise FailedVerification("The manifest for the backup at '{0}' has a bad signature".format(self.location))
+        return signed_by
+
+    def fingerprints_for(self, signer, gpg_home=None):
+        """Return the fingerprints of the keys (and their subkeys) in the keyring for signer"""
+        options = ["--list-keys", "--with-colons", "--with-fingerprint", "--batch"]
+        if gpg_home: options.extend(["--homedir", gpg_home])
+        options.append(pipes.quote(signer))
+
+        try:
+            keys = parse_keys(''.join(stdout_chunks("gpg", ' '.join(options), "Finding the signer's keys")))
+        except FailedToRun:
+            keys = []
+
+        if not keys:
+            raise FailedVerification("Couldn't find a key for {0} to check the manifest signature with".format(signer))
+        return set(found.fingerprint for key in keys for found in [key] + key.subkeys)
+
+    def check(self, expected, kind):
+        """Complain if what we've hashed of kind ("plaintext" or "ciphertext") isn't what the manifest expected"""
+        hasher = getattr(self, kind)
+        if (hasher.hexdigest(), hasher.size) != (expected[kind]["sha256"], expected[kind]["size"]):
+            raise FailedVerification("The {0} of the backup at '{1}' doesn't match it's manifest (sha256 {2} and {3} bytes instead of {4} and {5})".format(
+                kind, self.location, hasher.hexdigest(), hasher.size, expected[kind]["sha256"], expected[kind]["size"]
+                ))
+
+    def check_chunks(self, expected):
+        """Complain if a chunk the manifest expected is missing or isn't what it should be"""
+        encryptor = DedupEncryptor()
+        directory = os.path.dirname(os.path.abspath(self.location))
+        for name, digest in sorted(expected.get("chunks", {}).items()):
+            location = encryptor.chunk_path(directory, name)
+            if not os.path.exists(location):
+                raise FailedVerification("The backup at '{0}' needs a chunk that doesn't exist: {1}".format(self.location, name))
+
+            hasher = StreamHash.of_file(location)
+            if (hasher.hexdigest(), hasher.size) != (digest["sha256"], digest["size"]):
+                raise FailedVerification("Chunk {0} of the backup at '{1}' doesn't match it's manifest (sha256 {2} and {3} bytes instead of {4} and {5})".format(
+                    name, self.location, hasher.hexdigest(), hasher.size, digest["sha256"], digest["size"]
+                    ))
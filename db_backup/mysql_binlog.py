@@ -0,0 +1,170 @@
+"""
+Dump a mysql database along with where the binlog was when it was dumped,
+and later dump only the binlog events since then
+
+MysqlDriver runs this as a script with the same python we're running under
+and the options for the mysql commands go after it's own options::
+
+    python mysql_binlog.py dump --database <name> --state <state> [--since <previous state>] -- <mysql options>
+
+Without a previous state (or if the binlog it starts at has been purged) this writes a mysqldump of the database
+and otherwise it writes the sql mysqlbinlog makes from the events since then, which mysql can replay.
+Either way the state remembers where in the binlog the dump got up to.
+
+mysqlbinlog writes the time of each event in UTC so events_until can stop replaying at a point in time.
+"""
+import subprocess
+import optparse
+import datetime
+import shutil
+import json
+import re
+import sys
+import os
+
+# mysqldump --master-data=2 writes where the binlog was as a comment near the start of the dump
+COORDINATES = re.compile(r"(?:MASTER|SOURCE)_LOG_FILE='([^']+)', *(?:MASTER|SOURCE)_LOG_POS=(\d+)")
+
+# How far into the dump we look for those coordinates
+HEAD_LINES = 100
+
+# mysqlbinlog writes the time of each event like "#260918 14:05:01 server id 1  end_log_pos 234 ..."
+EVENT_TIME = re.compile(r"^#(\d{6}) +(\d{1,2}):(\d\d):(\d\d) +server id")
+
+# How much we copy at a time
+CHUNK_SIZE = 65536
+
+def dump_full(database, options, out):
+    """Write a mysqldump of the database to out and return where the binlog was when it was dumped"""
+    command = ["mysqldump"] + options + ["--single-transaction", "--master-data=2", database]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        coordinates = None
+        for _ in range(HEAD_LINES):
+            line = process.stdout.readline()
+            out.write(line)
+            match = COORDINATES.search(line)
+            if match or not line:
+                coordinates = match
+                break
+
+        if coordinates is None:
+            raise ValueError("mysqldump didn't say where the binlog was, is binary logging turned on?")
+
+        shutil.copyfileobj(process.stdout, out, CHUNK_SIZE)
+        out.flush()
+    except:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        raise
+
+    code = process.wait()
+    if code != 0:
+        raise ValueError("mysqldump failed with exit code {0}".format(code))
+    return {"kind": "full", "file": coordinates.group(1), "position": int(coordinates.group(2))}
+
+def query(options, sql):
+    """Return the rows from running sql with the mysql command"""
+    process = subprocess.Popen(["mysql"] + options + ["--batch", "--skip-column-names", "-e", sql], stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise ValueError("mysql failed to run {0} with exit code {1}".format(sql, process.returncode))
+    return [line.split("\t") for line in output.splitlines() if line]
+
+def dump_binlog(database, options, previous, out):
+    """
+    Write the sql for the binlog events since the previous state to out and return where we got up to
+
+    Return None without writing anything if the binlog the previous state starts at has been purged
+    """
+    status = query(options, "SHOW MASTER STATUS")
+    if not status:
+        raise ValueError("mysql didn't say where the binlog is, is binary logging turned on?")
+    end_file, end_position = status[0][0], int(status[0][1])
+
+    logs = [row[0] for row in query(options, "SHOW BINARY LOGS")]
+    if previous["file"] not in logs or end_file not in logs:
+        return None
+
+    # The start position is for the first file and the stop position is for the last one
+    command = ["mysqlbinlog"] + options + [
+          "--read-from-remote-server", "--database", database
+        , "--start-position", str(previous["position"]), "--stop-position", str(end_position)
+        ] + logs[logs.index(previous["file"]):logs.index(end_file) + 1]
+
+    out.flush()
+    code = subprocess.call(command, stdout=out, env=dict(os.environ, TZ="UTC"))
+    if code != 0:
+        raise ValueError("mysqlbinlog failed with exit code {0}".format(code))
+    return {"kind": "incremental", "file": end_file, "position": end_position}
+
+def dump(database, options, out, state, since=None):
+    """Dump the database or the binlog since the backup with the since state file to out and write the new state"""
+    result = None
+    if since and os.path.exists(since):
+        with open(since) as fle:
+            result = dump_binlog(database, options, json.loads(fle.readline()), out)
+
+    if result is None:
+        result = dump_full(database, options, out)
+
+    with open(state, "w") as fle:
+        fle.write("{0}\n".format(json.dumps(result)))
+
+def events_until(chunks, stop_at):
+    """
+    Yield the sql mysqlbinlog made from chunks up to the first event after stop_at (a naive datetime in UTC)
+
+    A transaction cut off part way through is rolled back. We keep reading after that
+    so whatever is decrypting the chunks doesn't find it's reader gone
+    """
+    pending = ""
+    for chunk in chunks:
+        pending += chunk.tobytes() if hasattr(chunk, "tobytes") else chunk
+        lines = pending.split("\n")
+        pending = lines.pop()
+
+        kept = []
+        for line in lines:
+            match = EVENT_TIME.match(line)
+            if match:
+                when = datetime.datetime.strptime("{0} {1}:{2}:{3}".format(*match.groups()), "%y%m%d %H:%M:%S")
+                if when > stop_at:
+                    kept.append("DELIMITER ;\nROLLBACK;\n")
+                    yield "\n".join(kept)
+                    for _ in chunks:
+                        pass
+                    return
+            kept.append(line)
+
+        if kept:
+            yield "{0}\n".format("\n".join(kept))
+
+    if pending:
+        yield pending
+
+def main(argv=None):
+    """Dump the database or it's binlog from the command line and return an exit code"""
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage="%prog dump --database <name> --state <state> [--since <previous state>] -- <mysql options>")
+    parser.add_option("--database", help="The database to dump")
+    parser.add_option("--state", help="Where to remember where in the binlog we got up to")
+    parser.add_option("--since", help="The state of the backup to dump the binlog since")
+    options, args = parser.parse_args(argv)
+
+    if not args or args[0] != "dump" or not options.database or not options.state:
+        parser.print_usage(sys.stderr)
+        return 2
+
+    try:
+        dump(options.database, args[1:], sys.stdout, options.state, options.since)
+    except (IOError, OSError, ValueError) as error:
+        sys.stderr.write("{0}\n".format(error))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,42 @@
 from contextlib import contextmanager
+import collections
 import subprocess
+import threading
 import logging
+import Queue
+import select
 import signal
 import shlex
+import pipes
 import fcntl
+import errno
 import time
+import sys
+import io
 import os
 
-from db_backup.errors import NoCommand, FailedToRun
+from db_backup.errors import NoCommand, FailedToRun, TimedOut, FailedBackup
 
 log = logging.getLogger("db_backup")
 
+# How much we read from a process at a time
+CHUNK_SIZE = 65536
+
+# The most memory a stage will hold in chunks it has read
+MAX_STAGE_MEMORY = CHUNK_SIZE * 4
+
+# How long a process can go without making progress before we kill it
+DEFAULT_IDLE_TIMEOUT = 300
+
+# How often we check on processes that don't send their data through us
+SUPERVISE_INTERVAL = 1
+
+# How far behind the others one branch of a Fanout can get before they all wait for it
+FANOUT_BUFFER_SIZE = CHUNK_SIZE * 256
+
+# Absolute paths for the commands we've found, keyed by (command, PATH)
+resolved_commands = {}
+
 def until(timeout, step=0.1):
     """Keep yielding until timeout"""
     start = time.time()
@@ -25,13 +51,363 @@ def make_non_blocking(stream):
     fl = fcntl.fcntl(fd, fcntl.F_GETFL)
     fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
-def start_process(command, env=None, capture_stdin=False, stdin=None):
+def make_blocking(stream):
+    """Make a stream blocking again"""
+    fd = stream.fileno()
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl & ~os.O_NONBLOCK)
+
+def read_stream(stream, size=CHUNK_SIZE):
+    """
+    Read up to size bytes from a stream
+
+    Returns an empty string if the stream is closed and None if it has nothing for us yet
+    """
+    try:
+        return os.read(stream.fileno(), size)
+    except OSError as error:
+        if error.errno in (errno.EAGAIN, errno.EINTR):
+            return None
+        raise
+
+class ChunkPool(object):
+    """
+    A ring of preallocated buffers that chunks are read into
+
+    There are as many chunk_size buffers as fit into max_memory, which is the most we'll ever hold.
+    A view of a buffer stays valid until the ring comes back around to that buffer,
+    so consumers must be done with a chunk before they have asked for that many more.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, max_memory=MAX_STAGE_MEMORY):
+        if chunk_size <= 0 or max_memory < chunk_size:
+            raise ValueError("Need a positive chunk_size no bigger than max_memory (got {0} and {1})".format(chunk_size, max_memory))
+
+        self.index = 0
+        self.chunk_size = chunk_size
+        self.views = [memoryview(bytearray(chunk_size)) for _ in range(max_memory // chunk_size)]
+
+    def current(self):
+        """Return a view of the buffer that should be filled next"""
+        return self.views[self.index]
+
+    def advance(self):
+        """Move onto the next buffer now that the current one holds a chunk"""
+        self.index = (self.index + 1) % len(self.views)
+
+class ChunkReader(object):
+    """
+    Read chunks from a stream into the buffers of a ChunkPool without allocating new strings
+
+    read returns a view of the chunk that is only valid until the pool reuses it's buffer
+    """
+    def __init__(self, stream, pool=None):
+        self.stream = stream
+        self.pool = pool or ChunkPool()
+        self.raw = io.FileIO(stream.fileno(), closefd=False)
+
+    def read(self):
+        """
+        Read the next chunk
+
+        Returns an empty view if the stream is closed and None if it has nothing for us yet
+        """
+        view = self.pool.current()
+        try:
+            amount = self.raw.readinto(view)
+        except (IOError, OSError) as error:
+            if error.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+
+        if amount is None:
+            return None
+
+        if amount:
+            self.pool.advance()
+        return view[:amount]
+
+def regroup(chunks, size):
+    """Yield strings of size bytes made from the chunks we're given (the last one may be smaller)"""
+    pending = bytearray()
+    for chunk in chunks:
+        pending.extend(chunk)
+        while len(pending) >= size:
+            yield str(pending[:size])
+            del pending[:size]
+
+    if pending:
+        yield str(pending)
+
+class Reactor(object):
+    """
+    Wait on the pipes of our processes and only wake up when one of them is ready
+
+    Streams are registered as readers or writers and wait returns (readable, writable)
+    Uses poll where the platform has it and falls back to select otherwise
+    """
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+
+    def add_reader(self, stream):
+        """Wake up when this stream has something to read or is closed"""
+        self.readers[stream.fileno()] = stream
+
+    def add_writer(self, stream):
+        """Wake up when this stream can take more data"""
+        self.writers[stream.fileno()] = stream
+
+    def remove(self, stream):
+        """Stop watching this stream"""
+        for streams in (self.readers, self.writers):
+            for fd, watched in list(streams.items()):
+                if watched is stream:
+                    del streams[fd]
+
+    def wait(self, timeout=None):
+        """
+        Block until one of our streams is ready or timeout seconds has passed
+        Return (readable, writable) lists of the streams that are ready
+        """
+        if not self.readers and not self.writers:
+            return [], []
+
+        try:
+            if hasattr(select, "poll"):
+                return self.wait_with_poll(timeout)
+            else:
+                return self.wait_with_select(timeout)
+        except (select.error, IOError, OSError) as error:
+            if error.args[0] == errno.EINTR:
+                return [], []
+            raise
+
+    def wait_with_poll(self, timeout):
+        """Use poll to wait for our streams"""
+        poller = select.poll()
+        for fd in self.readers:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        for fd in self.writers:
+            if fd in self.readers:
+                poller.modify(fd, select.POLLIN | select.POLLPRI | select.POLLOUT)
+            else:
+                poller.register(fd, select.POLLOUT)
+
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+
+        readable, writable = [], []
+        for fd, event in poller.poll(timeout):
+            # Hangups and errors count as readable so the read can tell us it's closed
+            if fd in self.readers and event & (select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR):
+                readable.append(self.readers[fd])
+            if fd in self.writers and event & (select.POLLOUT | select.POLLHUP | select.POLLERR):
+                writable.append(self.writers[fd])
+        return readable, writable
+
+    def wait_with_select(self, timeout):
+        """Use select to wait for our streams"""
+        readable, writable, _ = select.select(list(self.readers), list(self.writers), [], timeout)
+        return [self.readers[fd] for fd in readable], [self.writers[fd] for fd in writable]
+
+class Watchdog(object):
+    """
+    Keep track of the progress a process is making
+
+    idle_timeout is how many seconds it may go without reading or writing anything
+    total_timeout is how many seconds it may run for altogether
+    Either may be None to not enforce that deadline
+    """
+    def __init__(self, desc, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None):
+        self.desc = desc
+        self.idle_timeout = idle_timeout
+        self.total_timeout = total_timeout
+
+        self.observed = 0
+        self.progressed = 0
+        self.started = time.time()
+        self.last_progress = self.started
+
+    def progress(self, amount):
+        """Record that the process moved some bytes"""
+        self.progressed += amount
+        self.last_progress = time.time()
+
+    def observe(self, counter):
+        """
+        Record progress from a counter of how many bytes the process has moved in total
+
+        A counter of None means we can't tell, so only the total_timeout applies.
+        The counter goes down when a process it counts finishes, which is progress too.
+        """
+        if counter is None:
+            self.rest()
+        elif counter > self.observed:
+            self.progress(counter - self.observed)
+        elif counter < self.observed:
+            self.rest()
+
+        if counter is not None:
+            self.observed = counter
+
+    def rest(self):
+        """Start the idle clock again because we've been busy rather than the process"""
+        self.last_progress = time.time()
+
+    def remaining(self):
+        """Return how many seconds until the nearest deadline, or None if there isn't one"""
+        now = time.time()
+        deadlines = []
+        if self.idle_timeout is not None:
+            deadlines.append(self.last_progress + self.idle_timeout - now)
+        if self.total_timeout is not None:
+            deadlines.append(self.started + self.total_timeout - now)
+
+        if not deadlines:
+            return None
+        return max(min(deadlines), 0)
+
+    def check(self):
+        """Raise TimedOut if the process has gone past one of it's deadlines"""
+        now = time.time()
+        if self.total_timeout is not None and now - self.started >= self.total_timeout:
+            raise TimedOut("{0} took longer than {1} seconds ({2} bytes)".format(self.desc, self.total_timeout, self.progressed))
+
+        if self.idle_timeout is not None and now - self.last_progress >= self.idle_timeout:
+            raise TimedOut("{0} made no progress for {1} seconds ({2} bytes)".format(self.desc, self.idle_timeout, self.progressed))
+
+class ProcessStats(object):
+    """
+    What a process cost us and how much it did
+
+    wall_time, cpu_time (user + system) and max_rss (bytes) come from wait4 when the process is reaped.
+    bytes_in and bytes_out are what the kernel says the process read and wrote (where /proc is available).
+    blocked_read and blocked_write are how long we spent waiting for it to give us output or take our input,
+    which is only known for processes whose data goes through us.
+    """
+    ATTRS = (
+          "desc", "pid", "returncode", "wall_time", "cpu_time", "max_rss"
+        , "bytes_in", "bytes_out", "blocked_read", "blocked_write", "throughput"
+        )
+
+    def __init__(self, desc=None):
+        self.desc = desc
+        self.pid = None
+        self.ended = None
+        self.returncode = None
+        self.started = time.time()
+
+        self.cpu_time = None
+        self.max_rss = None
+        self.bytes_in = None
+        self.bytes_out = None
+        self.blocked_read = 0
+        self.blocked_write = 0
+
+    @property
+    def wall_time(self):
+        """How long the process ran for (so far)"""
+        return (self.ended or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """Bytes per second through the process, going by whichever of bytes_in and bytes_out is larger"""
+        if self.bytes_in is None and self.bytes_out is None:
+            return None
+        return max(self.bytes_in or 0, self.bytes_out or 0) / max(self.wall_time, 0.001)
+
+    def sample_io(self):
+        """Record what the kernel says the process has read and written so far"""
+        counters = io_counters(self.pid)
+        if counters is not None:
+            self.bytes_in, self.bytes_out = counters
+
+    def reaped(self, returncode, rusage):
+        """Record how the process ended"""
+        self.ended = time.time()
+        self.returncode = returncode
+        self.cpu_time = rusage.ru_utime + rusage.ru_stime
+
+        # Linux says kilobytes and OSX says bytes
+        self.max_rss = rusage.ru_maxrss
+        if sys.platform != "darwin":
+            self.max_rss *= 1024
+
+    def as_dict(self):
+        """Return the stats as a dictionary"""
+        return dict((key, getattr(self, key)) for key in ProcessStats.ATTRS)
+
+    def __repr__(self):
+        return "<ProcessStats {0}>".format(self.as_dict())
+
+class Process(subprocess.Popen):
+    """
+    A Popen that reaps itself with wait4 so we know what the process cost us
+
+    The ProcessStats for the process are available as process.stats
+    """
+    def __init__(self, *args, **kwargs):
+        self.stats = ProcessStats()
+        super(Process, self).__init__(*args, **kwargs)
+        self.stats.pid = self.pid
+
+    def poll(self):
+        """Return the returncode, or None if the process is still running"""
+        if self.returncode is None:
+            self.reap(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        """Wait for the process to finish and return the returncode"""
+        while self.returncode is None:
+            self.reap(0)
+        return self.returncode
+
+    def reap(self, flags):
+        """Use wait4 to see if the process is done and record what it cost us if it is"""
+        # /proc still has the io counters for a process until it's been reaped
+        self.stats.sample_io()
+        try:
+            pid, status, rusage = os.wait4(self.pid, flags)
+        except OSError as error:
+            if error.errno == errno.EINTR:
+                return
+            if error.errno != errno.ECHILD:
+                raise
+            # Something else reaped it, so all we can do is what Popen does
+            self.returncode = 0
+            return
+
+        if pid == self.pid:
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+            self.stats.reaped(self.returncode, rusage)
+
+def start_process(command, env=None, capture_stdin=False, stdin=None, source=None):
+    """
+    Start a process with it's stdout and stderr as non blocking pipes
+
+    If source is specified then it is a stream (i.e. the stdout of another process)
+    that is given to the process as it's stdin so that data goes straight from one to the other
+    """
     stdin_flag = subprocess.PIPE if capture_stdin or stdin else None
+    if source is not None:
+        # The other end needs to be able to block while it waits for data
+        make_blocking(source)
+        stdin_flag = source
 
     environment = os.environ.copy()
     if env:
         environment.update(env)
-    process = subprocess.Popen(shlex.split(command), stdin=stdin_flag, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+
+    # Close other fds so children don't keep each other's pipes open
+    # and let them die from SIGPIPE like they would in a shell rather than inherit python ignoring it
+    process = Process(shlex.split(command), stdin=stdin_flag, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment
+        , close_fds=True, preexec_fn=restore_sigpipe
+        )
+    process.stats.desc = command
 
     if stdin:
         process.stdin.write(stdin)
@@ -40,67 +416,402 @@ def start_process(command, env=None, capture_stdin=False, stdin=None):
     make_non_blocking(process.stderr)
     return process
 
+def restore_sigpipe():
+    """Give SIGPIPE back it's default behaviour"""
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
 def check_and_start_process(command, options, desc, **start_args):
     """Check for a command before we start a process with that command and some options"""
     # Make sure the command itself exists
-    check_for_command(command, desc)
+    location = check_for_command(command, desc)
 
     # We can assume the command exists, let's do this!
     log.info("Running \"%s %s\"", command, options)
-    return start_process("{0} {1}".format(command, options), **start_args)
+    process = start_process("{0} {1}".format(pipes.quote(location), options), **start_args)
+    process.stats.desc = desc
+    return process
 
-def feed_process(process, desc, food):
-    """Feed the stdin of a process"""
-    with ensure_killed(process, desc):
-        for bite in food:
-            print_process(process, desc)
-            if process.poll() is not None:
-                break
+def feed_process(process, desc, food, watchdog=None, queue_size=2, metrics=None):
+    """
+    Feed the stdin of a process
+
+    The food is pulled in a Producer thread and handed over through a queue of queue_size bites,
+    so whatever makes the food and this process get to work at the same time.
+    A Drainer thread logs output from the process so it can't block on a full pipe
+    and we only write when the stdin is writable.
+
+    If the food is views into reusable buffers then those buffers must outlive queue_size + 2 bites.
+
+    The process is killed if it stops making progress according to the watchdog
+    and metrics is called with it's ProcessStats when it's done
+    """
+    if watchdog is None:
+        watchdog = Watchdog(desc)
+
+    with ensure_killed(process, desc, metrics):
+        make_non_blocking(process.stdin)
+
+        reactor = Reactor()
+        reactor.add_writer(process.stdin)
+
+        drainer = Drainer(process, desc, watchdog)
+        drainer.start()
 
-            process.stdin.write(bite)
+        producer = Producer(food, queue_size)
+        producer.start()
+        try:
+            for bite in producer:
+                # Time spent waiting for food isn't the fault of this process
+                watchdog.rest()
+                if not write_all(reactor, process, bite, watchdog):
+                    break
+        finally:
+            producer.stop()
 
         # Finish feeding, close it's mouth
-        process.stdin.close()
-        wait_for(process, desc, timeout=10)
-        print_process(process, desc)
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            # It already stopped listening
+            pass
 
-def read_process(process):
-    """Get any stdout and stderr from the process"""
-    try:
-        next_chunk = process.stdout.read()
-    except IOError:
-        next_chunk = ""
+        drainer.finish()
+        wait_for(process, desc, timeout=watchdog.remaining())
 
-    try:
-        next_error = process.stderr.read()
-    except IOError:
-        next_error = ""
+class Producer(threading.Thread):
+    """
+    Pull items from an iterator in a thread and hand them over through a bounded queue
+
+    Iterating over the producer yields those items and raises whatever the iterator raised.
+    The iterator waits whenever queue_size items are waiting for us.
+    """
+    def __init__(self, iterator, queue_size=2):
+        super(Producer, self).__init__()
+        self.daemon = True
+        self.iterator = iterator
+        self.stopped = threading.Event()
+        self.queue = Queue.Queue(maxsize=queue_size)
+
+    def __iter__(self):
+        while True:
+            kind, item = self.queue.get()
+            if kind is StopIteration:
+                break
+            elif kind is Exception:
+                raise item[0], item[1], item[2]
+            yield item
+
+    def run(self):
+        try:
+            try:
+                for item in self.iterator:
+                    self.queue.put((None, item))
+                    if self.stopped.is_set():
+                        return
+            except Exception:
+                self.queue.put((Exception, sys.exc_info()))
+            else:
+                self.queue.put((StopIteration, None))
+        finally:
+            if hasattr(self.iterator, "close"):
+                self.iterator.close()
+
+    def stop(self):
+        """Tell the thread to stop and empty the queue so it isn't stuck waiting for us"""
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+class Drainer(threading.Thread):
+    """Log stdout and stderr from a process in a thread until it closes them, counting it as progress"""
+    def __init__(self, process, desc, watchdog):
+        super(Drainer, self).__init__()
+        self.desc = desc
+        self.daemon = True
+        self.process = process
+        self.watchdog = watchdog
+
+    def run(self):
+        reactor = Reactor()
+        for stream in (self.process.stdout, self.process.stderr):
+            if stream:
+                reactor.add_reader(stream)
+
+        while reactor.readers:
+            readable, _ = reactor.wait()
+            log_readable(reactor, self.process, self.desc, readable, self.watchdog)
+
+    def finish(self):
+        """Wait for the process to close it's pipes, complaining if it stops making progress"""
+        while self.is_alive():
+            self.join(self.watchdog.remaining())
+            self.watchdog.check()
+
+def write_all(reactor, process, bite, watchdog):
+    """
+    Write all of bite to the stdin of the process when it's writable
+
+    Return False if the process stopped listening before we could finish
+    """
+    view = memoryview(bite)
+    stats = process.stats
+    fd = process.stdin.fileno()
+    while len(view):
+        # A process that's gone away makes it's stdin writable so we find out from the write
+        waiting = time.time()
+        _, writable = reactor.wait(watchdog.remaining())
+        stats.blocked_write += time.time() - waiting
+
+        if writable:
+            try:
+                written = os.write(fd, view)
+            except OSError as error:
+                if error.errno == errno.EAGAIN:
+                    continue
+                if error.errno == errno.EPIPE:
+                    return False
+                raise
+            view = view[written:]
+            watchdog.progress(written)
+
+        watchdog.check()
+    return True
+
+def log_readable(reactor, process, desc, readable, watchdog):
+    """Log output from the streams that are readable and stop watching any that are finished"""
+    for stream in readable:
+        data = read_stream(stream)
+        if data is None:
+            continue
+        elif not data:
+            reactor.remove(stream)
+        else:
+            watchdog.progress(len(data))
+            if stream is process.stdout:
+                log_output(desc, data, "")
+            else:
+                log_output(desc, "", data)
+
+def read_process(process, timeout=0):
+    """
+    Get any stdout and stderr from the process
+
+    Only waits up to timeout for something to be ready and returns empty strings if there is nothing
+    """
+    next_chunk, next_error = "", ""
+
+    reactor = Reactor()
+    for stream in (process.stdout, process.stderr):
+        if stream and not stream.closed:
+            reactor.add_reader(stream)
+
+    if reactor.readers:
+        readable, _ = reactor.wait(timeout)
+        for stream in readable:
+            data = read_stream(stream) or ""
+            if stream is process.stdout:
+                next_chunk = data
+            else:
+                next_error = data
 
     return next_chunk, next_error
 
+def log_output(desc, next_chunk, next_error):
+    """Log some stdout and stderr from a process"""
+    next_chunk = next_chunk.strip()
+    next_error = next_error.strip()
+
+    if next_chunk:
+        for line in next_chunk.split('\n'):
+            log.info("{0} [STDOUT] {1}".format(desc, line))
+
+    if next_error:
+        for line in next_error.split('\n'):
+            log.info("{0} [STDERR] {1}".format(desc, line))
+
 def print_process(process, desc):
-    """Print stdout and stderr from a process"""
-    for _ in until(timeout=5):
+    """Print whatever stdout and stderr the process has ready without waiting for more"""
+    while True:
         next_chunk, next_error = read_process(process)
-        next_chunk = next_chunk.strip()
-        next_error = next_error.strip()
-        if not next_error and not next_chunk:
+        if not next_chunk and not next_error:
             break
+        log_output(desc, next_chunk, next_error)
 
-        if next_chunk:
-            for line in next_chunk.split('\n'):
-                log.info("{0} [STDOUT] {1}".format(desc, line))
+def check_for_command(command, desc):
+    """Return the absolute path to the command or raise NoCommand if it doesn't exist"""
+    location = resolve_command(command)
+    if location is None:
+        raise NoCommand("It seems you need to install {0} for {1}".format(command, desc))
+    return location
 
-        if next_error:
-            for line in next_error.split('\n'):
-                log.info("{0} [STDERR] {1}".format(desc, line))
+def resolve_command(command):
+    """
+    Find the absolute path to a command on our PATH, or None if it isn't there
+
+    Commands we find are remembered for the life of the process so we only look for them once
+    """
+    path = os.environ.get("PATH", os.defpath)
+    key = (command, path)
+    if key not in resolved_commands:
+        location = find_command(command, path)
+        if location is None:
+            # Don't remember missing commands in case they get installed
+            return None
+        resolved_commands[key] = location
+    return resolved_commands[key]
+
+def find_command(command, path):
+    """Look for an executable command in the directories of the path"""
+    if os.path.dirname(command):
+        candidates = [command]
+    else:
+        candidates = [os.path.join(directory, command) for directory in path.split(os.pathsep) if directory]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.abspath(candidate)
+
+def run_concurrently(*functions):
+    """
+    Call all the functions at the same time in threads and return a list of what they returned
+
+    If any of them raised an exception, the first one (in the order we were given them) is raised
+    """
+    results = [None] * len(functions)
+    errors = [None] * len(functions)
+
+    def run(index, function):
+        try:
+            results[index] = function()
+        except Exception:
+            errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=run, args=(index, function)) for index, function in enumerate(functions)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+def map_in_order(function, items, workers):
+    """
+    Yield function(item) for each item, calling it for up to workers items at a time in threads
+
+    Results come out in the same order as the items and we only take up to 2 * workers items
+    more than we've yielded, so slow consumers hold back how many items we pull.
+    If function raises for an item, that is raised here when we get to that item
+    """
+    tasks = Queue.Queue()
+    pending = collections.deque()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            item, outcome, done = task
+            try:
+                outcome.append((None, function(item)))
+            except Exception:
+                outcome.append((sys.exc_info(), None))
+            done.set()
+
+    def result(outcome, done):
+        done.wait()
+        error, value = outcome[0]
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return value
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
-def check_for_command(command, desc):
-    """Raise NoCommand if the specified command doesn't exist"""
     try:
-        subprocess.check_call(["which", command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError:
-        raise NoCommand("It seems you need to install {0} for {1}".format(command, desc))
+        for item in items:
+            outcome, done = [], threading.Event()
+            tasks.put((item, outcome, done))
+            pending.append((outcome, done))
+            if len(pending) >= workers * 2:
+                yield result(*pending.popleft())
+
+        while pending:
+            yield result(*pending.popleft())
+    finally:
+        # Forget what hasn't started and let the threads go once they finish what they're doing
+        while True:
+            try:
+                tasks.get_nowait()
+            except Queue.Empty:
+                break
+        for _ in threads:
+            tasks.put(None)
+
+def communicate(command, options, desc, data, env=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """
+    Give data to a process running specified command and return everything it writes to stdout
+    Anything from stderr is logged
+
+    The process is killed if it goes idle_timeout seconds without progress and we raise FailedToRun if it fails
+    """
+    process = check_and_start_process(command, options, desc, capture_stdin=True, env=env)
+    watchdog = Watchdog(desc, idle_timeout=idle_timeout)
+
+    output = bytearray()
+    view = memoryview(data)
+    with ensure_killed(process, desc):
+        make_non_blocking(process.stdin)
+
+        reactor = Reactor()
+        reactor.add_reader(process.stdout)
+        reactor.add_reader(process.stderr)
+        reactor.add_writer(process.stdin)
+
+        while reactor.readers:
+            readable, writable = reactor.wait(watchdog.remaining())
+
+            if writable:
+                try:
+                    written = os.write(process.stdin.fileno(), view[:CHUNK_SIZE])
+                    view = view[written:]
+                    watchdog.progress(written)
+                except OSError as error:
+                    if error.errno not in (errno.EAGAIN, errno.EINTR, errno.EPIPE):
+                        raise
+                    if error.errno == errno.EPIPE:
+                        # It stopped listening, it's exit code will tell us if that's a problem
+                        view = view[len(view):]
+
+                if not len(view):
+                    reactor.remove(process.stdin)
+                    process.stdin.close()
+
+            for stream in readable:
+                data = read_stream(stream)
+                if data is None:
+                    continue
+                elif not data:
+                    reactor.remove(stream)
+                elif stream is process.stdout:
+                    output.extend(data)
+                    watchdog.progress(len(data))
+                else:
+                    log_output(desc, "", data)
+
+            watchdog.check()
+
+        wait_for(process, desc, timeout=watchdog.remaining())
+    return str(output)
 
 def wait_for(process, desc, timeout=10, silent=False):
     """
@@ -108,7 +819,13 @@ def wait_for(process, desc, timeout=10, silent=False):
     Break early if it finishes
     Just log if it doesn't within the timeout
     It's up to the caller to see if it actually finished
+
+    A timeout of None means wait for as long as it takes
     """
+    if timeout is None:
+        process.wait()
+        return
+
     # And wait for it to finish
     for _ in until(timeout):
         if process.poll() is not None:
@@ -118,13 +835,301 @@ def wait_for(process, desc, timeout=10, silent=False):
         log.error("Timed out waiting for the process to finish (%s)", desc)
 
 @contextmanager
-def ensure_killed(process, desc):
-    """Make sure the process gets killed"""
+def ensure_killed(process, desc, metrics=None):
+    """
+    Make sure the process gets killed, even if something goes wrong while we deal with it
+
+    metrics is called with the ProcessStats of the process once it's dead
+    """
     try:
         yield
     except KeyboardInterrupt:
         log.error("Force stopping the process")
+    finally:
+        kill_process(process, desc)
+        report(process, metrics)
+
+    if process.poll() != 0:
+        raise FailedToRun("{0} failed".format(desc), exit_code=process.returncode)
+
+@contextmanager
+def ensure_all_killed(stages, metrics=None):
+    """
+    Make sure all of the processes in stages (a list of (process, desc)) get killed
+    and complain about the first one that failed
+
+    metrics is called with the ProcessStats of each process once they are all dead
+
+    Processes that died because something after them stopped reading (SIGPIPE) are blamed last
+    and otherwise we blame processes that ended by themselves before those we killed
+    """
+    ended = []
+    try:
+        yield
+    except KeyboardInterrupt:
+        log.error("Force stopping the processes")
+    finally:
+        ended.extend(process for process, _ in stages if process.poll() is not None)
+        for process, desc in stages:
+            kill_process(process, desc)
+        for process, _ in stages:
+            report(process, metrics)
+
+    def blame(stage):
+        process, _ = stage
+        return (process.returncode == -signal.SIGPIPE, process not in ended)
+
+    for process, desc in sorted(stages, key=blame):
+        if process.poll() != 0:
+            raise FailedToRun("{0} failed".format(desc), exit_code=process.returncode)
+
+def report(process, metrics):
+    """Give the stats for a finished process to the metrics callback if there is one"""
+    stats = getattr(process, "stats", None)
+    if metrics is not None and stats is not None:
+        metrics(stats)
+
+def io_counters(pid):
+    """Return (bytes read, bytes written) for a process according to /proc or None if we can't tell"""
+    try:
+        with open("/proc/{0}/io".format(pid)) as fle:
+            counters = dict(line.split(":", 1) for line in fle if ":" in line)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def process_parents():
+    """Return {parent: [pid, ...]} for everything that is running according to /proc"""
+    parents = collections.defaultdict(list)
+    try:
+        pids = [name for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return parents
+
+    for name in pids:
+        try:
+            with open("/proc/{0}/stat".format(name)) as fle:
+                # The command name is in brackets and can have spaces in it, the parent comes after it
+                parent = int(fle.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        parents[parent].append(int(name))
+    return parents
+
+def child_pids(pid, parents=None):
+    """
+    Return the pids of everything pid started (and everything they started) that is still running
+
+    parents is from process_parents, which reads every process in /proc, so we only do that if we aren't given it
+    """
+    if parents is None:
+        parents = process_parents()
+
+    found = []
+    pending = [pid]
+    while pending:
+        children = parents.get(pending.pop(), [])
+        found.extend(children)
+        pending.extend(children)
+    return found
+
+def io_counter(process, parents=None):
+    """
+    Return how many bytes the process has read and written according to /proc or None if we can't tell
+
+    This includes what the processes it started are doing, so a shell that runs other commands isn't idle
+    (parents is as for child_pids)
+    """
+    counters = io_counters(process.pid)
+    if counters is None:
+        return None
+
+    total = sum(counters)
+    for pid in child_pids(process.pid, parents):
+        counters = io_counters(pid)
+        if counters is not None:
+            total += sum(counters)
+    return total
+
+class Supervisor(object):
+    """
+    Supervise processes that pass data between themselves without going through us
+
+    stages is a list of (process, watchdog) pairs in the order the data flows through them.
+    We log their output, use the bytes they read and write (from /proc where available) as their progress
+    and make sure they are all killed if any of them fail or stop making progress.
+
+    Nothing here blocks so one loop can look after many supervisors (see supervise_all):
+    watch the streams from streams() and call read(stream) when one is readable (stop watching it if that returns False),
+    call tick() at least every SUPERVISE_INTERVAL seconds until finished is True and then call finish().
+    tick can be given what process_parents says so many supervisors share reading /proc.
+    Or call run() to do all of that and wait for it to finish.
+
+    segments is a list of Segments moving data between those processes in threads.
+    We don't watch the streams they read from and they are stopped along with the processes.
 
+    metrics is called with the ProcessStats of each process and segment once they are all done
+    """
+    def __init__(self, stages, metrics=None, segments=()):
+        self.error = None
+        self.stages = stages
+        self.metrics = metrics
+        self.segments = list(segments)
+
+        taken = set(segment.source for segment in self.segments)
+        self.owners = {}
+        for process, watchdog in stages:
+            for stream in (process.stdout, process.stderr):
+                if stream and not stream.closed and stream not in taken:
+                    self.owners[stream] = (process, watchdog)
+
+    def streams(self):
+        """Return the streams that still need watching"""
+        return list(self.owners)
+
+    def read(self, stream):
+        """Log what's available from a readable stream and return whether it's still open"""
+        process, watchdog = self.owners[stream]
+        data = read_stream(stream)
+        if data is None:
+            return True
+        elif not data:
+            del self.owners[stream]
+            return False
+        elif stream is process.stdout:
+            log_output(watchdog.desc, data, "")
+        else:
+            log_output(watchdog.desc, "", data)
+        return True
+
+    def tick(self, parents=None):
+        """
+        Update the watchdogs from the progress the processes have made
+
+        parents is what process_parents said recently, otherwise we ask it ourselves if anything is still running
+        """
+        running = [(process, watchdog) for process, watchdog in self.stages if process.poll() is None]
+        if running and parents is None and self.error is None:
+            parents = process_parents()
+
+        for process, watchdog in running:
+            if self.error is None:
+                watchdog.observe(io_counter(process, parents))
+                try:
+                    watchdog.check()
+                except TimedOut:
+                    self.error = sys.exc_info()
+
+        for segment in self.segments:
+            if self.error is None and segment.error is not None:
+                self.error = segment.error
+            elif self.error is None and segment.is_alive():
+                try:
+                    segment.check()
+                except TimedOut:
+                    self.error = sys.exc_info()
+
+    @property
+    def finished(self):
+        """Whether the processes are all done, or there's no point letting them carry on"""
+        if self.error is not None:
+            return True
+
+        for process, _ in self.stages:
+            if process.poll() not in (None, 0):
+                return True
+
+        for segment in self.segments:
+            if segment.error is not None:
+                return True
+            if segment.is_alive():
+                return False
+
+        return all(process.poll() is not None for process, _ in self.stages)
+
+    def run(self):
+        """Supervise just these processes until they are done, raising if something failed"""
+        error = supervise_all([self])[0]
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def finish(self):
+        """Kill anything that is still running and raise if something failed"""
+        try:
+            with ensure_all_killed([(process, watchdog.desc) for process, watchdog in self.stages], self.metrics):
+                error = self.error
+                for segment in self.segments:
+                    if error is None:
+                        error = segment.error
+
+                if error is not None:
+                    raise error[0], error[1], error[2]
+
+                for process, watchdog in self.stages:
+                    print_process(process, watchdog.desc)
+        finally:
+            # The segments stop once the processes either side of them are gone
+            for segment in self.segments:
+                segment.finish()
+                report(segment, self.metrics)
+
+def supervise(stages, metrics=None):
+    """Supervise processes passing data between themselves (see Supervisor) until they are done"""
+    Supervisor(stages, metrics).run()
+
+def supervise_all(supervisors):
+    """
+    Look after many Supervisors at the same time from the one thread
+
+    Return a list with the exc_info for each supervisor that failed, or None for those that succeeded
+    """
+    reactor = Reactor()
+    owners = {}
+    for supervisor in supervisors:
+        for stream in supervisor.streams():
+            reactor.add_reader(stream)
+            owners[stream] = supervisor
+
+    results = []
+    pending = list(supervisors)
+
+    # Reading every process in /proc is the expensive part of a tick, so all the supervisors
+    # share one reading and we only read it again every SUPERVISE_INTERVAL
+    parents, scanned = None, None
+    try:
+        while pending:
+            if reactor.readers:
+                readable, _ = reactor.wait(SUPERVISE_INTERVAL)
+            else:
+                readable = []
+                time.sleep(0.1)
+
+            for stream in readable:
+                if not owners[stream].read(stream):
+                    reactor.remove(stream)
+
+            if scanned is None or time.time() - scanned >= SUPERVISE_INTERVAL:
+                parents, scanned = process_parents(), time.time()
+
+            for supervisor in list(pending):
+                supervisor.tick(parents)
+                if supervisor.finished:
+                    pending.remove(supervisor)
+                    for stream in supervisor.streams():
+                        reactor.remove(stream)
+    finally:
+        # Make sure everything is cleaned up, even if we were interrupted
+        for supervisor in supervisors:
+            try:
+                supervisor.finish()
+                results.append(None)
+            except FailedBackup:
+                results.append(sys.exc_info())
+
+    return results
+
+def kill_process(process, desc):
+    """Terminate the process if it's still running and sigkill it if that doesn't work"""
     if process.poll() is None:
         # Timedout waiting for the process to finish
         process.terminate()
@@ -134,38 +1139,95 @@ def ensure_killed(process, desc):
         # Ok, force kill it now
         log.error("Seems the process is hanging, sigkilling it now")
         os.kill(process.pid, signal.SIGKILL)
+        wait_for(process, desc, timeout=1, silent=True)
 
-    if process.poll() != 0:
-        raise FailedToRun("{0} failed".format(desc), exit_code=process.returncode)
-
-def non_hanging_process(process, desc, timeout=30):
+def non_hanging_process(process, desc, watchdog=None, pool=None, metrics=None):
     """
     Yield (next_chunk, next_error) pairs from a process
     Make sure if the process hangs that it ends up dying
     If the process fails, we raise a FailedToRun exception
+
+    We only wake up when there is output to read rather than polling for it
+    and the process is killed if it stops making progress according to the watchdog
+
+    next_chunk is a view into a buffer from the pool and is only valid until the pool reuses that buffer
+    and metrics is called with the ProcessStats of the process when it's done
     """
-    with ensure_killed(process, desc):
-        for _ in until(timeout):
-            next_chunk, next_error = read_process(process)
-            yield next_chunk, next_error
+    if watchdog is None:
+        watchdog = Watchdog(desc)
+    reader = ChunkReader(process.stdout, pool)
 
-            # Stop when the process has stopped and there is no more output to read
-            if not next_chunk and not next_error and process.poll() is not None:
-                break
+    with ensure_killed(process, desc, metrics):
+        reactor = Reactor()
+        for stream in (process.stdout, process.stderr):
+            if stream:
+                reactor.add_reader(stream)
+
+        stats = process.stats
+        while reactor.readers:
+            waiting = time.time()
+            readable, _ = reactor.wait(watchdog.remaining())
+            stats.blocked_read += time.time() - waiting
+
+            next_chunk, next_error = "", ""
+            for stream in readable:
+                if stream is process.stdout:
+                    data = reader.read()
+                else:
+                    data = read_stream(stream)
+
+                if data is None:
+                    continue
+                elif not data:
+                    # Stop watching it once it's closed
+                    reactor.remove(stream)
+                elif stream is process.stdout:
+                    next_chunk = data
+                else:
+                    next_error = data
+
+            if next_chunk or next_error:
+                watchdog.progress(len(next_chunk) + len(next_error))
+                yield next_chunk, next_error
+                # Time spent by our consumer isn't the fault of the process
+                watchdog.rest()
+
+            watchdog.check()
+
+        wait_for(process, desc, timeout=watchdog.remaining())
 
-        wait_for(process, desc, timeout=0)
+def stdout_chunks(command, options, desc, **kwargs):
+    """
+    Yield chunks from stdout from a process running specified command as strings
+    Takes the same arguments as stdout_views
+    """
+    for view in stdout_views(command, options, desc, **kwargs):
+        yield view.tobytes()
 
-def stdout_chunks(command, options, desc, interaction=None, env=None, stdin=None):
+def stdout_views(command, options, desc, interaction=None, env=None, stdin=None
+    , idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None, chunk_size=CHUNK_SIZE, max_memory=MAX_STAGE_MEMORY, metrics=None
+    ):
     """
     Yield chunks from stdout from a process running specified command
     Anything from stderr is logged
+
+    Chunks are memoryviews of at most chunk_size bytes from a pool that never holds more than max_memory.
+    Each view is only valid until max_memory / chunk_size more chunks have been read,
+    so copy it if you need it for longer than that.
+
+    The process is killed if it goes idle_timeout seconds without output
+    or runs for longer than total_timeout seconds
+
+    metrics is called with the ProcessStats of the process when it's done
     """
+    pool = ChunkPool(chunk_size, max_memory)
     process = check_and_start_process(command, options, desc, capture_stdin=bool(interaction), env=env, stdin=stdin)
     if interaction:
         process.stdin.write(interaction)
         process.stdin.close()
 
-    for next_chunk, next_error in non_hanging_process(process, desc):
+    watchdog = Watchdog(desc, idle_timeout=idle_timeout, total_timeout=total_timeout)
+    for next_chunk, next_error in non_hanging_process(process, desc, watchdog, pool, metrics):
         if next_error:
             for line in next_error.split('\n'):
                 log.info("STDERR: %s", line)
@@ -173,3 +1235,435 @@ def stdout_chunks(command, options, desc, interaction=None, env=None, stdin=None
         if next_chunk:
             yield next_chunk
 
+def head_of(command, options, desc, size, interaction=None, env=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """
+    Return the first size bytes of stdout from a process running specified command (or all of it if there's less)
+    and kill the process as soon as we have them
+
+    Anything from stderr is logged and we complain with FailedToRun if the process fails before we have enough
+    """
+    process = check_and_start_process(command, options, desc, capture_stdin=bool(interaction), env=env)
+    try:
+        if interaction:
+            process.stdin.write(interaction)
+            process.stdin.close()
+
+        reactor = Reactor()
+        reactor.add_reader(process.stdout)
+        reactor.add_reader(process.stderr)
+        watchdog = Watchdog(desc, idle_timeout=idle_timeout)
+
+        head = bytearray()
+        while reactor.readers and len(head) < size:
+            readable, _ = reactor.wait(watchdog.remaining())
+            for stream in readable:
+                data = read_stream(stream)
+                if data is None:
+                    continue
+                elif not data:
+                    reactor.remove(stream)
+                elif stream is process.stdout:
+                    head.extend(data)
+                    watchdog.progress(len(data))
+                else:
+                    log_output(desc, "", data)
+            watchdog.check()
+
+        if len(head) < size:
+            wait_for(process, desc, timeout=watchdog.remaining())
+            if process.poll() != 0:
+                raise FailedToRun("{0} failed".format(desc), exit_code=process.returncode)
+
+        return str(head[:size])
+    finally:
+        kill_process(process, desc)
+
+class ProcessStage(object):
+    """
+    A Pipeline stage that runs an external command
+
+    It reads whatever the stage before it produces from it's stdin and it's stdout goes to the stage after it.
+    env and stdin are as for start_process and interaction is written to it's stdin before it's closed,
+    which means only the first stage of a pipeline can have an interaction.
+    """
+    def __init__(self, command, options, desc, env=None, stdin=None, interaction=None):
+        self.env = env
+        self.desc = desc
+        self.stdin = stdin
+        self.command = command
+        self.options = options
+        self.interaction = interaction
+
+    def start(self, source=None, capture_stdin=False):
+        """Start the process, reading from source if there is one or from a pipe we write to if capture_stdin"""
+        if self.interaction and (source is not None or capture_stdin):
+            raise ValueError("{0} can't take input from another stage when it has an interaction".format(self.desc))
+        if self.stdin and source is not None:
+            raise ValueError("{0} can't take input straight from another process when it has stdin".format(self.desc))
+
+        process = check_and_start_process(self.command, self.options, self.desc
+            , env=self.env, stdin=self.stdin, source=source, capture_stdin=capture_stdin or bool(self.interaction)
+            )
+
+        if self.interaction:
+            process.stdin.write(self.interaction)
+            process.stdin.close()
+        return process
+
+class PythonStage(object):
+    """
+    A Pipeline stage that transforms data in python
+
+    transform is called with an iterator of chunks from the stage before it and returns an iterator of chunks for the stage after it.
+    The chunks it gets are memoryviews that are only valid until it asks for the next few chunks (see stdout_views)
+    and the first stage of a pipeline gets an empty iterator, so it's free to make up it's own chunks.
+    """
+    def __init__(self, transform, desc):
+        self.desc = desc
+        self.transform = transform
+
+class Segment(threading.Thread):
+    """
+    Run PythonStages one after the other in a thread
+
+    Chunks are read from source (the stdout of the process before us, if there is one)
+    and whatever the last stage yields is written to destination (the stdin of the process after us, if there is one).
+    We block on both, so the pipes either side of us hold back whichever of us and those processes is faster.
+
+    If a stage raises, error is the exc_info and destination is left open so the process after us
+    doesn't mistake what it has for all of it before it is killed.
+    """
+    def __init__(self, stages, source, destination, watchdog, pool=None):
+        super(Segment, self).__init__()
+        self.daemon = True
+        self.error = None
+        self.stages = stages
+        self.source = source
+        self.destination = destination
+
+        self.pool = pool
+        self.blocked = False
+        self.watchdog = watchdog
+
+        self.stats = ProcessStats(watchdog.desc)
+        self.stats.bytes_in = 0
+        self.stats.bytes_out = 0
+
+    def run(self):
+        chunks = self.read()
+        try:
+            for stage in self.stages:
+                chunks = stage.transform(chunks)
+
+            for chunk in chunks:
+                if not self.write(chunk):
+                    break
+        except Exception:
+            self.error = sys.exc_info()
+            self.stats.returncode = 1
+        else:
+            self.stats.returncode = 0
+            self.close(self.destination)
+        finally:
+            self.close(self.source)
+            if hasattr(chunks, "close"):
+                chunks.close()
+            self.stats.ended = time.time()
+
+    def read(self):
+        """Yield chunks from our source until it closes"""
+        if self.source is None:
+            return
+
+        make_blocking(self.source)
+        reader = ChunkReader(self.source, self.pool)
+        while True:
+            view = self.wait_for(reader.read, "blocked_read")
+            if view is None:
+                continue
+            if not len(view):
+                break
+
+            self.stats.bytes_in += len(view)
+            self.watchdog.progress(len(view))
+            yield view
+
+    def write(self, chunk):
+        """Write all of the chunk to our destination and return False if it stopped listening"""
+        view = memoryview(chunk)
+        self.stats.bytes_out += len(view)
+        if self.destination is None:
+            return True
+
+        fd = self.destination.fileno()
+        while len(view):
+            try:
+                written = self.wait_for(lambda: os.write(fd, view), "blocked_write")
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno == errno.EPIPE:
+                    return False
+                raise
+            view = view[written:]
+            self.watchdog.progress(written)
+        return True
+
+    def wait_for(self, action, counter):
+        """Do something that blocks on another process, which doesn't count against our watchdog"""
+        self.blocked = True
+        waiting = time.time()
+        try:
+            return action()
+        finally:
+            setattr(self.stats, counter, getattr(self.stats, counter) + time.time() - waiting)
+            self.blocked = False
+            self.watchdog.rest()
+
+    def check(self):
+        """Raise TimedOut if our stages have stopped making progress"""
+        if self.blocked:
+            self.watchdog.rest()
+        self.watchdog.check()
+
+    def close(self, stream):
+        """Close one of our streams, not caring if the other end has already gone"""
+        if stream is not None:
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+
+    def finish(self):
+        """Wait for the thread now the processes around it are gone and let go of our streams"""
+        self.join(10)
+        if self.is_alive():
+            log.error("Seems %s is hanging, leaving it behind", self.watchdog.desc)
+        self.release()
+
+    def release(self):
+        """Let go of our streams"""
+        self.close(self.source)
+        self.close(self.destination)
+
+class Tee(Segment):
+    """
+    Give everything from source to each of the destinations in a thread
+
+    A destination that can't keep up gets up to buffer_size bytes behind the others
+    before we stop reading from source, which then holds back everything before us until it catches up.
+    Destinations that stop listening are forgotten about and their exit code will say if that's a problem.
+    """
+    def __init__(self, source, destinations, watchdog, buffer_size=FANOUT_BUFFER_SIZE):
+        super(Tee, self).__init__([], source, None, watchdog)
+        self.buffer_size = buffer_size
+        self.destinations = destinations
+
+    def run(self):
+        try:
+            self.tee()
+        except Exception:
+            self.error = sys.exc_info()
+            self.stats.returncode = 1
+        else:
+            self.stats.returncode = 0
+            for destination in self.destinations:
+                self.close(destination)
+        finally:
+            self.close(self.source)
+            self.stats.ended = time.time()
+
+    def tee(self):
+        """Copy from our source to our destinations until the source closes and they have everything"""
+        make_non_blocking(self.source)
+        for destination in self.destinations:
+            make_non_blocking(destination)
+
+        reading = True
+        buffers = dict((destination, collections.deque()) for destination in self.destinations)
+        buffered = dict((destination, 0) for destination in self.destinations)
+
+        while buffers:
+            reactor = Reactor()
+            if reading and max(buffered.values()) < self.buffer_size:
+                reactor.add_reader(self.source)
+            for destination, amount in buffered.items():
+                if amount:
+                    reactor.add_writer(destination)
+
+            readable, writable = self.wait_for(lambda: reactor.wait(SUPERVISE_INTERVAL), "blocked_read")
+
+            if readable:
+                data = read_stream(self.source)
+                if data == "":
+                    reading = False
+                elif data:
+                    self.stats.bytes_in += len(data)
+                    self.watchdog.progress(len(data))
+                    for destination in buffers:
+                        buffers[destination].append(memoryview(data))
+                        buffered[destination] += len(data)
+
+            for destination in writable:
+                pending = buffers[destination]
+                try:
+                    written = os.write(destination.fileno(), pending[0])
+                except OSError as error:
+                    if error.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    if error.errno != errno.EPIPE:
+                        raise
+                    del buffers[destination]
+                    del buffered[destination]
+                    self.close(destination)
+                    continue
+
+                self.stats.bytes_out += written
+                buffered[destination] -= written
+                if written == len(pending[0]):
+                    pending.popleft()
+                else:
+                    pending[0] = pending[0][written:]
+
+            if not reading:
+                # Let destinations that have everything finish without waiting for the others
+                for destination, amount in list(buffered.items()):
+                    if not amount:
+                        del buffers[destination]
+                        del buffered[destination]
+                        self.close(destination)
+
+    def release(self):
+        """Let go of our streams"""
+        self.close(self.source)
+        for destination in self.destinations:
+            self.close(destination)
+
+class Fanout(object):
+    """
+    The last stage of a Pipeline, which gives everything the stage before it produces to each of it's branches
+
+    Each branch is a list of stages that makes a pipeline of it's own from there.
+    A branch that falls behind gets up to buffer_size bytes behind the others before they all have to wait for it (see Tee).
+    """
+    def __init__(self, branches, buffer_size=FANOUT_BUFFER_SIZE, desc="Fanning out"):
+        self.desc = desc
+        self.branches = branches
+        self.buffer_size = buffer_size
+
+class Pipeline(object):
+    """
+    A chain of stages where the output of each stage is the input of the next (i.e. dump, compress, encrypt)
+
+    Each stage is a ProcessStage or a PythonStage and the last one can be a Fanout to more than one chain of stages.
+    Adjacent processes are joined by giving the stdout of one to the next as it's stdin so that data never passes through python.
+    Adjacent python stages run together in a Segment that reads from the process before them and writes to the process after them,
+    so the pipes between stages hold back the faster stages and no stage holds more than max_memory of chunks.
+
+    The output of a pipeline that ends with a process is logged and one that ends with python stages is whatever those stages do with it.
+
+    Each stage is killed if it goes idle_timeout seconds without progress or takes longer than total_timeout seconds.
+    If any stage fails every process is killed and the first failure is raised
+    and metrics is called with the ProcessStats of each process and segment once they are all done.
+    """
+    def __init__(self, stages, idle_timeout=DEFAULT_IDLE_TIMEOUT, total_timeout=None
+        , chunk_size=CHUNK_SIZE, max_memory=MAX_STAGE_MEMORY, metrics=None
+        ):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+
+        self.stages = stages
+        self.metrics = metrics
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+        self.total_timeout = total_timeout
+
+    def run(self):
+        """Run every stage until they are all done, raising if any of them failed"""
+        self.start().run()
+
+    def start(self):
+        """Start every stage and return a Supervisor for the caller to drive (see supervise_all)"""
+        segments = []
+        processes = []
+        try:
+            self.start_stages(self.stages, None, processes, segments)
+        except:
+            exc_info = sys.exc_info()
+            for process, watchdog in processes:
+                kill_process(process, watchdog.desc)
+            for segment in segments:
+                segment.release()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        for segment in segments:
+            segment.start()
+        return Supervisor(processes, metrics=self.metrics, segments=segments)
+
+    def start_stages(self, stages, source, processes, segments):
+        """
+        Start these stages with the first one reading from source (if there is one)
+        and add the (process, watchdog) pairs and Segments we make to processes and segments
+        """
+        pending = []
+        for index, stage in enumerate(stages):
+            if isinstance(stage, PythonStage):
+                pending.append(stage)
+                continue
+
+            if isinstance(stage, Fanout):
+                if index != len(stages) - 1:
+                    raise ValueError("{0} has to be the last stage".format(stage.desc))
+                self.start_fanout(stage, source, pending, processes, segments)
+                return
+
+            if pending:
+                process = stage.start(capture_stdin=True)
+                segments.append(self.segment(pending, source, process.stdin))
+                pending = []
+            else:
+                process = stage.start(source=source)
+                if source is not None:
+                    # Only the new process should be reading from the last one now
+                    source.close()
+
+            source = process.stdout
+            processes.append((process, self.watchdog(stage.desc)))
+
+        if pending:
+            segments.append(self.segment(pending, source, None))
+
+    def start_fanout(self, fanout, source, pending, processes, segments):
+        """Start the branches of a Fanout and a Tee that gives each of them what comes from source"""
+        if pending:
+            # The python stages before us write into a pipe that we read from
+            read, write = self.pipe()
+            segments.append(self.segment(pending, source, write))
+            source = read
+
+        if source is None:
+            raise ValueError("{0} needs a stage before it".format(fanout.desc))
+
+        destinations = []
+        for branch in fanout.branches:
+            read, write = self.pipe()
+            destinations.append(write)
+            self.start_stages(branch, read, processes, segments)
+
+        segments.append(Tee(source, destinations, self.watchdog(fanout.desc), fanout.buffer_size))
+
+    def pipe(self):
+        """Return (read, write) ends of a new pipe"""
+        read, write = os.pipe()
+        return os.fdopen(read, "rb", 0), os.fdopen(write, "wb", 0)
+
+    def segment(self, stages, source, destination):
+        """Make a Segment for some python stages"""
+        desc = ", ".join(stage.desc for stage in stages)
+        pool = ChunkPool(self.chunk_size, self.max_memory)
+        return Segment(stages, source, destination, self.watchdog(desc), pool)
+
+    def watchdog(self, desc):
+        """Make a Watchdog for one of our stages"""
+        return Watchdog(desc, idle_timeout=self.idle_timeout, total_timeout=self.total_timeout)
@@ -0,0 +1,329 @@
+"""
+Dump and restore a sqlite database as the database file itself rather than as sql
+
+SqliteFileDriver runs this as a script with the same python we're running under,
+so it only uses the standard library and doesn't need the sqlite3 command::
+
+    python sqlite_backup.py dump <database>
+        Write a consistent copy of the database file to stdout
+
+    python sqlite_backup.py dump <database> --pages <pages> [--since <previous pages>]
+        Write the pages of the database that changed since the backup with the previous pages file
+        (or all of the database file if there isn't one) and remember the digest of each page in pages,
+        keyed with a secret kept next to pages so the digests don't say what is in the pages
+
+    python sqlite_backup.py restore <database>
+        Replace an empty database with the copy on stdin, or apply the changed pages on stdin to it.
+        Anything on stdin that isn't a database file or pages is run as sql (i.e. from sqlite3's .dump)
+"""
+from contextlib import contextmanager
+import tempfile
+import optparse
+import hashlib
+import sqlite3
+import shutil
+import struct
+import errno
+import hmac
+import json
+import time
+import sys
+import os
+
+# What every sqlite database file starts with
+SQLITE_MAGIC = "SQLite format 3\x00"
+
+# What changed pages start with, followed by a line of json saying how big the database is
+PAGES_MAGIC = "db_backup sqlite pages 1\n"
+
+# Each changed page is written after it's page number and a page number of 0 ends them
+PAGE_NUMBER = struct.Struct(">I")
+
+# How much of the hmac-sha256 of each page we remember to tell if it changed
+DIGEST_SIZE = 16
+
+# The file next to the pages files with the secret their digests are keyed with
+PAGES_KEY = ".db_backup_pages_key"
+
+# How much we copy at a time
+CHUNK_SIZE = 65536
+
+# How long we wait for other connections to the database before giving up
+LOCK_TIMEOUT = 60
+
+def dump(name, out):
+    """
+    Write a consistent copy of the database at name to out
+
+    We read the database file itself rather than making a copy of it first,
+    so nothing else can write to the database until all of it has been written to out
+    """
+    if not os.path.exists(name):
+        raise ValueError("There was no sqlite database at {0}".format(name))
+
+    with frozen(name) as connection:
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+
+        # Closing this file lets go of sqlite's locks, so it stays open until we've read everything
+        with open(name, "rb") as fle:
+            for _, page in read_pages(name, fle, page_size, page_count):
+                out.write(page)
+        out.flush()
+
+@contextmanager
+def frozen(name, timeout=LOCK_TIMEOUT):
+    """
+    Yield a connection to the database at name that stops anything else writing to it
+    so we can read the database file itself
+
+    In WAL mode we also wait for everything already written to get from the WAL into the database file
+    """
+    connection = sqlite3.connect(name, isolation_level=None, timeout=timeout)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        if connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            checkpoint(name, timeout)
+        yield connection
+    finally:
+        connection.close()
+
+def checkpoint(name, timeout=LOCK_TIMEOUT):
+    """Copy everything in the WAL into the database file, waiting for readers of old snapshots to let us"""
+    connection = sqlite3.connect(name, isolation_level=None, timeout=timeout)
+    try:
+        start = time.time()
+        while True:
+            _, in_log, checkpointed = connection.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            if in_log == checkpointed:
+                return
+            if time.time() - start > timeout:
+                raise ValueError("Couldn't get everything from the WAL into {0} within {1} seconds".format(name, timeout))
+            time.sleep(0.1)
+    finally:
+        connection.close()
+
+def dump_pages(name, out, pages, since=None):
+    """
+    Write the pages of the database at name that changed since the backup with the since pages file to out
+    and remember the digest of every page in pages
+
+    The digests are keyed with the secret from pages_key, so anyone who can read pages but not the key
+    can't check guesses about what is in the database against them
+
+    If there is no since, or it's pages are a different size or keyed differently, we write all of the database file instead
+    """
+    if not os.path.exists(name):
+        raise ValueError("There was no sqlite database at {0}".format(name))
+
+    key = pages_key(os.path.dirname(os.path.abspath(pages)))
+    key_id = hmac.new(key, "key id", hashlib.sha256).hexdigest()[:16]
+    keyed = hmac.new(key, digestmod=hashlib.sha256)
+
+    with frozen(name) as connection:
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+
+        previous = None
+        if since and os.path.exists(since):
+            info, previous = read_digests(since)
+            if info["page_size"] != page_size or info.get("key") != key_id:
+                previous = None
+
+        kind = "full" if previous is None else "incremental"
+        if kind == "incremental":
+            out.write(PAGES_MAGIC)
+            out.write("{0}\n".format(json.dumps({"page_size": page_size, "page_count": page_count})))
+
+        digests = []
+        # Closing this file lets go of sqlite's locks, so it stays open until we've read everything
+        with open(name, "rb") as fle:
+            for number, page in read_pages(name, fle, page_size, page_count):
+                hasher = keyed.copy()
+                hasher.update(page)
+                digest = hasher.digest()[:DIGEST_SIZE]
+                digests.append(digest)
+
+                if kind == "full":
+                    out.write(page)
+                elif previous[(number - 1) * DIGEST_SIZE:number * DIGEST_SIZE] != digest:
+                    out.write(PAGE_NUMBER.pack(number))
+                    out.write(page)
+
+        if kind == "incremental":
+            out.write(PAGE_NUMBER.pack(0))
+        out.flush()
+
+    write_digests(pages, {"page_size": page_size, "page_count": page_count, "kind": kind, "key": key_id}, digests)
+
+def pages_key(directory):
+    """
+    Return the secret that the digests of pages files in directory are keyed with, making it if it doesn't exist yet
+
+    Only the user making the backups can read it
+    """
+    location = os.path.join(directory, PAGES_KEY)
+    if not os.path.exists(location):
+        # mkstemp only lets us read the file and the link means another backup making it at the same time doesn't replace it
+        handle, temporary = tempfile.mkstemp(dir=directory, prefix="{0}.".format(PAGES_KEY))
+        try:
+            with os.fdopen(handle, "wb") as fle:
+                fle.write(os.urandom(32).encode("hex"))
+            try:
+                os.link(temporary, location)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        finally:
+            os.remove(temporary)
+
+    with open(location) as fle:
+        return fle.read().strip().decode("hex")
+
+def read_pages(name, fle, page_size, page_count):
+    """Yield (number, page) for each page in the database file fle"""
+    for number in range(1, page_count + 1):
+        page = fle.read(page_size)
+        if len(page) != page_size:
+            raise ValueError("The database at {0} is shorter than sqlite says it is".format(name))
+        yield number, page
+
+def read_digests(location):
+    """Return (info, digests) from a pages file"""
+    with open(location, "rb") as fle:
+        info = json.loads(fle.readline())
+        return info, fle.read()
+
+def write_digests(location, info, digests):
+    """Write a pages file with a line of json about the database and then the digest of each page"""
+    with open(location, "wb") as fle:
+        fle.write("{0}\n".format(json.dumps(info)))
+        for digest in digests:
+            fle.write(digest)
+
+def restore(name, source):
+    """Restore the database at name from source, which is either a database file, changed pages or sql"""
+    head = source.read(len(SQLITE_MAGIC))
+    if head == SQLITE_MAGIC:
+        restore_file(name, head, source)
+    elif head and PAGES_MAGIC.startswith(head):
+        head += source.read(len(PAGES_MAGIC) - len(head))
+        if head != PAGES_MAGIC:
+            raise ValueError("Expected changed pages but got something else")
+        apply_pages(name, source)
+    else:
+        restore_sql(name, head, source)
+
+def apply_pages(name, source):
+    """Write the changed pages from source into the database at name, which must be the backup they were taken after"""
+    info = json.loads(source.readline())
+    page_size, page_count = info["page_size"], info["page_count"]
+
+    with open(name, "r+b") as fle:
+        if fle.read(len(SQLITE_MAGIC)) != SQLITE_MAGIC:
+            raise ValueError("Can only apply changed pages to a database restored from the backup before them")
+
+        while True:
+            number = PAGE_NUMBER.unpack(read_exactly(source, PAGE_NUMBER.size))[0]
+            if number == 0:
+                break
+            fle.seek((number - 1) * page_size)
+            fle.write(read_exactly(source, page_size))
+
+        fle.truncate(page_count * page_size)
+        fle.flush()
+        os.fsync(fle.fileno())
+
+    remove_journals(name)
+    check_integrity(name)
+
+def read_exactly(source, size):
+    """Read size bytes from source and complain if it ends before then"""
+    data = source.read(size)
+    if len(data) != size:
+        raise ValueError("The changed pages ended part way through")
+    return data
+
+def check_integrity(location):
+    """Complain if sqlite doesn't think the database at location is ok"""
+    connection = sqlite3.connect(location)
+    try:
+        result = connection.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        connection.close()
+    if result != "ok":
+        raise ValueError("The restored database failed it's integrity check: {0}".format(result))
+
+def remove_journals(name):
+    """Remove journals that belonged to the database before we replaced it"""
+    for suffix in ("-wal", "-shm", "-journal"):
+        if os.path.exists(name + suffix):
+            os.remove(name + suffix)
+
+def restore_file(name, head, source):
+    """
+    Replace the database at name with the database file from source
+
+    The file is written next to the database and checked before it is moved over the top of it
+    """
+    directory = os.path.dirname(os.path.abspath(name))
+    handle, location = tempfile.mkstemp(dir=directory, prefix=".{0}.".format(os.path.basename(name)))
+    try:
+        with os.fdopen(handle, "wb") as fle:
+            fle.write(head)
+            shutil.copyfileobj(source, fle, CHUNK_SIZE)
+            fle.flush()
+            os.fsync(fle.fileno())
+
+        check_integrity(location)
+        remove_journals(name)
+        os.rename(location, name)
+    finally:
+        if os.path.exists(location):
+            os.remove(location)
+
+def restore_sql(name, head, source):
+    """Run the sql from source against the database at name a statement at a time"""
+    connection = sqlite3.connect(name, isolation_level=None)
+    try:
+        statement = head
+        for line in iter(source.readline, ""):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                connection.executescript(statement)
+                statement = ""
+
+        if statement.strip():
+            raise ValueError("The sql ended part way through a statement: {0}".format(statement.strip()[:100]))
+    finally:
+        connection.close()
+
+def main(argv=None):
+    """Dump or restore the database from the command line and return an exit code"""
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage="%prog dump|restore <database> [--pages <pages> [--since <previous pages>]]")
+    parser.add_option("--pages", help="Dump the pages of the database and remember their digests in this file")
+    parser.add_option("--since", help="Only dump the pages that changed since the backup with this pages file")
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 2 or args[0] not in ("dump", "restore"):
+        parser.print_usage(sys.stderr)
+        return 2
+
+    action, name = args
+    try:
+        if action == "dump" and options.pages:
+            dump_pages(name, sys.stdout, options.pages, options.since)
+        elif action == "dump":
+            dump(name, sys.stdout)
+        else:
+            restore(name, sys.stdin)
+    except (IOError, OSError, ValueError, sqlite3.Error) as error:
+        sys.stderr.write("{0}\n".format(error))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
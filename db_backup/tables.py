@@ -0,0 +1,155 @@
+"""
+Remember where each table is in a sql dump so restore can skip the tables it wasn't asked for
+
+The dump is split into sections at the lines the driver's table_markers match (i.e. the comment mysqldump writes
+before each table) and a section either belongs to a table or is needed whatever we restore (i.e. the SET statements
+at the start). The index is the offset in the dump of the start of each section.
+"""
+from db_backup.processes import PythonStage
+from db_backup.errors import BadBackupFile
+
+import json
+import re
+import os
+
+# How much of the start of a line the markers get to look at
+MARKER_SIZE = 1024
+
+def as_bytes(chunk):
+    """Chunks from a process are memoryviews"""
+    return chunk.tobytes() if hasattr(chunk, "tobytes") else chunk
+
+class TableIndex(object):
+    """
+    Where each table starts in a dump
+
+    markers are regexes for the start of a line that begins a section. The section belongs to the table
+    matched by the first group that matched anything, or to everything if the regex has no groups.
+    """
+    def __init__(self, markers=(), sections=None, size=0):
+        self.size = size
+        self.markers = [re.compile(marker) for marker in markers]
+
+        # Finds the lines that start a section without going through the dump a line at a time in python
+        self.candidates = re.compile("\n(?:{0})".format("|".join("(?:{0})".format(marker) for marker in markers))) if markers else None
+        self.sections = sections if sections is not None else [[None, 0]]
+
+        # The last line of what we've seen so far, which may not be finished yet
+        self.line = ""
+        self.line_offset = 0
+
+    @property
+    def tables(self):
+        """The names of the tables in the dump"""
+        found = []
+        for name, _ in self.sections:
+            if name is not None and name not in found:
+                found.append(name)
+        return found
+
+    def stage(self, desc):
+        """Return a PythonStage that indexes what goes through it"""
+        def index(chunks):
+            for chunk in chunks:
+                self.update(as_bytes(chunk))
+                yield chunk
+            self.finish()
+        return PythonStage(index, desc)
+
+    def update(self, chunk):
+        """Find the sections that start in this chunk of the dump"""
+        first = chunk.find("\n")
+        if first == -1:
+            self.line = (self.line + chunk)[:MARKER_SIZE]
+            self.size += len(chunk)
+            return
+
+        self.mark(self.line + chunk[:min(first, MARKER_SIZE)], 0, self.line_offset)
+
+        # Every line after the first newline, except the last one which may not be finished
+        last = chunk.rfind("\n")
+        if self.candidates is not None:
+            for match in self.candidates.finditer(chunk, first, last):
+                self.mark(chunk, match.start() + 1, self.size + match.start() + 1)
+
+        self.line = chunk[last + 1:last + 1 + MARKER_SIZE]
+        self.line_offset = self.size + last + 1
+        self.size += len(chunk)
+
+    def finish(self):
+        """The last line is finished when the dump is"""
+        self.mark(self.line, 0, self.line_offset)
+        self.line = ""
+
+    def mark(self, text, position, offset):
+        """Start a new section at offset if the line at position in text begins one"""
+        for marker in self.markers:
+            match = marker.match(text, position)
+            if match:
+                names = [name for name in match.groups() if name]
+                name = names[0] if names else None
+                if self.sections[-1][0] != name:
+                    self.sections.append([name, offset])
+                return
+
+    def ranges(self, tables):
+        """Return the (start, end) of each part of the dump that restoring these tables needs"""
+        missing = [table for table in tables if table not in self.tables]
+        if missing:
+            raise BadBackupFile("The backup doesn't have these tables: {0}".format(", ".join(missing)))
+
+        ranges = []
+        ends = [start for _, start in self.sections[1:]] + [self.size]
+        for (name, start), end in zip(self.sections, ends):
+            if start == end or (name is not None and name not in tables):
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return [tuple(found) for found in ranges]
+
+    def write(self, location, encrypt):
+        """Write the index into a .tables file next to the backup at location, encrypted by the encrypt function"""
+        with open(self.path_for(location), "wb") as fle:
+            fle.write(encrypt(json.dumps({"version": 1, "size": self.size, "sections": self.sections})))
+
+    @classmethod
+    def read(kls, location, decrypt):
+        """Return the TableIndex for the backup at location, decrypted by the decrypt function"""
+        path = kls.path_for(location)
+        if not os.path.exists(path):
+            raise BadBackupFile("The backup at '{0}' has no table index".format(location))
+
+        with open(path, "rb") as fle:
+            info = json.loads(decrypt(fle.read()))
+        return kls(sections=info["sections"], size=info["size"])
+
+    @classmethod
+    def path_for(kls, location):
+        """Where the table index for the backup at location lives"""
+        return "{0}.tables".format(location)
+
+def with_offsets(chunks):
+    """Yield (offset, chunk) for each chunk of a stream"""
+    offset = 0
+    for chunk in chunks:
+        yield offset, chunk
+        offset += len(chunk)
+
+def keep_ranges(pieces, ranges):
+    """
+    Yield the parts of the (offset, chunk) pieces that are in the sorted (start, end) ranges
+
+    We keep reading after the last range so whatever is writing the pieces doesn't find it's reader gone
+    """
+    ranges = list(ranges)
+    for offset, chunk in pieces:
+        end = offset + len(chunk)
+        while ranges and ranges[0][1] <= offset:
+            ranges.pop(0)
+
+        for start, stop in ranges:
+            if start >= end:
+                break
+            yield as_bytes(chunk[max(start, offset) - offset:min(stop, end) - offset])
@@ -0,0 +1,54 @@
+"""
+Archive and restore postgres WAL segments as encrypted files, from postgres itself
+
+In postgresql.conf (with wal_level = replica and archive_mode = on)::
+
+    archive_command = 'python -m db_backup.wal archive %p --recipient <uid> --archive-dir <dir>'
+
+Set archive_timeout as well to bound how much you can lose when the database is quiet.
+point_in_time_restore sets the restore_command for you::
+
+    restore_command = 'python -m db_backup.wal restore %f %p --archive-dir <dir>'
+
+Both exit with 1 and say why on stderr when they fail, so postgres tries again later
+or knows it has run out of WAL to replay.
+"""
+from db_backup.commands import archive_wal, restore_wal
+from db_backup.errors import FailedBackup
+
+import optparse
+import sys
+
+def main(argv=None):
+    """Archive or restore a WAL segment from the command line and return an exit code"""
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage="%prog archive <path> --recipient <uid> --archive-dir <dir>\n       %prog restore <name> <path> --archive-dir <dir>")
+    parser.add_option("--archive-dir", help="Where the encrypted WAL segments live")
+    parser.add_option("--recipient", action="append", default=[], help="Who can decrypt the archived segments")
+    parser.add_option("--gpg-home", help="The gpg home to use instead of the default one")
+    parser.add_option("--compression", help="Compress segments with this codec before encrypting them")
+    parser.add_option("--chunked", action="store_true", default=False, help="Encrypt segments as a chunked container")
+    options, args = parser.parse_args(argv)
+
+    archiving = len(args) == 2 and args[0] == "archive" and options.recipient
+    restoring = len(args) == 3 and args[0] == "restore"
+    if not options.archive_dir or not (archiving or restoring):
+        parser.print_usage(sys.stderr)
+        return 2
+
+    try:
+        if archiving:
+            archive_wal(args[1], options.recipient, options.archive_dir, gpg_home=options.gpg_home
+                , compression=options.compression, chunked=options.chunked
+                )
+        else:
+            restore_wal(args[1], args[2], options.archive_dir, gpg_home=options.gpg_home)
+    except (FailedBackup, IOError, OSError) as error:
+        sys.stderr.write("{0}\n".format(error))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# coding: spec
+
+from db_backup.catalog import Catalog, CatalogEntry
+from db_backup.errors import BadBackupDir
+
+from tests.utils import a_temp_directory
+from tests.case import TestCase
+
+import datetime
+import sqlite3
+
+describe TestCase, "Catalog":
+    def add(self, catalog, filename, database, finished, succeeded=True):
+        catalog.add(CatalogEntry(catalog.backup_dir, filename, engine="psql", database=database
+            , started=finished - 10, finished=finished, succeeded=succeeded, recipients=["bob@bob.com"], rows={"blah": 3}
+            ))
+
+    it "finds the latest backup of a database that succeeded":
+        with a_temp_directory() as backup_dir:
+            catalog = Catalog(backup_dir)
+            self.add(catalog, "one", "db", 100)
+            self.add(catalog, "two", "db", 200)
+            self.add(catalog, "three", "db", 300, succeeded=False)
+            self.add(catalog, "four", "other", 400)
+
+            latest = catalog.latest("db")
+            self.assertEqual((latest.filename, latest.recipients, latest.rows), ("two", ["bob@bob.com"], {"blah": 3}))
+            self.assertEqual(latest.location, "{0}/two".format(backup_dir))
+            self.assertEqual(catalog.latest("db", succeeded=False).filename, "three")
+            self.assertIs(catalog.latest("nope"), None)
+
+    it "finds the backups between two times":
+        with a_temp_directory() as backup_dir:
+            catalog = Catalog(backup_dir)
+            for number in range(10):
+                self.add(catalog, str(number), "db" if number % 2 else "other", 1000 + number * 100, succeeded=number != 4)
+
+            self.assertEqual([entry.filename for entry in catalog.between(1200, 1500)], ["2", "3", "5"])
+            self.assertEqual([entry.filename for entry in catalog.between(1200, 1500, database="db")], ["3", "5"])
+            self.assertEqual([entry.filename for entry in catalog.between(1200, 1500, succeeded=False)], ["4"])
+            self.assertEqual([entry.filename for entry in catalog.between(1200, 1500, database="other", succeeded=False)], ["4"])
+
+            start = datetime.datetime.utcfromtimestamp(1200)
+            self.assertEqual([entry.filename for entry in catalog.between(start, start + datetime.timedelta(seconds=100))], ["2", "3"])
+
+    it "doesn't look at every backup to answer":
+        with a_temp_directory() as backup_dir:
+            catalog = Catalog(backup_dir)
+            self.add(catalog, "one", "db", 100)
+            connection = sqlite3.connect(catalog.path)
+            try:
+                for condition in ("database = 'db' and succeeded = 1 order by finished desc limit 1", "succeeded = 1 and finished between 1 and 2 order by finished"):
+                    plan = " ".join(str(row) for row in connection.execute("explain query plan select * from backups where {0}".format(condition)))
+                    self.assertIn("USING INDEX", plan)
+            finally:
+                connection.close()
+
+    it "complains if there is no catalog":
+        with a_temp_directory() as backup_dir:
+            with self.assertRaisesRegexp(BadBackupDir, "There is no catalog in the backup directory at '{0}'".format(backup_dir)):
+                Catalog(backup_dir).latest("db")
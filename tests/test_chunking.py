@@ -0,0 +1,33 @@
+# coding: spec
+
+from db_backup.chunking import content_defined
+
+from tests.case import TestCase
+
+import random
+
+describe TestCase, "Content defined chunking":
+    def lines(self, count, seed=1):
+        generator = random.Random(seed)
+        return ["{0}\n".format("".join(generator.choice("abcdef0123456789") for _ in range(generator.randint(10, 200)))) for _ in range(count)]
+
+    it "gives back everything it was given in chunks that end at newlines":
+        data = "".join(self.lines(3000))
+        pieces = list(content_defined(iter([data[i:i + 1000] for i in range(0, len(data), 1000)]), minimum=1024, average=4096, maximum=65536))
+        self.assertEqual("".join(pieces), data)
+        self.assertGreater(len(pieces), 10)
+        for piece in pieces[:-1]:
+            assert piece.endswith("\n")
+            self.assertGreaterEqual(len(piece), 1024)
+
+    it "cuts chunks that don't end by themselves":
+        pieces = list(content_defined(iter(["a" * 10000]), minimum=1024, average=4096, maximum=4096))
+        self.assertEqual([len(piece) for piece in pieces], [4096, 4096, 1808])
+
+    it "only changes the chunks around a change":
+        lines = self.lines(3000)
+        changed = lines[:1500] + ["something new\n"] + lines[1500:]
+        options = dict(minimum=1024, average=4096, maximum=65536)
+        before = list(content_defined(iter(["".join(lines)]), **options))
+        after = list(content_defined(iter(["".join(changed)]), **options))
+        self.assertLessEqual(len(set(after) - set(before)), 2)
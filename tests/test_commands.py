@@ -1,12 +1,25 @@
 # coding: spec
 
-from db_backup.errors import BadBackupFile, NonEmptyDatabase
-from db_backup.commands import backup, restore, sanitise_path
+from db_backup.errors import BadBackupFile, BadBackupDir, NonEmptyDatabase, GPGFailedToStart, UnknownCompression, FailedVerification, NotIncremental, NoTableIndex, FailedToRun
+from db_backup.commands import backup, backup_many, restore, restore_many, restoring, verify, sanitise_path, archive_wal, restore_wal, point_in_time_restore
+from db_backup.encryption import ChunkedEncryptor, DedupEncryptor, encryptor_for
+from db_backup.processes import Pipeline, ProcessStage, PythonStage, communicate
+from db_backup.incremental import ChainLink
+from db_backup.catalog import Catalog
+from db_backup import mysql_binlog, wal
 
-from tests.utils import a_temp_directory, path_to, assert_is_binary, a_temp_file
+from tests.utils import a_temp_directory, path_to, assert_is_binary, a_temp_file, copied_directory, setup_gpg_home, run_command
 from tests.case import TestCase
 
+from textwrap import dedent
+import datetime
+import hashlib
+import json
+import threading
+import sqlite3
+import random
 import uuid
+import time
 import mock
 import os
 
@@ -23,11 +36,11 @@ describe TestCase, "Backup command":
                 recipients = ["bob@bob.com"]
                 database_settings = {"name": database, "engine": "sqlite3"}
 
-                destination = backup(database_settings, recipients, backup_dir, gpg_home=gpg_home)
+                result = backup(database_settings, recipients, backup_dir, gpg_home=gpg_home)
 
-                self.assertEqual(destination, os.path.join(backup_dir, filename))
-                assert os.path.exists(destination)
-                assert_is_binary(destination)
+                self.assertEqual(result.location, os.path.join(backup_dir, filename))
+                assert os.path.exists(result.location)
+                assert_is_binary(result.location)
 
     it "Can take in a function to make the backup filename":
         filename = str(uuid.uuid1())
@@ -40,11 +53,718 @@ describe TestCase, "Backup command":
                 recipients = ["bob@bob.com"]
                 database_settings = {"name": database, "engine": "sqlite3"}
 
-                destination = backup(database_settings, recipients, backup_dir, filename_maker=filename_maker, gpg_home=gpg_home)
+                result = backup(database_settings, recipients, backup_dir, filename_maker=filename_maker, gpg_home=gpg_home)
 
-                self.assertEqual(destination, os.path.join(backup_dir, filename))
-                assert os.path.exists(destination)
-                assert_is_binary(destination)
+                self.assertEqual(result.location, os.path.join(backup_dir, filename))
+                assert os.path.exists(result.location)
+                assert_is_binary(result.location)
+
+    it "records what each process cost and gives it to the metrics callback":
+        reported = []
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                database_settings = {"name": database, "engine": "sqlite3"}
+                result = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), metrics=reported.append)
+
+                self.assertEqual(sorted(stats.desc for stats in result.stages), ["Dump command", "Encrypting something"])
+                self.assertEqual(reported, result.stages)
+                for stats in result.stages:
+                    self.assertEqual(stats.returncode, 0)
+                    self.assertGreater(stats.wall_time, 0)
+                    self.assertGreaterEqual(stats.cpu_time, 0)
+                    self.assertGreater(stats.max_rss, 0)
+
+    it "compresses the dump before gpg gets it when asked to":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                database_settings = {"name": database, "engine": "sqlite3"}
+                result = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), compression="gzip")
+
+                self.assertEqual(sorted(stats.desc for stats in result.stages), ["Compressing with gzip", "Dump command", "Encrypting something"])
+                assert_is_binary(result.location)
+
+    it "can make a chunked backup":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with copied_directory(path_to("gpg")) as gpg_home:
+                    setup_gpg_home(gpg_home)
+                    database_settings = {"name": database, "engine": "sqlite3"}
+                    result = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, compression="gzip", chunked=True)
+
+                    self.assertEqual(sorted(stats.desc for stats in result.stages), ["Compressing with gzip", "Dump command", "Encrypting chunks"])
+                    self.assertIs(type(encryptor_for(result.location)), ChunkedEncryptor)
+
+    it "adds every backup to the catalog in it's backup_dir":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                connection = sqlite3.connect(database)
+                try:
+                    connection.execute("create table blah (val text)")
+                    connection.executemany("insert into blah values (?)", [("one", ), ("two", )])
+                    connection.commit()
+                    connection.execute("analyze")
+                finally:
+                    connection.close()
+
+                database_settings = {"name": database, "engine": "sqlite3"}
+                result = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), compression="gzip", manifest=True)
+
+                pipeline = mock.Mock(name="pipeline")
+                pipeline.run.side_effect = FailedToRun("Dump command failed", exit_code=1)
+                with mock.patch("db_backup.commands.Pipeline", lambda *args, **kwargs: pipeline):
+                    with self.assertRaisesRegexp(FailedToRun, "Dump command failed"):
+                        backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"))
+
+                catalog = Catalog(backup_dir)
+                latest = catalog.latest(database)
+                self.assertEqual(latest.location, result.location)
+                self.assertEqual((latest.engine, latest.kind, latest.codec, latest.encryption), ("sqlite3", "full", "gzip", "gpg"))
+                self.assertEqual((latest.recipients, latest.rows), (["bob@bob.com"], {"blah": 2}))
+                self.assertEqual(latest.ciphertext_size, os.path.getsize(result.location))
+                self.assertGreater(latest.plaintext_size, 0)
+                self.assertLessEqual(latest.started, latest.finished)
+
+                failed = catalog.latest(database, succeeded=False)
+                self.assertNotEqual(failed.filename, latest.filename)
+                self.assertEqual(failed.error, "Dump command failed")
+
+                # Without a manifest or table index we don't know how big the dump was
+                backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"))
+                self.assertIs(catalog.latest(database).plaintext_size, None)
+
+    it "dumps once for many targets":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with a_temp_directory() as other_dir:
+                    database_settings = {"name": database, "engine": "sqlite3"}
+                    result = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg")
+                        , filename_maker=lambda: "backup.gpg", targets=[(["jade@stone.com"], other_dir)]
+                        )
+
+                    self.assertEqual(result.locations, [os.path.join(backup_dir, "backup.gpg"), os.path.join(other_dir, "backup.gpg")])
+                    self.assertEqual(sorted(stats.desc for stats in result.stages)
+                        , ["Dump command", "Encrypting something", "Encrypting something", "Fanning out"]
+                        )
+                    for location in result.locations:
+                        assert_is_binary(location)
+
+    it "complains about every target before dumping anything":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                missing = os.path.join(backup_dir, "nope")
+                with self.assertRaisesRegexp(BadBackupDir, "The backup directory at '{0}' doesn't exist".format(missing)):
+                    backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg")
+                        , targets=[(["bob@bob.com"], missing)]
+                        )
+                self.assertEqual(os.listdir(backup_dir), [])
+
+    it "complains about compression it doesn't know before doing anything":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with self.assertRaisesRegexp(UnknownCompression, "Don't know how to compress with lzma, choose from zstd, xz, gzip, pigz"):
+                    backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), compression="lzma")
+                self.assertEqual(os.listdir(backup_dir), [])
+
+    it "complains before dumping anything if it can't write to the backup_dir":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                missing = os.path.join(backup_dir, "nope")
+                with self.assertRaisesRegexp(BadBackupDir, "The backup directory at '{0}' doesn't exist".format(missing)):
+                    backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], missing, gpg_home=path_to("gpg"))
+
+describe TestCase, "Backup many command":
+    it "backs up all the databases at the same time and says which ones failed":
+        with a_temp_file() as database1:
+            with a_temp_file() as database2:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        jobs = [
+                              ({"name": database1, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir)
+                            , ({"name": database2, "engine": "sqlite3"}, ["nobody@nowhere.com"], backup_dir)
+                            , ({"name": database2, "engine": "sqlite3"}, ["jade@stone.com"], backup_dir)
+                            ]
+
+                        counted = []
+                        def count_rows(handler):
+                            counted.append(threading.current_thread())
+                            return {"blah": 3}
+
+                        reported = []
+                        filenames = iter(["one", "two", "three"])
+                        with mock.patch("db_backup.commands.count_rows", count_rows):
+                            results = backup_many(jobs, filename_maker=lambda: next(filenames), gpg_home=gpg_home, metrics=reported.append)
+
+                        self.assertEqual([destination for destination, _ in results], [os.path.join(backup_dir, name) for name in ("one", "two", "three")])
+                        self.assertIs(results[0][1], None)
+                        self.assertIs(type(results[1][1]), GPGFailedToStart)
+                        self.assertIs(results[2][1], None)
+
+                        for destination in (results[0][0], results[2][0]):
+                            assert os.path.exists(destination)
+                            assert_is_binary(destination)
+
+                        catalog = Catalog(backup_dir)
+                        self.assertEqual([entry.filename for entry in catalog.select("order by id")], ["one", "two", "three"])
+                        self.assertEqual(catalog.latest(database2).filename, "three")
+                        failed = catalog.latest(database2, succeeded=False)
+                        self.assertEqual((failed.filename, failed.recipients), ("two", ["nobody@nowhere.com"]))
+                        self.assertEqual(failed.error, str(results[1][1]))
+
+                        # The rows are counted at the same time, like the checks in backup
+                        self.assertEqual(len(counted), 3)
+                        self.assertNotIn(threading.current_thread(), counted)
+                        self.assertEqual(catalog.latest(database1).rows, {"blah": 3})
+
+                        descs = [stats.desc for stats in reported]
+                        for database in (database1, database2):
+                            self.assertIn("Dump command ({0})".format(database), descs)
+
+describe TestCase, "Restore many command":
+    def decrypting(self):
+        def decrypt_stages(location, gpg_home=None):
+            return ChunkedEncryptor().decrypt_stages(location, gpg_home=gpg_home, password="super_secret")
+        return mock.patch("db_backup.commands.encryptor_for", lambda location: mock.Mock(name="encryptor", decrypt_stages=decrypt_stages))
+
+    def make_database(self, location, val):
+        connection = sqlite3.connect(location)
+        try:
+            connection.execute("create table blah (val text)")
+            connection.execute("insert into blah values (?)", (val, ))
+            connection.commit()
+        finally:
+            connection.close()
+
+    it "restores all the backups at the same time and says which ones failed":
+        with a_temp_file() as database1:
+            with a_temp_file() as database2:
+                with a_temp_file() as restored1:
+                    with a_temp_file() as restored2:
+                        with a_temp_directory() as backup_dir:
+                            with copied_directory(path_to("gpg")) as gpg_home:
+                                setup_gpg_home(gpg_home)
+                                self.make_database(database1, "one")
+                                self.make_database(database2, "two")
+                                first = backup({"name": database1, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True)
+                                second = backup({"name": database2, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True)
+                                missing = os.path.join(backup_dir, "missing")
+
+                                jobs = [
+                                      ({"name": restored1, "engine": "sqlite3"}, first.location)
+                                    , ({"name": database1, "engine": "sqlite3"}, second.location)
+                                    , ({"name": restored2, "engine": "sqlite3"}, missing)
+                                    , ({"name": restored2, "engine": "sqlite3"}, second.location)
+                                    ]
+                                with self.decrypting():
+                                    results = restore_many(jobs, gpg_home=gpg_home)
+
+                                self.assertEqual([location for location, _ in results], [first.location, second.location, missing, second.location])
+                                self.assertIs(results[0][1], None)
+                                self.assertIs(type(results[1][1]), NonEmptyDatabase)
+                                self.assertIs(type(results[2][1]), BadBackupFile)
+                                self.assertIs(results[3][1], None)
+
+                                for location, val in ((restored1, "one"), (restored2, "two")):
+                                    connection = sqlite3.connect(location)
+                                    try:
+                                        self.assertEqual(connection.execute("select val from blah").fetchall(), [(val, )])
+                                    finally:
+                                        connection.close()
+
+    it "kills a restore the caller stops driving before it finishes":
+        with a_temp_file() as database:
+            with a_temp_file() as restored:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        self.make_database(database, "one")
+                        result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True)
+
+                        with self.decrypting():
+                            with restoring({"name": restored, "engine": "sqlite3"}, result.location, gpg_home=gpg_home) as supervisor:
+                                self.assertEqual([watchdog.desc for _, watchdog in supervisor.stages], ["Restore command ({0})".format(restored)])
+                                self.assertFalse(supervisor.finished)
+                        self.assertTrue(all(process.poll() is not None for process, _ in supervisor.stages))
+
+describe TestCase, "Verify command":
+    it "checks each backup against the manifest written next to it":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with a_temp_directory() as other_dir:
+                    database_settings = {"name": database, "engine": "sqlite3"}
+                    result = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg")
+                        , targets=[(["jade@stone.com"], other_dir)], manifest=True
+                        )
+
+                    for location in result.locations:
+                        assert os.path.exists("{0}.manifest".format(location))
+                        manifest = verify(location, gpg_home=path_to("gpg"))
+                        self.assertEqual(manifest.ciphertext.size, os.path.getsize(location))
+
+    it "complains if the backup doesn't match it's manifest":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), manifest=True)
+                with open(result.location, "ab") as fle:
+                    fle.write("tampered")
+
+                with self.assertRaisesRegexp(FailedVerification, "The ciphertext of the backup at '{0}' doesn't match it's manifest".format(result.location)):
+                    verify(result.location, gpg_home=path_to("gpg"))
+
+    it "complains if there is no manifest or it's signature is bad":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"))
+                with self.assertRaisesRegexp(FailedVerification, "There is no manifest for the backup at '{0}'".format(result.location)):
+                    verify(result.location, gpg_home=path_to("gpg"))
+
+                result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), manifest=True)
+                with open("{0}.manifest.asc".format(result.location), "w") as fle:
+                    fle.write("not a signature")
+                with self.assertRaisesRegexp(FailedVerification, "The manifest for the backup at '{0}' has a bad signature".format(result.location)):
+                    verify(result.location, gpg_home=path_to("gpg"))
+
+    it "insists on a good signature from the signer when it has one":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with copied_directory(path_to("gpg")) as gpg_home:
+                    setup_gpg_home(gpg_home)
+                    result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, manifest=True)
+                    with self.assertRaisesRegexp(FailedVerification, "The manifest for the backup at '{0}' isn't signed".format(result.location)):
+                        verify(result.location, gpg_home=gpg_home, signer="bob@bob.com")
+
+                    # The test keys have a passphrase, so we sign it ourselves rather than through backup
+                    manifest = "{0}.manifest".format(result.location)
+                    run_command("gpg", "--homedir {0} --batch --yes --pinentry-mode loopback --passphrase super_secret --armor --detach-sign --local-user bob@bob.com --output {1}.asc {1}".format(gpg_home, manifest), "Signing the manifest")
+
+                    verify(result.location, gpg_home=gpg_home, signer="bob@bob.com")
+                    verify(result.location, gpg_home=gpg_home, signer="4E57C1B01D958C30C4560003EC901116FC6BA54B")
+                    with self.assertRaisesRegexp(FailedVerification, "The manifest for the backup at '{0}' wasn't signed by jade@stone.com".format(result.location)):
+                        verify(result.location, gpg_home=gpg_home, signer="jade@stone.com")
+                    with self.assertRaisesRegexp(FailedVerification, "Couldn't find a key for nobody@nowhere.com"):
+                        verify(result.location, gpg_home=gpg_home, signer="nobody@nowhere.com")
+
+    it "can decrypt the backup to check the dump without restoring it":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with copied_directory(path_to("gpg")) as gpg_home:
+                    setup_gpg_home(gpg_home)
+                    database_settings = {"name": database, "engine": "sqlite3"}
+                    result = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, compression="gzip", chunked=True, manifest=True)
+
+                    manifest = verify(result.location, gpg_home=gpg_home, deep=True, password="super_secret")
+                    self.assertGreater(manifest.plaintext.size, 0)
+
+describe TestCase, "Incremental backups":
+    def change(self, database, sql, *args):
+        connection = sqlite3.connect(database)
+        try:
+            connection.execute(sql, *args)
+            connection.commit()
+        finally:
+            connection.close()
+
+    it "only backs up the pages that changed and restores the whole chain":
+        with a_temp_file() as database:
+            with a_temp_file() as restored:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        database_settings = {"name": database, "engine": "sqlite3_file"}
+                        self.change(database, "create table blah (val text)")
+                        self.change(database, "insert into blah values (randomblob(1000000))")
+
+                        results = []
+                        for value in ("one", "two"):
+                            results.append(backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True, incremental=True))
+                            self.change(database, "insert into blah values (?)", (value, ))
+                        results.append(backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True, incremental=True))
+
+                        locations = [result.location for result in results]
+                        self.assertEqual(ChainLink.of(locations[0]).kind, "full")
+                        self.assertEqual(ChainLink.of(locations[-1]).chain, locations)
+                        for location in locations[1:]:
+                            self.assertLess(os.path.getsize(location), os.path.getsize(locations[0]) / 10)
+
+                        def decrypt_stages(location, gpg_home=None):
+                            return ChunkedEncryptor().decrypt_stages(location, gpg_home=gpg_home, password="super_secret")
+                        with mock.patch("db_backup.commands.encryptor_for", lambda location: mock.Mock(name="encryptor", decrypt_stages=decrypt_stages)):
+                            result = restore({"name": restored, "engine": "sqlite3_file"}, locations[-1], gpg_home=gpg_home)
+                        self.assertEqual(result.locations, locations)
+
+                        connection = sqlite3.connect(restored)
+                        try:
+                            self.assertEqual(connection.execute("select val from blah where length(val) < 10").fetchall(), [("one", ), ("two", )])
+                        finally:
+                            connection.close()
+
+    it "complains if a backup the chain needs is missing":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                database_settings = {"name": database, "engine": "sqlite3_file"}
+                self.change(database, "create table blah (val text)")
+                first = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), incremental=True)
+                second = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), incremental=True)
+
+                os.remove(first.location)
+                with self.assertRaisesRegexp(BadBackupFile, "The backup at '{0}' needs '{1}' which doesn't exist".format(second.location, first.location)):
+                    restore(database_settings, second.location, gpg_home=path_to("gpg"))
+
+    it "keeps reading the binlog after stop_at so the decrypting process isn't cut off":
+        with a_temp_file() as script:
+            with open(script, "w") as fle:
+                fle.write('echo "BEGIN;"\necho "#260918 14:05:01 server id 1"\nseq 1 500000\n')
+
+            found = []
+            def collect(chunks):
+                found.extend(chunks)
+                return iter(())
+
+            stop = PythonStage(lambda chunks: mysql_binlog.events_until(chunks, datetime.datetime(2026, 1, 1)), "Stopping")
+            Pipeline([ProcessStage("sh", script, "Decrypting something"), stop, PythonStage(collect, "Collecting")]).run()
+            self.assertEqual("".join(found), "BEGIN;\nDELIMITER ;\nROLLBACK;\n")
+
+    it "replays the mysql binlog since the full backup up to stop_at":
+        with a_temp_directory() as bin_dir:
+            with a_temp_file() as restored:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        now = datetime.datetime.utcnow().replace(microsecond=0)
+                        fakes = {
+                              "mysqldump": """
+                                echo "-- mysqldump $*"
+                                echo "-- CHANGE MASTER TO MASTER_LOG_FILE='binlog.000001', MASTER_LOG_POS=100;"
+                                echo "create table blah (id int);"
+                              """
+                            , "mysql": """
+                                case "$*" in
+                                    *"SHOW MASTER STATUS"*) printf 'binlog.000002\\t300\\n' ;;
+                                    *"SHOW BINARY LOGS"*) printf 'binlog.000001\\t1000\\nbinlog.000002\\t300\\n' ;;
+                                    *information_schema*) echo 0 ;;
+                                    *) cat >> {restored} ;;
+                                esac
+                              """
+                            , "mysqlbinlog": """
+                                echo "-- mysqlbinlog $*"
+                                echo "# at 100"
+                                echo "{first} server id 1  end_log_pos 200"
+                                echo "insert into blah values (1);"
+                                echo "# at 200"
+                                echo "{second} server id 1  end_log_pos 300"
+                                echo "insert into blah values (2);"
+                              """
+                            }
+                        for name, script in fakes.items():
+                            with open(os.path.join(bin_dir, name), "w") as fle:
+                                fle.write("#!/bin/sh\n{0}".format(dedent(script).format(restored=restored
+                                    , first=(now + datetime.timedelta(hours=1)).strftime("#%y%m%d %H:%M:%S")
+                                    , second=(now + datetime.timedelta(hours=2)).strftime("#%y%m%d %H:%M:%S")
+                                    )))
+                            os.chmod(os.path.join(bin_dir, name), 0755)
+
+                        database_settings = {"engine": "mysql", "name": "blah"}
+                        with mock.patch.dict(os.environ, {"PATH": "{0}:{1}".format(bin_dir, os.environ["PATH"])}):
+                            first = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True, incremental=True)
+                            second = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True, incremental=True)
+                            self.assertEqual(ChainLink.of(second.location).chain, [first.location, second.location])
+
+                            def decrypt_stages(location, gpg_home=None):
+                                return ChunkedEncryptor().decrypt_stages(location, gpg_home=gpg_home, password="super_secret")
+                            with mock.patch("db_backup.commands.encryptor_for", lambda location: mock.Mock(name="encryptor", decrypt_stages=decrypt_stages)):
+                                restore(database_settings, second.location, gpg_home=gpg_home, stop_at=now + datetime.timedelta(minutes=90))
+
+                        with open(restored) as fle:
+                            replayed = fle.read().split("\n")
+                        self.assertEqual(replayed[0], "-- mysqldump --single-transaction --master-data=2 blah")
+                        self.assertEqual(replayed[3], "-- mysqlbinlog --read-from-remote-server --database blah --start-position 100 --stop-position 300 binlog.000001 binlog.000002")
+                        self.assertIn("insert into blah values (1);", replayed)
+                        self.assertNotIn("insert into blah values (2);", replayed)
+                        self.assertEqual(replayed[-3:], ["DELIMITER ;", "ROLLBACK;", ""])
+
+    it "only stops part way through a chain of backups":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"))
+                with self.assertRaisesRegexp(NotIncremental, "Can only stop part way through restoring a chain of incremental backups"):
+                    restore({"name": database, "engine": "sqlite3"}, result.location, gpg_home=path_to("gpg"), stop_at=datetime.datetime.utcnow())
+
+    it "complains about engines that can't make incremental backups":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with self.assertRaisesRegexp(NotIncremental, "Can't make incremental backups of sqlite3 databases"):
+                    backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), incremental=True)
+
+describe TestCase, "Deduplicated backups":
+    def chunk_files(self, backup_dir):
+        found = []
+        for root, _, filenames in os.walk(os.path.join(backup_dir, "chunks")):
+            found.extend(os.path.join(root, filename) for filename in filenames if not filename.endswith(".sha256"))
+        return set(found)
+
+    it "only stores the chunks that changed and restores from the shared chunks":
+        with a_temp_file() as database:
+            with a_temp_file() as restored:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        database_settings = {"name": database, "engine": "sqlite3"}
+                        connection = sqlite3.connect(database)
+                        try:
+                            connection.execute("create table blah (id integer, val text)")
+                            # The same rows every time so the chunks are the same every time
+                            connection.executemany("insert into blah values (?, ?)", [(i, hashlib.sha256(str(i)).hexdigest() * 16) for i in range(6000)])
+                            connection.commit()
+
+                            first = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, dedup=True)
+                            before = self.chunk_files(backup_dir)
+                            self.assertGreater(len(before), 2)
+
+                            connection.execute("update blah set val = 'changed' where id = 1500")
+                            connection.commit()
+                        finally:
+                            connection.close()
+
+                        second = backup(database_settings, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, dedup=True)
+                        self.assertIs(type(encryptor_for(second.location)), DedupEncryptor)
+                        self.assertLessEqual(len(self.chunk_files(backup_dir) - before), 2)
+                        assert_is_binary(first.location)
+
+                        def decrypt_stages(location, gpg_home=None):
+                            return DedupEncryptor().decrypt_stages(location, gpg_home=gpg_home, password="super_secret")
+                        with mock.patch("db_backup.commands.encryptor_for", lambda location: mock.Mock(name="encryptor", decrypt_stages=decrypt_stages)):
+                            restore({"name": restored, "engine": "sqlite3"}, second.location, gpg_home=gpg_home)
+
+                        connection = sqlite3.connect(restored)
+                        try:
+                            self.assertEqual(connection.execute("select count(*) from blah").fetchall(), [(6000, )])
+                            self.assertEqual(connection.execute("select val from blah where id = 1500").fetchall(), [("changed", )])
+                        finally:
+                            connection.close()
+
+    it "complains if a chunk the backup needs is missing":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with copied_directory(path_to("gpg")) as gpg_home:
+                    setup_gpg_home(gpg_home)
+                    result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, dedup=True)
+                    for location in self.chunk_files(backup_dir):
+                        os.remove(location)
+
+                    with self.assertRaisesRegexp(BadBackupFile, "The backup file at '{0}' needs a chunk that doesn't exist".format(result.location)):
+                        list(DedupEncryptor().decrypt_stages(result.location, gpg_home=gpg_home, password="super_secret")[0].transform(iter(())))
+
+    it "puts the chunks in the manifest so verify checks them as well":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with copied_directory(path_to("gpg")) as gpg_home:
+                    setup_gpg_home(gpg_home)
+                    connection = sqlite3.connect(database)
+                    try:
+                        connection.execute("create table blah (id integer, val text)")
+                        connection.executemany("insert into blah values (?, ?)", [(i, hashlib.sha256(str(i)).hexdigest() * 16) for i in range(3000)])
+                        connection.commit()
+                    finally:
+                        connection.close()
+
+                    result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, dedup=True, manifest=True)
+                    chunks = sorted(self.chunk_files(backup_dir))
+                    verify(result.location, gpg_home=gpg_home)
+                    with open("{0}.manifest".format(result.location)) as fle:
+                        self.assertEqual(sorted(json.load(fle)["chunks"]), sorted(os.path.basename(chunk) for chunk in chunks))
+
+                    with open(chunks[0], "ab") as fle:
+                        fle.write("corrupted")
+                    with self.assertRaisesRegexp(FailedVerification, "Chunk {0} of the backup at '{1}' doesn't match it's manifest".format(os.path.basename(chunks[0]), result.location)):
+                        verify(result.location, gpg_home=gpg_home)
+
+                    os.remove(chunks[0])
+                    with self.assertRaisesRegexp(FailedVerification, "The backup at '{0}' needs a chunk that doesn't exist: {1}".format(result.location, os.path.basename(chunks[0]))):
+                        verify(result.location, gpg_home=gpg_home)
+
+    it "keeps each chunk and it's digest together when the same chunk is stored at the same time":
+        with a_temp_directory() as backup_dir:
+            with copied_directory(path_to("gpg")) as gpg_home:
+                setup_gpg_home(gpg_home)
+                # The same block over and over means the same chunks are stored by many threads at once
+                block = "".join("{0}\n".format(os.urandom(100).encode("hex")) for _ in range(5000))
+                destination = os.path.join(backup_dir, "backup")
+
+                # Finish the encrypting in a different order to how it started
+                original = communicate
+                def slow_communicate(*args, **kwargs):
+                    result = original(*args, **kwargs)
+                    time.sleep(random.random() / 20)
+                    return result
+
+                encryptor = DedupEncryptor(workers=8)
+                with mock.patch("db_backup.encryption.communicate", slow_communicate):
+                    encryptor.write_index(iter([block] * 16), ["bob@bob.com"], destination, gpg_home)
+
+                digests = encryptor.digests[destination]
+                chunks = self.chunk_files(backup_dir)
+                self.assertEqual(set(os.path.basename(chunk) for chunk in chunks), set(digests))
+                for chunk in chunks:
+                    with open(chunk, "rb") as fle:
+                        data = fle.read()
+                    self.assertEqual(digests[os.path.basename(chunk)], {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data)})
+                    self.assertEqual(encryptor.chunk_digest(chunk), digests[os.path.basename(chunk)])
+
+                # And the threads that lost didn't leave their copies behind
+                for root, _, filenames in os.walk(os.path.join(backup_dir, "chunks")):
+                    self.assertEqual([filename for filename in filenames if filename.startswith(".")], [])
+
+    it "won't compress before deduplicating":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with self.assertRaisesRegexp(ValueError, "Deduplicated backups can't be compressed first"):
+                    backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), dedup=True, compression="gzip")
+
+describe TestCase, "Restoring some tables":
+    def make_database(self, database):
+        connection = sqlite3.connect(database)
+        try:
+            connection.execute("create table wanted (id integer, val text)")
+            connection.execute("create table unwanted (id integer, val text)")
+            connection.executemany("insert into wanted values (?, ?)", [(i, "w" * 100) for i in range(100)])
+            connection.executemany("insert into unwanted values (?, hex(randomblob(100)))", [(i, ) for i in range(1000)])
+            connection.commit()
+        finally:
+            connection.close()
+
+    def restore_tables(self, location, restored, gpg_home, tables):
+        password = "super_secret"
+        encryptor = mock.Mock(name="encryptor"
+            , decrypt_for_us = lambda data, desc, gpg_home=None: ChunkedEncryptor().decrypt_for_us(data, desc, gpg_home, password)
+            , decrypt_stages = lambda location, gpg_home=None, ranges=None: ChunkedEncryptor(chunk_size=4096).decrypt_stages(location, gpg_home, password, ranges)
+            )
+        with mock.patch("db_backup.commands.encryptor_for", lambda location: encryptor):
+            restore({"name": restored, "engine": "sqlite3"}, location, gpg_home=gpg_home, tables=tables)
+
+    it "only restores the tables it's asked for and only decrypts the chunks they are in":
+        with a_temp_file() as database:
+            with a_temp_file() as restored:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        self.make_database(database)
+                        with mock.patch("db_backup.commands.ChunkedEncryptor", lambda: ChunkedEncryptor(chunk_size=4096)):
+                            result = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True, table_index=True)
+                        assert_is_binary("{0}.tables".format(result.location))
+
+                        decrypted = []
+                        original = ChunkedEncryptor.decrypt_chunks
+                        def decrypt_chunks(self, location, header, index, gpg_home=None, numbers=None):
+                            decrypted.append((len(index), len(numbers)))
+                            return original(self, location, header, index, gpg_home, numbers)
+
+                        with mock.patch.object(ChunkedEncryptor, "decrypt_chunks", decrypt_chunks):
+                            self.restore_tables(result.location, restored, gpg_home, ["wanted"])
+
+                        [(total, used)] = decrypted
+                        self.assertLess(used, total / 2)
+
+                        connection = sqlite3.connect(restored)
+                        try:
+                            self.assertEqual(connection.execute("select count(*) from wanted").fetchall(), [(100, )])
+                            self.assertEqual(connection.execute("select name from sqlite_master where type = 'table'").fetchall(), [("wanted", )])
+                        finally:
+                            connection.close()
+
+    it "complains about tables the backup doesn't have or backups without an index":
+        with a_temp_file() as database:
+            with a_temp_file() as restored:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        self.make_database(database)
+                        indexed = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True, table_index=True)
+                        with self.assertRaisesRegexp(BadBackupFile, "The backup doesn't have these tables: nope"):
+                            self.restore_tables(indexed.location, restored, gpg_home, ["wanted", "nope"])
+
+                        plain = backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True)
+                        with self.assertRaisesRegexp(BadBackupFile, "The backup at '{0}' has no table index".format(plain.location)):
+                            self.restore_tables(plain.location, restored, gpg_home, ["wanted"])
+
+    it "can't index the tables of a dump that isn't sql":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with self.assertRaisesRegexp(NoTableIndex, "Can't find the tables in dumps of sqlite3_file databases"):
+                    backup({"name": database, "engine": "sqlite3_file"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), table_index=True)
+
+describe TestCase, "WAL archiving":
+    it "archives segments from postgres' archive_command and gets them back for it's restore_command":
+        with a_temp_directory() as archive_dir:
+            with a_temp_directory() as pg_wal:
+                with copied_directory(path_to("gpg")) as gpg_home:
+                    setup_gpg_home(gpg_home)
+                    segment = os.path.join(pg_wal, "000000010000000000000001")
+                    with open(segment, "w") as fle:
+                        fle.write("wal" * 10000)
+
+                    argv = ["archive", segment, "--recipient", "bob@bob.com", "--archive-dir", archive_dir, "--gpg-home", gpg_home, "--chunked"]
+                    self.assertEqual(wal.main(argv), 0)
+                    self.assertEqual(sorted(os.listdir(archive_dir)), ["000000010000000000000001.gpg", "000000010000000000000001.gpg.manifest"])
+
+                    # Archiving the same segment again is fine, but not a different one with the same name
+                    self.assertEqual(wal.main(argv), 0)
+                    with open(segment, "w") as fle:
+                        fle.write("different")
+                    with self.assertRaisesRegexp(BadBackupDir, "The WAL archive at '{0}' already has a different 000000010000000000000001".format(archive_dir)):
+                        archive_wal(segment, ["bob@bob.com"], archive_dir, gpg_home=gpg_home)
+
+                    destination = os.path.join(pg_wal, "RECOVERYXLOG")
+                    restore_wal("000000010000000000000001", destination, archive_dir, gpg_home=gpg_home, password="super_secret")
+                    with open(destination) as fle:
+                        self.assertEqual(fle.read(), "wal" * 10000)
+
+                    with self.assertRaisesRegexp(BadBackupFile, "The WAL archive at '{0}' has no 000000010000000000000002".format(archive_dir)):
+                        restore_wal("000000010000000000000002", destination, archive_dir, gpg_home=gpg_home)
+                    with mock.patch("sys.stderr"):
+                        self.assertEqual(wal.main(["restore", "000000010000000000000002", destination, "--archive-dir", archive_dir]), 1)
+
+    it "restores a base backup into a data directory that replays the archived WAL":
+        with a_temp_directory() as bin_dir:
+            with a_temp_directory() as cluster:
+                with a_temp_directory() as backup_dir:
+                    with a_temp_directory() as restored:
+                        with copied_directory(path_to("gpg")) as gpg_home:
+                            setup_gpg_home(gpg_home)
+                            with open(os.path.join(cluster, "PG_VERSION"), "w") as fle:
+                                fle.write("16\n")
+                            with open(os.path.join(bin_dir, "pg_basebackup"), "w") as fle:
+                                fle.write(dedent("""
+                                    #!/bin/sh
+                                    exec tar -C {0} -cf - .
+                                """).lstrip().format(cluster))
+                            os.chmod(os.path.join(bin_dir, "pg_basebackup"), 0755)
+
+                            with mock.patch.dict(os.environ, {"PATH": "{0}:{1}".format(bin_dir, os.environ["PATH"])}):
+                                result = backup({"engine": "psql", "name": "postgres"}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True, base_backup=True)
+
+                            data_dir = os.path.join(restored, "data")
+                            def decrypt_stages(location, gpg_home=None):
+                                return ChunkedEncryptor().decrypt_stages(location, gpg_home=gpg_home, password="super_secret")
+                            with mock.patch("db_backup.commands.encryptor_for", lambda location: mock.Mock(name="encryptor", decrypt_stages=decrypt_stages)):
+                                point_in_time_restore(result.location, data_dir, backup_dir, target_time=datetime.datetime(2020, 1, 2, 3, 4, 5), gpg_home=gpg_home)
+
+                            self.assertEqual(os.stat(data_dir).st_mode & 0777, 0700)
+                            with open(os.path.join(data_dir, "PG_VERSION")) as fle:
+                                self.assertEqual(fle.read(), "16\n")
+                            assert os.path.exists(os.path.join(data_dir, "recovery.signal"))
+                            with open(os.path.join(data_dir, "postgresql.auto.conf")) as fle:
+                                settings = fle.read()
+                            self.assertIn("recovery_target_time = '2020-01-02 03:04:05.000000+00'\n", settings)
+                            self.assertIn("-m db_backup.wal restore %f %p --archive-dir {0} --gpg-home {1}'\n".format(backup_dir, gpg_home), settings)
+
+                            with self.assertRaisesRegexp(NonEmptyDatabase, "Sorry, won't restore into a data directory that isn't empty"):
+                                point_in_time_restore(result.location, data_dir, backup_dir)
+
+    it "complains about engines that can't make base backups":
+        with a_temp_file() as database:
+            with a_temp_directory() as backup_dir:
+                with self.assertRaisesRegexp(NotIncremental, "Can't make base backups of sqlite3 databases"):
+                    backup({"name": database, "engine": "sqlite3"}, ["bob@bob.com"], backup_dir, gpg_home=path_to("gpg"), base_backup=True)
 
 describe TestCase, "Sanitise path":
     @mock.patch("db_backup.commands.urlparse.urlparse")
@@ -95,22 +815,68 @@ describe TestCase, "Restore command":
                 handler.is_empty.assert_called_once()
             fake_sanitise_path.assert_called_once_with(restore_from)
 
-    @mock.patch("db_backup.commands.Encryptor")
+    @mock.patch("db_backup.commands.Pipeline")
+    @mock.patch("db_backup.commands.encryptor_for")
     @mock.patch("db_backup.commands.DatabaseHandler")
-    it "Decrypts from the backup and gives it to the database handler", FakeDatabaseHandler, FakeEncryptor:
-        handler = mock.Mock(name="handler")
+    it "Decrypts from the backup straight into the restore command", FakeDatabaseHandler, fake_encryptor_for, FakePipeline:
+        handler = mock.MagicMock(name="handler")
         gpg_home = mock.Mock(name="gpg_home")
+        restorer = mock.Mock(name="restorer")
         encryptor = mock.Mock(name="encryptor")
-        decrypted = mock.Mock(name="decrypted")
+        decrypter = mock.Mock(name="decrypter")
+        decompressor = mock.Mock(name="decompressor")
         database_settings = mock.Mock(name="database_settings")
 
         FakeDatabaseHandler.side_effect = lambda settings: handler
         handler.is_empty.side_effect = lambda: True
+        handler.restore_stage.return_value.__enter__.return_value = restorer
 
-        FakeEncryptor.side_effect = lambda: encryptor
-        encryptor.decrypt.side_effect = lambda *args, **kwargs: decrypted
+        fake_encryptor_for.return_value = encryptor
+        encryptor.decrypt_stages.return_value = [decrypter, decompressor]
 
         with a_temp_file() as restore_from:
-            restore(database_settings, restore_from, gpg_home)
-            handler.restore.assert_called_once_with(decrypted)
+            result = restore(database_settings, restore_from, gpg_home, idle_timeout=20, total_timeout=60)
+            self.assertEqual(result.location, restore_from)
+            fake_encryptor_for.assert_called_once_with(restore_from)
+            encryptor.decrypt_stages.assert_called_once_with(restore_from, gpg_home=gpg_home)
+            FakePipeline.assert_called_once_with([decrypter, decompressor, restorer], idle_timeout=20, total_timeout=60, metrics=mock.ANY)
+            FakePipeline.return_value.run.assert_called_once_with()
+
+    it "restores a directory dump as one whatever jobs is now":
+        with a_temp_directory() as bin_dir:
+            with a_temp_file() as restored:
+                with a_temp_directory() as backup_dir:
+                    with copied_directory(path_to("gpg")) as gpg_home:
+                        setup_gpg_home(gpg_home)
+                        scripts = {
+                              "pg_dump": """
+                                args="$*"; while [ "$1" != "--file" ]; do shift; done; dir="$2"
+                                mkdir "$dir" && echo "some data" > "$dir/1.dat"
+                            """
+                            , "pg_restore": """
+                                for arg in "$@"; do dir="$arg"; done
+                                echo "pg_restore $*" > {0} && cat "$dir/1.dat" >> {0}
+                            """.format(restored)
+                            , "psql": """
+                                echo "psql $*" > {0} && cat >> {0}
+                            """.format(restored)
+                            }
+                        for name, script in scripts.items():
+                            with open(os.path.join(bin_dir, name), "w") as fle:
+                                fle.write("#!/bin/sh\n{0}".format(dedent(script).lstrip()))
+                            os.chmod(os.path.join(bin_dir, name), 0755)
+
+                        with mock.patch.dict(os.environ, {"PATH": "{0}:{1}".format(bin_dir, os.environ["PATH"])}):
+                            result = backup({"engine": "psql", "name": "blah", "jobs": 3}, ["bob@bob.com"], backup_dir, gpg_home=gpg_home, chunked=True)
+                            self.assertEqual(Catalog(backup_dir).find(os.path.basename(result.location)).dump_format, "directory")
+
+                            def decrypt_stages(location, gpg_home=None):
+                                return ChunkedEncryptor().decrypt_stages(location, gpg_home=gpg_home, password="super_secret")
+                            with mock.patch("db_backup.commands.encryptor_for", lambda location: mock.Mock(name="encryptor", decrypt_stages=decrypt_stages)):
+                                with mock.patch("db_backup.databases.DatabaseHandler.is_empty", lambda handler: True):
+                                    restore({"engine": "psql", "name": "blah"}, result.location, gpg_home=gpg_home)
 
+                        with open(restored) as fle:
+                            lines = fle.read().split("\n")
+                        self.assertEqual(lines[0].split()[:4], ["pg_restore", "--jobs", "1", "-d"])
+                        self.assertEqual(lines[1], "some data")
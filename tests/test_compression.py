@@ -0,0 +1,41 @@
+# coding: spec
+
+from db_backup.compression import find_codec, detect_codec, CODECS
+from db_backup.processes import Pipeline, ProcessStage
+from db_backup.errors import UnknownCompression
+
+from tests.utils import a_temp_file
+from tests.case import TestCase
+
+describe TestCase, "Codecs":
+    it "finds codecs by name":
+        self.assertEqual(find_codec("zstd").compress, ("zstd", "-T0 -q -c"))
+        self.assertEqual(find_codec("pigz").name, "pigz")
+
+    it "complains about codecs it doesn't know":
+        with self.assertRaisesRegexp(UnknownCompression, "Don't know how to compress with blah, choose from zstd, xz, gzip, pigz"):
+            find_codec("blah")
+
+    it "detects the codec from the start of what it compressed":
+        self.assertEqual(detect_codec("\x28\xb5\x2f\xfd\x04\x58").name, "zstd")
+        self.assertEqual(detect_codec("\xfd7zXZ\x00\x00").name, "xz")
+
+        # Everything that makes gzip can be decompressed by gzip
+        self.assertEqual(detect_codec("\x1f\x8b\x08\x00\x00\x00").name, "gzip")
+
+    it "doesn't detect a codec for things that aren't compressed":
+        self.assertIs(detect_codec("BEGIN TRANSACTION;"), None)
+        self.assertIs(detect_codec(""), None)
+
+    it "makes a stream that it can detect and decompress":
+        codec = find_codec("gzip")
+        with a_temp_file() as compressed:
+            with a_temp_file() as decompressed:
+                Pipeline([ProcessStage("seq", "10000", "Count"), codec.compress_stage(), ProcessStage("tee", compressed, "Tee something")]).run()
+
+                with open(compressed) as fle:
+                    self.assertIs(detect_codec(fle.read(10)), codec)
+
+                Pipeline([ProcessStage("cat", compressed, "Cat something"), codec.decompress_stage(), ProcessStage("tee", decompressed, "Tee something")]).run()
+                with open(decompressed) as fle:
+                    self.assertEqual(fle.read().split(), [str(num) for num in range(1, 10001)])
@@ -0,0 +1,91 @@
+# coding: spec
+
+from db_backup.connections import ConnectionPool, optional_import, query, pool
+from db_backup.databases import DatabaseInfo
+from db_backup.errors import FailedToRun
+
+from tests.case import TestCase
+
+from noseOfYeti.tokeniser.support import noy_sup_setUp
+import sqlite3
+import mock
+
+describe TestCase, "ConnectionPool":
+    before_each:
+        self.info = DatabaseInfo("mysql", "blah", user="bob")
+        self.connect = mock.Mock(name="connect", side_effect=lambda: mock.Mock(name="connection"))
+
+    it "gives back the connection it kept for the same database":
+        connections = ConnectionPool()
+        with connections.connection(self.info, self.connect) as first:
+            pass
+        with connections.connection(DatabaseInfo("mysql", "blah", user="bob"), self.connect) as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(len(self.connect.mock_calls), 1)
+
+        with connections.connection(DatabaseInfo("mysql", "other"), self.connect) as other:
+            pass
+        self.assertIsNot(other, first)
+
+    it "doesn't keep a connection that something went wrong with":
+        connections = ConnectionPool()
+        with self.assertRaisesRegexp(ValueError, "nope"):
+            with connections.connection(self.info, self.connect) as first:
+                raise ValueError("nope")
+        first.close.assert_called_once_with()
+
+        with connections.connection(self.info, self.connect) as second:
+            pass
+        self.assertIsNot(first, second)
+
+    it "only keeps as many idle connections as it's size":
+        connections = ConnectionPool(size=1)
+        with connections.connection(self.info, self.connect) as first:
+            with connections.connection(self.info, self.connect) as second:
+                pass
+        first.close.assert_called_once_with()
+        self.assertEqual(second.close.mock_calls, [])
+
+        with connections.connection(self.info, self.connect, size=0) as third:
+            pass
+        self.assertIs(third, second)
+        third.close.assert_called_once_with()
+
+        connections.clear()
+        self.assertEqual(connections.idle, {})
+
+describe TestCase, "Querying":
+    it "returns the rows and complains like the command line would":
+        info = DatabaseInfo("sqlite3", ":memory:")
+        connect = lambda: sqlite3.connect(":memory:")
+        self.assertEqual(query(info, connect, "select ? + 1", (1, ), "Adding", size=0), [(2, )])
+        with self.assertRaisesRegexp(FailedToRun, "Finding nothing failed: no such table: missing"):
+            query(info, connect, "select * from missing", (), "Finding nothing", size=0)
+        self.assertNotIn(info, pool.idle)
+
+    it "tries a new connection when a pooled one has gone stale":
+        info = DatabaseInfo("sqlite3", ":memory:")
+        stale = mock.Mock(name="stale")
+        stale.cursor.return_value.execute.side_effect = Exception("MySQL server has gone away")
+        pool.idle[info] = [stale]
+        try:
+            connect = mock.Mock(name="connect", side_effect=lambda: sqlite3.connect(":memory:"))
+            self.assertEqual(query(info, connect, "select ? + 1", (1, ), "Adding"), [(2, )])
+            stale.close.assert_called_once_with()
+            self.assertEqual(len(connect.mock_calls), 1)
+            self.assertEqual(len(pool.idle[info]), 1)
+            self.assertIsNot(pool.idle[info][0], stale)
+
+            # But a query that fails on a new connection isn't tried again
+            for calls in (2, 3):
+                with self.assertRaisesRegexp(FailedToRun, "Finding nothing failed: no such table: missing"):
+                    query(info, connect, "select * from missing", (), "Finding nothing", size=0)
+                self.assertEqual(len(connect.mock_calls), calls)
+            self.assertEqual(pool.idle[info], [])
+        finally:
+            pool.clear()
+
+    it "imports the first module it can":
+        self.assertIs(optional_import("not_a_real_module", "sqlite3"), sqlite3)
+        self.assertIs(optional_import("not_a_real_module"), None)
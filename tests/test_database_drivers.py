@@ -1,9 +1,11 @@
 # coding: spec
 
-from db_backup.databases import DatabaseInfo, DatabaseDriver, PsqlDriver, MysqlDriver, DatabaseHandler, SqliteDriver
-from db_backup.errors import FailedToRun, NoDatabase
+from db_backup.databases import DatabaseInfo, DatabaseDriver, PsqlDriver, MysqlDriver, DatabaseHandler, SqliteDriver, SqliteFileDriver
+from db_backup.errors import FailedToRun, NoDatabase, NotIncremental, UnknownProfile, BadBackupFile
 
-from tests.utils import print_exception_and_assertfail, run_command
+from db_backup.processes import Pipeline, PythonStage
+
+from tests.utils import print_exception_and_assertfail, run_command, a_temp_directory, a_temp_file
 from tests.case import TestCase
 
 from noseOfYeti.tokeniser.support import noy_sup_setUp, noy_sup_tearDown
@@ -11,7 +13,10 @@ import mock
 
 from textwrap import dedent
 import tempfile
+import hashlib
+import json
 import random
+import shlex
 import os
 
 describe TestCase, "DatabaseDriver":
@@ -23,6 +28,12 @@ describe TestCase, "DatabaseDriver":
         driver = DatabaseDriver(self.database_info)
         self.assertIs(driver.database_info, self.database_info)
 
+    it "complains about incremental dumps if it can't make them":
+        self.database_info.engine = "blah"
+        with self.assertRaisesRegexp(NotIncremental, "Can't make incremental backups of blah databases"):
+            with self.database_driver.incremental_dump_command("state"):
+                pass
+
     describe "Getting a temporary file":
         it "Writes the content to the file and returns it's location":
             content = """
@@ -107,6 +118,7 @@ describe TestCase, "DatabaseDriver":
             result = mock.Mock(name="result")
             dump_template = mock.Mock(name="dump_template")
             self.database_driver.dump_template = dump_template
+            self.database_info.profile = ""
 
             fill_out_cm = mock.MagicMock(name="fill_out_cm")
             fill_out_cm.__enter__.return_value = result
@@ -145,29 +157,182 @@ describe TestCase, "DatabaseDriver":
                 self.assertIs(self.database_driver.is_empty(), False)
                 run_template.assert_called_once_with(is_empty_template, "Find number of tables")
 
+        it "asks natively when it can and doesn't start a command":
+            driver = MysqlDriver(DatabaseInfo("mysql", "blah", user="bob", port="3307"))
+            cursor = mock.Mock(name="cursor")
+            cursor.fetchall.side_effect = lambda: []
+            pymysql = mock.Mock(name="pymysql")
+            pymysql.connect.side_effect = lambda **kwargs: mock.Mock(name="connection", cursor=lambda: cursor)
+
+            with mock.patch("db_backup.databases.optional_import", lambda *names: pymysql):
+                with mock.patch.object(driver, "run_template") as run_template:
+                    self.assertIs(driver.is_empty(), True)
+                    self.assertEqual(run_template.mock_calls, [])
+
+            pymysql.connect.assert_called_once_with(database="blah", user="bob", port=3307, autocommit=True)
+            cursor.execute.assert_called_once_with(MysqlDriver.is_empty_query[0], ("blah", ))
+
+        it "uses the template when the library isn't installed":
+            driver = PsqlDriver(DatabaseInfo("psql", "blah"))
+            with mock.patch("db_backup.databases.optional_import", lambda *names: None):
+                with mock.patch.object(driver, "run_template") as run_template:
+                    run_template.side_effect = lambda template, desc: "1"
+                    self.assertIs(driver.is_empty(), False)
+                    self.assertEqual(driver.estimated_size(), 1)
+            self.assertEqual(run_template.mock_calls, [
+                  mock.call(PsqlDriver.is_empty_template, "Find number of tables")
+                , mock.call(PsqlDriver.size_template, "Find size of database")
+                ])
+
     describe "run_template":
-        @mock.patch("db_backup.databases.stdout_chunks")
-        it "fills out the template and returns the stripped stdout from running the command", fake_stdout_chunks:
+        @mock.patch("db_backup.databases.stdout_views")
+        it "fills out the template and returns the stripped stdout from running the command", fake_stdout_views:
             env = mock.Mock(name="env")
             desc = mock.Mock(name="desc")
             command = mock.Mock(name="command")
             options = mock.Mock(name="options")
             template = mock.Mock(name="template")
 
-            fake_stdout_chunks.side_effect = lambda *args, **kwargs: "\n1\n"
+            fake_stdout_views.side_effect = lambda *args, **kwargs: [memoryview("\n1"), memoryview("\n")]
             fill_out_cm = mock.MagicMock(name="fill_out_cm")
             fill_out_cm.__enter__.return_value = (command, options, env, None)
             with mock.patch.object(self.database_driver, "fill_out") as fill_out:
                 fill_out.return_value = fill_out_cm
                 self.assertEqual(self.database_driver.run_template(template, desc), "1")
                 fill_out.assert_called_once_with(template)
-                fake_stdout_chunks.assert_called_once_with(command, options, desc, env=env, stdin=None)
+                fake_stdout_views.assert_called_once_with(command, options, desc, env=env, stdin=None)
 
         it "actually works":
             self.database_info.as_dict.side_effect = lambda: {}
             result = self.database_driver.run_template(("echo", "blah and stuff"), "Run echo")
             self.assertEqual(result, "blah and stuff")
 
+describe TestCase, "Parallel dumps":
+    it "dumps and restores the normal way with one job":
+        driver = PsqlDriver(DatabaseInfo.from_dict({"engine": "psql", "name": "blah", "jobs": 1}))
+        with driver.dump_command() as (command, options, env, stdin):
+            self.assertEqual((command, options), ("pg_dump", " blah"))
+        self.assertEqual(driver.commands_for("restore"), ["psql"])
+
+    it "uses a directory that only lasts as long as the command with more than one job":
+        driver = PsqlDriver(DatabaseInfo.from_dict({"engine": "psql", "name": "blah", "user": "bob", "jobs": 4}))
+        with driver.dump_command() as (command, options, env, stdin):
+            self.assertEqual(command, "sh")
+            argv = shlex.split(options)
+            directory = argv[argv.index("--file") + 1]
+            self.assertEqual(argv[:2], ["-c", '"$@" && exec tar -C {0} -cf - dump'.format(os.path.dirname(directory))])
+            self.assertEqual(argv[2:], ["sh", "pg_dump", "--format=directory", "--jobs", "4", "--file", directory, "-U", "bob", "blah"])
+            assert os.path.isdir(os.path.dirname(directory))
+        assert not os.path.exists(os.path.dirname(directory))
+
+        self.assertEqual(driver.commands_for("dump"), ["pg_dump", "tar"])
+        self.assertEqual(driver.commands_for("restore"), ["pg_restore", "tar"])
+
+    it "dumps mysql in parallel with mydumper and restores it with myloader":
+        driver = MysqlDriver(DatabaseInfo.from_dict({"engine": "mysql", "name": "blah", "password": "pwd", "jobs": 8}))
+        self.assertEqual(driver.commands_for("dump"), ["mydumper", "tar"])
+        self.assertEqual(driver.commands_for("restore"), ["myloader", "tar"])
+
+        with driver.restore_command() as (command, options, env, stdin):
+            argv = shlex.split(options)
+            directory = argv[argv.index("--directory") + 1]
+            self.assertEqual(argv[:2], ["-c", 'tar -C {0} -xf - && exec "$@"'.format(os.path.dirname(directory))])
+            self.assertEqual(argv[2:4], ["sh", "myloader"])
+            assert argv[4].startswith("--defaults-extra-file=")
+            self.assertEqual(argv[5:], ["--threads", "8", "--directory", directory, "--database", "blah"])
+
+        # Filling out the template with a password doesn't change the template itself
+        with driver.restore_command() as (command, options, env, stdin):
+            self.assertEqual(len([arg for arg in shlex.split(options) if arg.startswith("--defaults-extra-file")]), 1)
+
+    it "restores the way the backup was dumped when it knows":
+        driver = PsqlDriver(DatabaseInfo.from_dict({"engine": "psql", "name": "blah"}))
+        self.assertEqual(driver.dump_format, "plain")
+        self.assertEqual(driver.commands_for("restore", dump_format="directory"), ["pg_restore", "tar"])
+        with driver.restore_command("directory") as (command, options, env, stdin):
+            argv = shlex.split(options)
+            self.assertEqual(argv[2:5], ["sh", "pg_restore", "--jobs"])
+            self.assertEqual(argv[5], "1")
+
+        driver = PsqlDriver(DatabaseInfo.from_dict({"engine": "psql", "name": "blah", "jobs": 4}))
+        self.assertEqual(driver.dump_format, "directory")
+        self.assertEqual(driver.commands_for("restore", dump_format="plain"), ["psql"])
+        with driver.restore_command("plain") as (command, options, env, stdin):
+            self.assertEqual((command, options), ("psql", "-d blah"))
+
+        with self.assertRaisesRegexp(BadBackupFile, "Can't restore a directory dump into a sqlite3 database"):
+            SqliteDriver(DatabaseInfo.from_dict({"engine": "sqlite3", "name": "blah"})).commands_for("restore", dump_format="directory")
+
+    it "packs the directory into one stream and unpacks it for pg_restore":
+        with a_temp_directory() as bin_dir:
+            with a_temp_file() as restored:
+                with open(os.path.join(bin_dir, "pg_dump"), "w") as fle:
+                    fle.write(dedent("""
+                        #!/bin/sh
+                        args="$*"; while [ "$1" != "--file" ]; do shift; done; dir="$2"
+                        mkdir "$dir" && echo "$args" > "$dir/toc.dat" && echo "some data" > "$dir/1.dat"
+                    """).lstrip())
+                with open(os.path.join(bin_dir, "pg_restore"), "w") as fle:
+                    fle.write(dedent("""
+                        #!/bin/sh
+                        for arg in "$@"; do dir="$arg"; done
+                        echo "$*" > {0} && cat "$dir/toc.dat" "$dir/1.dat" >> {0}
+                    """).lstrip().format(restored))
+                for name in ("pg_dump", "pg_restore"):
+                    os.chmod(os.path.join(bin_dir, name), 0755)
+
+                with mock.patch.dict(os.environ, {"PATH": "{0}:{1}".format(bin_dir, os.environ["PATH"])}):
+                    handler = DatabaseHandler({"engine": "psql", "name": "blah", "jobs": 3})
+                    with handler.dump_stage() as dump:
+                        with handler.restore_stage() as restore:
+                            Pipeline([dump, restore]).run()
+
+                with open(restored) as fle:
+                    lines = fle.read().split("\n")
+                self.assertEqual(lines[0].split()[:4], ["--jobs", "3", "-d", "blah"])
+                self.assertEqual(lines[1].split()[:3], ["--format=directory", "--jobs", "3"])
+                self.assertEqual(lines[2], "some data")
+
+describe TestCase, "Dump profiles":
+    it "dumps with the default options without a profile":
+        driver = MysqlDriver(DatabaseInfo.from_dict({"engine": "mysql", "name": "blah", "user": "bob"}))
+        with driver.dump_command() as (command, options, env, stdin):
+            self.assertEqual((command, shlex.split(options)), ("mysqldump", ["--user", "bob", "blah"]))
+
+    it "puts the profile's options after the password file and before the template's own options":
+        driver = MysqlDriver(DatabaseInfo.from_dict({"engine": "mysql", "name": "blah", "user": "bob", "password": "pwd", "profile": "online"}))
+        with driver.dump_command() as (command, options, env, stdin):
+            argv = shlex.split(options)
+            self.assertEqual(command, "mysqldump")
+            assert argv[0].startswith("--defaults-extra-file=")
+            self.assertEqual(argv[1:], ["--single-transaction", "--quick", "--user", "bob", "blah"])
+
+        # Using the profile doesn't change the template itself
+        self.assertEqual(MysqlDriver.dump_template[1][0], ("--user", "{user}"))
+
+    it "gives pg_dump a lock timeout":
+        driver = PsqlDriver(DatabaseInfo.from_dict({"ENGINE": "psql", "NAME": "blah", "PROFILE": "minimal-lock"}))
+        with driver.dump_command() as (command, options, env, stdin):
+            self.assertEqual((command, shlex.split(options)), ("pg_dump", ["--lock-wait-timeout", "5s", "blah"]))
+
+    it "uses the directory profiles for parallel dumps":
+        driver = MysqlDriver(DatabaseInfo.from_dict({"engine": "mysql", "name": "blah", "jobs": 4, "profile": "fast"}))
+        with driver.dump_command() as (command, options, env, stdin):
+            argv = shlex.split(options)
+            self.assertEqual(argv[2:7], ["sh", "mydumper", "--trx-consistency-only", "--rows", "500000"])
+
+    it "complains about a profile it doesn't know before dumping":
+        driver = PsqlDriver(DatabaseInfo.from_dict({"engine": "psql", "name": "blah", "profile": "reckless"}))
+        with self.assertRaisesRegexp(UnknownProfile, "Don't know the reckless dump profile for psql databases, choose from fast, minimal-lock, online"):
+            driver.commands_for("dump")
+        self.assertEqual(driver.commands_for("restore"), ["psql"])
+
+    it "complains about a profile for a driver without any":
+        driver = SqliteDriver(DatabaseInfo.from_dict({"engine": "sqlite3", "name": "blah", "profile": "online"}))
+        with self.assertRaisesRegexp(UnknownProfile, "Can't choose a dump profile for sqlite3 databases"):
+            with driver.dump_command():
+                pass
+
 describe TestCase, "DriverTestBase":
 
     # Tell noseOfYeti not to run these tests in this class
@@ -255,7 +420,7 @@ describe TestCase, "DriverTestBase":
 
     it "complains if tries to determine if a database that doesn't exist is empty":
         self.dropdb()
-        if self.SQL_ENGINE == 'sqlite3':
+        if self.SQL_ENGINE.startswith('sqlite3'):
             with self.assertRaisesRegexp(NoDatabase, "There was no sqlite database.+"):
                 self.database_driver.is_empty()
         else:
@@ -451,3 +616,152 @@ describe TestCase, "DriverTestBase":
             assert 'sqlite3' in SqliteDriver.aliases
             assert 'django.db.backends.sqlite3' in SqliteDriver.aliases
 
+        it "knows how big the database is without the sqlite3 command":
+            self.createdb()
+            self.create_table("blah", "id integer")
+            with mock.patch.object(self.database_driver, "run_template") as run_template:
+                assert not self.database_driver.is_empty()
+                self.assertEqual(self.database_driver.estimated_size(), os.path.getsize(self.SQL_TEST_DB_NAME))
+                self.assertEqual(run_template.mock_calls, [])
+
+        it "only knows how many rows there are once ANALYZE has counted them":
+            self.createdb()
+            self.create_table("blah", "id integer")
+            self.insert_values("blah", ["(1)", "(2)", "(3)"])
+            self.assertIs(self.database_driver.row_counts(), None)
+
+            self.run_sql_command("analyze", "Analyzing")
+            self.insert_values("blah", ["(4)"])
+            self.assertEqual(self.database_driver.row_counts(), {"blah": 3})
+
+    describe "Sqlite File Driver":
+        # __only_run_tests_in_children__ Means the tests in the parent describe are run here
+
+        SQL_ENGINE = 'sqlite3_file'
+        DRIVER_KLS = SqliteFileDriver
+
+        @classmethod
+        def setupClass(cls):
+            cls.SQL_TEST_DB_NAME = tempfile.NamedTemporaryFile(delete=False).name
+
+        @classmethod
+        def see_if_database_exists(cls):
+            """Return whether our test database exists"""
+            return os.path.exists(cls.SQL_TEST_DB_NAME)
+
+        def _createdb(self):
+            """Sqlite just makes the database if it doesn't exist"""
+            return run_command("sqlite3", "{0} .schema".format(self.SQL_TEST_DB_NAME), "Making database")
+
+        def _dropdb(self):
+            """Assume there is a db to delete and drop it"""
+            os.remove(self.SQL_TEST_DB_NAME)
+
+        def run_sql_command(self, command, desc, extra=""):
+            """Run some command with sqlite cli"""
+            return run_command("sqlite3", "{0} \"{1}\" {2}".format(self.SQL_TEST_DB_NAME, command, extra), desc)
+
+        def insert_values(self, table_name, values):
+            """One value at a time like the Sqlite Driver"""
+            for val in values:
+                self.run_sql_command("insert into {0} values {1}".format(table_name, val), "Inserting value {0}".format(val))
+
+        it "has a plain alias":
+            assert 'sqlite3_file' in SqliteFileDriver.aliases
+
+        it "dumps a copy of the database file":
+            self.createdb()
+            self.create_table("blah", "id integer")
+            dump = ''.join(self.database_handler.dump())
+            self.assertEqual(dump[:16], "SQLite format 3\x00")
+
+        it "dumps a database that uses a WAL":
+            self.createdb()
+            self.run_sql_command("pragma journal_mode=wal", "Using a WAL")
+            self.create_table("blah", "id integer, val varchar(10)")
+            self.insert_values("blah", [(1, "one")])
+            dump = list(self.database_handler.dump())
+
+            self.dropdb()
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(self.SQL_TEST_DB_NAME + suffix):
+                    os.remove(self.SQL_TEST_DB_NAME + suffix)
+            self.createdb()
+            self.database_handler.restore(dump)
+            self.assertEqual([row for row in self.select_values("blah") if row], ["1|one"])
+
+        it "can restore a backup made with the sqlite3 engine":
+            self.createdb()
+            self.create_table("blah", "id integer, val varchar(10)")
+            self.insert_values("blah", [("1", "one"), ("2", "two")])
+            dump = list(DatabaseHandler({"engine": "sqlite3", "name": self.SQL_TEST_DB_NAME}).dump())
+
+            self.dropdb()
+            self.createdb()
+            self.database_handler.restore(dump)
+            self.assertEqual([row for row in self.select_values("blah") if row], ["1|one", "2|two"])
+
+        it "doesn't replace the database with something that isn't a database":
+            self.createdb()
+            with self.assertRaisesRegexp(FailedToRun, "Restoring database failed"):
+                self.database_handler.restore(["SQLite format 3\x00", "not really"])
+            assert self.database_driver.is_empty()
+
+        it "keys the digests of the pages so they don't say what's in the database":
+            def dump(state, since=None):
+                def ignore(food):
+                    for _ in food:
+                        pass
+                    return iter(())
+                with self.database_handler.dump_stage(state=state, since=since) as dumper:
+                    Pipeline([dumper, PythonStage(ignore, "Ignoring")]).run()
+                with open(state, "rb") as fle:
+                    return json.loads(fle.readline()), fle.read()
+
+            self.createdb()
+            self.create_table("blah", "id integer, val varchar(10)")
+            with open(self.SQL_TEST_DB_NAME, "rb") as fle:
+                first_page = fle.read(4096)
+
+            with a_temp_directory() as directory:
+                info, digests = dump(os.path.join(directory, "first.state"))
+                key = os.path.join(directory, ".db_backup_pages_key")
+                self.assertEqual(os.stat(key).st_mode & 0777, 0600)
+                self.assertEqual(info["page_size"], 4096)
+                self.assertNotEqual(digests[:16], hashlib.sha256(first_page).digest()[:16])
+
+                # A state file keyed with something else can't tell us what changed
+                with open(key, "w") as fle:
+                    fle.write(os.urandom(32).encode("hex"))
+                info, _ = dump(os.path.join(directory, "second.state"), since=os.path.join(directory, "first.state"))
+                self.assertEqual(info["kind"], "full")
+
+        it "can dump only the pages that changed and restore them over the previous dump":
+            def dump(state, since=None):
+                chunks = []
+                def collect(food):
+                    chunks.extend(chunk.tobytes() for chunk in food)
+                    return iter(())
+                with self.database_handler.dump_stage(state=state, since=since) as dumper:
+                    Pipeline([dumper, PythonStage(collect, "Collecting")]).run()
+                return ''.join(chunks)
+
+            self.createdb()
+            self.create_table("blah", "id integer, val varchar(10)")
+            self.run_sql_command("with recursive n(x) as (select 0 union all select x + 1 from n where x < 499) insert into blah select x, 'aaaaaaaaaa' from n", "Filling the table")
+
+            with a_temp_directory() as directory:
+                first = dump(os.path.join(directory, "first.state"))
+                self.insert_values("blah", [(500, "new")])
+                second = dump(os.path.join(directory, "second.state"), since=os.path.join(directory, "first.state"))
+
+            self.assertEqual(first[:16], "SQLite format 3\x00")
+            assert second.startswith("db_backup sqlite pages 1\n")
+            self.assertLess(len(second), len(first))
+
+            self.dropdb()
+            self.createdb()
+            self.database_handler.restore([first])
+            self.database_handler.restore([second])
+            self.assertEqual([row for row in self.select_values("blah") if row][-1], "500|new")
+
@@ -126,5 +126,5 @@ describe TestCase, "DatabaseHandler":
 
                 self.handler.restore(food)
                 fake_check_and_start_process.assert_called_once_with(command, options, "Restore command", capture_stdin=True, env=env, stdin=stdin)
-                fake_feed_process.assert_called_once_with(restorer, "Restoring database", food)
+                fake_feed_process.assert_called_once_with(restorer, "Restoring database", food, watchdog=mock.ANY, metrics=None)
 
@@ -1,13 +1,16 @@
 # coding: spec
 
-from db_backup.processes import wait_for, check_and_start_process, stdout_chunks
-from db_backup.errors import GPGFailedToStart, FailedToRun
-from db_backup.encryption import Encryptor
+from db_backup.processes import wait_for, check_and_start_process, stdout_chunks, Pipeline, PythonStage
+from db_backup.encryption import Encryptor, ChunkedEncryptor, encryptor_for, parse_keys, TRAILER
+from db_backup.errors import GPGFailedToStart, FailedToRun, BadBackupFile
+from db_backup.compression import find_codec
 
 from tests.utils import a_temp_file, path_to, copied_directory, gpg_fingerprint, setup_gpg_home
 from tests.case import TestCase
 
 from noseOfYeti.tokeniser.support import noy_sup_setUp
+import json
+import mock
 import os
 
 describe TestCase, "Encryptor":
@@ -19,6 +22,48 @@ describe TestCase, "Encryptor":
             with self.assertRaisesRegexp(GPGFailedToStart, "GPG didn't even start"):
                 self.encryptor.encrypt(["1", "2", "3"], ["lkasdf", "oiuweor"], dest)
 
+    it "complains about each recipient it can't find":
+        with self.assertRaisesRegexp(GPGFailedToStart, "GPG didn't even start: couldn't find a key for nobody@nowhere.com"):
+            self.encryptor.check_recipients(["bob@bob.com", "nobody@nowhere.com"], path_to("gpg"))
+
+    it "returns the fingerprints of the recipients":
+        fingerprints = self.encryptor.check_recipients(["bob@bob.com", "jade@stone.com"], path_to("gpg"))
+        self.assertEqual(fingerprints, ["4E57C1B01D958C30C4560003EC901116FC6BA54B", "B30E33401C2F02941E17CD82EE311C81AA8FF52B"])
+
+    it "remembers keys until the keyring changes":
+        with copied_directory(path_to("gpg")) as gpg_home:
+            setup_gpg_home(gpg_home)
+            self.encryptor.check_recipients(["bob@bob.com"], gpg_home)
+            with mock.patch("db_backup.encryption.stdout_chunks") as fake_stdout_chunks:
+                self.encryptor.check_recipients(["bob@bob.com"], gpg_home)
+                self.assertEqual(len(fake_stdout_chunks.mock_calls), 0)
+
+            process = check_and_start_process("gpg", "--homedir {0} --no-tty --batch --yes --delete-secret-and-public-key 4E57C1B01D958C30C4560003EC901116FC6BA54B".format(gpg_home), "Remove key")
+            wait_for(process, "Remove key", timeout=5)
+
+            with self.assertRaisesRegexp(GPGFailedToStart, "couldn't find a key for bob@bob.com"):
+                self.encryptor.check_recipients(["bob@bob.com"], gpg_home)
+
+    it "says what is wrong with keys it can't use":
+        output = "\n".join([
+              "pub:e:2048:1:AAAA:1394258844:1394259000::u:::scESC::::::23::0:"
+            , "fpr:::::::::EXPIRED:"
+            , "pub:r:2048:1:BBBB:1394258844:::u:::sc::::::23::0:"
+            , "fpr:::::::::REVOKED:"
+            , "pub:u:2048:1:CCCC:1394258844:::u:::scSC::::::23::0:"
+            , "fpr:::::::::SIGNONLY:"
+            , "sub:e:2048:1:DDDD:1394258844:1394259000:::::e::::::23:"
+            , "fpr:::::::::OLDSUB:"
+            ])
+        keys = parse_keys(output)
+        self.assertEqual([key.fingerprint for key in keys], ["EXPIRED", "REVOKED", "SIGNONLY"])
+        self.assertEqual([sub.fingerprint for sub in keys[2].subkeys], ["OLDSUB"])
+
+        self.assertEqual(keys[0].problem(), "expired at 2014-03-08 06:10:00 UTC")
+        self.assertEqual(keys[1].problem(), "has been revoked")
+        self.assertEqual(keys[2].problem(), "has no usable subkey that can encrypt")
+        self.assertIs(keys[2].problem("s"), None)
+
     it "can encrypt and decrypt a message":
         message = "1\n2\n3\n4"
         gpg_home = path_to("gpg")
@@ -64,3 +109,87 @@ describe TestCase, "Encryptor":
                 with self.assertRaisesRegexp(FailedToRun, "Decrypting something failed"):
                     list(self.encryptor.decrypt(dest, new_gpg_home, password="super_secret"))
 
+
+    it "decompresses what it decrypts if it was compressed":
+        with a_temp_file() as location:
+            with mock.patch.object(self.encryptor, "decrypted_head", return_value="\x28\xb5\x2f\xfd\x00\x00"):
+                stages = self.encryptor.decrypt_stages(location)
+            self.assertEqual([stage.desc for stage in stages], ["Decrypting something", "Decompressing with zstd"])
+
+            with mock.patch.object(self.encryptor, "decrypted_head", return_value="BEGIN TRANSACTION;"):
+                stages = self.encryptor.decrypt_stages(location)
+            self.assertEqual([stage.desc for stage in stages], ["Decrypting something"])
+
+describe TestCase, "ChunkedEncryptor":
+    before_each:
+        self.encryptor = ChunkedEncryptor(chunk_size=1000, workers=3)
+
+    def encrypt(self, message, dest, gpg_home, codec=None):
+        """Encrypt the message into a chunked container at dest"""
+        stage = self.encryptor.encrypt_stage(["bob@bob.com", "jade@stone.com"], dest, gpg_home, codec=codec)
+        Pipeline([PythonStage(lambda _: [message], "Message"), stage]).run()
+
+    def decrypt(self, dest, gpg_home):
+        """Decrypt the chunked container at dest"""
+        decrypted = bytearray()
+        def collect(chunks):
+            for chunk in chunks:
+                decrypted.extend(chunk)
+            return iter(())
+
+        stages = encryptor_for(dest).decrypt_stages(dest, gpg_home, password="super_secret")
+        Pipeline(stages + [PythonStage(collect, "Collect")]).run()
+        return str(decrypted)
+
+    it "can encrypt and decrypt a message in chunks":
+        message = ''.join(str(num) for num in range(5000))
+        with copied_directory(path_to("gpg")) as gpg_home:
+            setup_gpg_home(gpg_home)
+            with a_temp_file() as dest:
+                self.encrypt(message, dest, gpg_home)
+
+                with open(dest) as fle:
+                    encrypted = fle.read()
+                self.assertNotIn(message[:100], encrypted)
+
+                header, index = self.encryptor.read_container(dest, gpg_home, password="super_secret")
+                self.assertEqual((header["chunks"], len(index), header["codec"]), (19, 19, None))
+
+                self.assertIs(type(encryptor_for(dest)), ChunkedEncryptor)
+                self.assertEqual(self.decrypt(dest, gpg_home), message)
+
+    it "remembers the codec that compressed the chunks":
+        with copied_directory(path_to("gpg")) as gpg_home:
+            setup_gpg_home(gpg_home)
+            with a_temp_file() as dest:
+                self.encrypt("stuff", dest, gpg_home, codec=find_codec("gzip"))
+                stages = self.encryptor.decrypt_stages(dest, gpg_home, password="super_secret")
+                self.assertEqual([stage.desc for stage in stages], ["Decrypting chunks", "Decompressing with gzip"])
+
+    it "won't decrypt chunks that have been moved around":
+        with copied_directory(path_to("gpg")) as gpg_home:
+            setup_gpg_home(gpg_home)
+            with a_temp_file() as dest:
+                self.encrypt("a" * 1000 + "b" * 1000, dest, gpg_home)
+
+                with open(dest) as fle:
+                    encrypted = fle.read()
+                index_length, wrapped_length = TRAILER.unpack(encrypted[-TRAILER.size:])
+                index_start = len(encrypted) - TRAILER.size - wrapped_length - index_length
+                index = json.loads(encrypted[index_start:index_start + index_length])
+                swapped = json.dumps(list(reversed(index)))
+                self.assertEqual(len(swapped), index_length)
+
+                with open(dest, "w") as fle:
+                    fle.write(encrypted[:index_start] + swapped + encrypted[index_start + index_length:])
+
+                with self.assertRaisesRegexp(FailedToRun, "Decrypting chunk 0 failed"):
+                    self.decrypt(dest, gpg_home)
+
+    it "complains if it isn't a chunked backup":
+        with a_temp_file() as dest:
+            with open(dest, "w") as fle:
+                fle.write("blah")
+            self.assertIs(type(encryptor_for(dest)), Encryptor)
+            with self.assertRaisesRegexp(BadBackupFile, "isn't a chunked backup"):
+                self.encryptor.read_container(dest)
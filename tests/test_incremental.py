@@ -0,0 +1,37 @@
+# coding: spec
+
+from db_backup.incremental import ChainLink
+
+from tests.utils import a_temp_directory
+from tests.case import TestCase
+
+import json
+import os
+
+describe TestCase, "ChainLink":
+    def write_link(self, link, kind):
+        with open(link.state_path, "w") as fle:
+            fle.write("{0}\n".format(json.dumps({"kind": kind, "page_size": 1024, "page_count": 1})))
+        link.write()
+        return link
+
+    it "follows the chain back to the full backup":
+        with a_temp_directory() as directory:
+            first = self.write_link(ChainLink(os.path.join(directory, "one"), "db", created=1), "full")
+            second = self.write_link(first.after(os.path.join(directory, "two")), "incremental")
+            self.write_link(ChainLink(os.path.join(directory, "other"), "other_db", created=3), "full")
+
+            latest = ChainLink.latest(directory, "db")
+            self.assertEqual(latest.location, second.location)
+            self.assertEqual(latest.kind, "incremental")
+            self.assertEqual(latest.chain, [first.location, second.location])
+
+    it "starts a new chain when the dump had to be a full backup":
+        with a_temp_directory() as directory:
+            first = self.write_link(ChainLink(os.path.join(directory, "one"), "db"), "full")
+            second = self.write_link(first.after(os.path.join(directory, "two")), "full")
+            self.assertEqual(ChainLink.of(second.location).chain, [second.location])
+
+    it "isn't a link if there is no chain file":
+        with a_temp_directory() as directory:
+            self.assertIs(ChainLink.of(os.path.join(directory, "one")), None)
@@ -0,0 +1,58 @@
+# coding: spec
+
+from db_backup.manifest import StreamHash, Manifest
+from db_backup.processes import Pipeline, ProcessStage
+from db_backup.errors import FailedVerification
+
+from tests.utils import a_temp_directory
+from tests.case import TestCase
+
+import mock
+
+import hashlib
+import shlex
+import os
+
+describe TestCase, "StreamHash":
+    it "hashes what goes through it without changing it":
+        with a_temp_directory() as directory:
+            destination = os.path.join(directory, "out")
+            plaintext = StreamHash()
+            ciphertext = StreamHash()
+            Pipeline([ProcessStage("echo", "-n blah", "Echo"), plaintext.stage("Hashing"), ciphertext.writer(destination)]).run()
+
+            with open(destination) as fle:
+                self.assertEqual(fle.read(), "blah")
+            for hasher in (plaintext, ciphertext, StreamHash.of_file(destination)):
+                self.assertEqual((hasher.hexdigest(), hasher.size), (hashlib.sha256("blah").hexdigest(), 4))
+
+describe TestCase, "Manifest":
+    it "reads back what it wrote and complains about what doesn't match":
+        with a_temp_directory() as directory:
+            location = os.path.join(directory, "backup.gpg")
+            plaintext = StreamHash()
+            plaintext.update("dump")
+            ciphertext = StreamHash()
+            ciphertext.update("encrypted dump")
+            Manifest(location, plaintext, ciphertext).write()
+
+            manifest = Manifest(location)
+            expected = manifest.read()
+            self.assertEqual(expected["file"], "backup.gpg")
+            self.assertEqual(expected["plaintext"], {"sha256": hashlib.sha256("dump").hexdigest(), "size": 4})
+
+            manifest.plaintext.update("dump")
+            manifest.check(expected, "plaintext")
+            with self.assertRaisesRegexp(FailedVerification, "The ciphertext of the backup at '{0}' doesn't match it's manifest".format(location)):
+                manifest.check(expected, "ciphertext")
+
+    it "signs with a signer that has spaces in it":
+        with a_temp_directory() as directory:
+            location = os.path.join(directory, "backup.gpg")
+            with mock.patch("db_backup.manifest.stdout_chunks", return_value=iter([])) as stdout_chunks:
+                Manifest(location, StreamHash(), StreamHash()).write(signer="Bob <bob@bob.com>")
+
+            command, options, desc = stdout_chunks.call_args[0]
+            self.assertEqual(command, "gpg")
+            argv = shlex.split(options)
+            self.assertEqual(argv[argv.index("--local-user") + 1], "Bob <bob@bob.com>")
@@ -0,0 +1,491 @@
+# coding: spec
+
+from db_backup.processes import (
+      Reactor, Watchdog, ChunkPool, ChunkReader, Producer
+    , check_and_start_process, stdout_chunks, stdout_views, feed_process, supervise, supervise_all, process_parents
+    , check_for_command, resolve_command, resolved_commands, run_concurrently
+    , Pipeline, ProcessStage, PythonStage, Fanout, map_in_order, communicate, regroup
+    )
+from db_backup.errors import FailedToRun, TimedOut, NoCommand
+
+from tests.utils import a_temp_file
+from tests.case import TestCase
+
+from noseOfYeti.tokeniser.support import noy_sup_setUp
+import mock
+import pipes
+import time
+import os
+
+describe TestCase, "Reactor":
+    before_each:
+        self.reactor = Reactor()
+        read_fd, write_fd = os.pipe()
+        self.read_end = os.fdopen(read_fd, "r", 0)
+        self.write_end = os.fdopen(write_fd, "w", 0)
+
+    it "doesn't wake up readers when there is nothing to read":
+        self.reactor.add_reader(self.read_end)
+        start = time.time()
+        self.assertEqual(self.reactor.wait(0.2), ([], []))
+        self.assertGreater(time.time() - start, 0.15)
+
+    it "wakes up readers when there is something to read":
+        self.reactor.add_reader(self.read_end)
+        self.write_end.write("blah")
+        self.assertEqual(self.reactor.wait(1), ([self.read_end], []))
+
+    it "says readers are readable when the other end is closed":
+        self.reactor.add_reader(self.read_end)
+        self.write_end.close()
+        self.assertEqual(self.reactor.wait(1), ([self.read_end], []))
+
+    it "wakes up writers that can be written to":
+        self.reactor.add_writer(self.write_end)
+        self.assertEqual(self.reactor.wait(1), ([], [self.write_end]))
+
+    it "stops watching removed streams":
+        self.reactor.add_reader(self.read_end)
+        self.reactor.add_writer(self.write_end)
+        self.reactor.remove(self.write_end)
+        self.reactor.remove(self.read_end)
+        self.assertEqual(self.reactor.wait(1), ([], []))
+
+describe TestCase, "Reading chunks":
+    before_each:
+        read_fd, write_fd = os.pipe()
+        self.read_end = os.fdopen(read_fd, "r", 0)
+        self.write_end = os.fdopen(write_fd, "w", 0)
+
+    it "complains if the chunk_size doesn't fit in max_memory":
+        with self.assertRaisesRegexp(ValueError, "Need a positive chunk_size no bigger than max_memory \(got 10 and 5\)"):
+            ChunkPool(chunk_size=10, max_memory=5)
+
+    it "only allocates as many buffers as fit in max_memory":
+        pool = ChunkPool(chunk_size=10, max_memory=35)
+        self.assertEqual(len(pool.views), 3)
+        self.assertEqual([len(view) for view in pool.views], [10, 10, 10])
+
+    it "reads at most chunk_size into the buffers from the pool":
+        pool = ChunkPool(chunk_size=4, max_memory=8)
+        reader = ChunkReader(self.read_end, pool)
+        self.write_end.write("abcdefghij")
+
+        first = reader.read()
+        self.assertEqual(first.tobytes(), "abcd")
+        self.assertEqual(reader.read().tobytes(), "efgh")
+
+        # And the first buffer gets reused
+        self.assertEqual(reader.read().tobytes(), "ij")
+        self.assertEqual(first.tobytes(), "ijcd")
+
+    it "returns an empty view when the stream is closed":
+        reader = ChunkReader(self.read_end)
+        self.write_end.close()
+        self.assertEqual(len(reader.read()), 0)
+
+    it "yields views from a process that add up to all of it's output":
+        output = bytearray()
+        for view in stdout_views("seq", "10000", "Count", chunk_size=100, max_memory=200):
+            self.assertLessEqual(len(view), 100)
+            output.extend(view)
+        self.assertEqual(str(output).split(), [str(num) for num in range(1, 10001)])
+
+describe TestCase, "Process io":
+    it "yields stdout from a process as it arrives":
+        chunks = list(stdout_chunks("echo", "-n stuff", "Echo something"))
+        self.assertEqual(''.join(chunks), "stuff")
+
+    it "complains if the process fails":
+        with self.assertRaisesRegexp(FailedToRun, "Run false failed"):
+            list(stdout_chunks("false", "", "Run false"))
+
+    it "feeds a process with all the food":
+        with a_temp_file() as destination:
+            food = ["a" * 100000 for _ in range(10)]
+            process = check_and_start_process("tee", destination, "Tee something", capture_stdin=True)
+            feed_process(process, "Tee something", food)
+            with open(destination) as fle:
+                self.assertEqual(fle.read(), ''.join(food))
+
+describe TestCase, "Watchdog":
+    it "has no deadline if it has no timeouts":
+        watchdog = Watchdog("Something", idle_timeout=None, total_timeout=None)
+        self.assertIs(watchdog.remaining(), None)
+        watchdog.check()
+
+    it "complains when there hasn't been progress for idle_timeout":
+        watchdog = Watchdog("Something", idle_timeout=0.1)
+        watchdog.check()
+        time.sleep(0.15)
+        self.assertEqual(watchdog.remaining(), 0)
+        with self.assertRaisesRegexp(TimedOut, "Something made no progress for 0.1 seconds \(0 bytes\)"):
+            watchdog.check()
+
+    it "starts the idle clock again when there is progress":
+        watchdog = Watchdog("Something", idle_timeout=0.2)
+        time.sleep(0.15)
+        watchdog.progress(20)
+        time.sleep(0.15)
+        watchdog.check()
+        self.assertEqual(watchdog.progressed, 20)
+
+    it "complains when it runs out of total time regardless of progress":
+        watchdog = Watchdog("Something", idle_timeout=None, total_timeout=0.1)
+        watchdog.progress(20)
+        time.sleep(0.15)
+        with self.assertRaisesRegexp(TimedOut, "Something took longer than 0.1 seconds \(20 bytes\)"):
+            watchdog.check()
+
+    it "kills a process that is idle for too long":
+        start = time.time()
+        with self.assertRaisesRegexp(TimedOut, "Sleep made no progress"):
+            list(stdout_chunks("sleep", "10", "Sleep", idle_timeout=0.3))
+        self.assertLess(time.time() - start, 5)
+
+    it "lets a process that keeps making progress run for longer than the idle_timeout":
+        script = "for i in 1 2 3 4 5; do echo $i; sleep 0.1; done"
+        output = ''.join(stdout_chunks("sh", "-c '{0}'".format(script), "Count", idle_timeout=0.5))
+        self.assertEqual(output.split(), ["1", "2", "3", "4", "5"])
+
+    it "kills a process that makes progress but runs out of total time":
+        script = "while true; do echo 1; sleep 0.05; done"
+        with self.assertRaisesRegexp(TimedOut, "Count took longer than 0.3 seconds"):
+            list(stdout_chunks("sh", "-c '{0}'".format(script), "Count", total_timeout=0.3))
+
+describe TestCase, "Supervising processes":
+    it "passes the output of one process straight into the next":
+        with a_temp_file() as destination:
+            producer = check_and_start_process("seq", "100000", "Count")
+            consumer = check_and_start_process("tee", destination, "Tee something", source=producer.stdout)
+            producer.stdout.close()
+
+            supervise([(producer, Watchdog("Count")), (consumer, Watchdog("Tee something"))])
+            with open(destination) as fle:
+                self.assertEqual(fle.read().split(), [str(num) for num in range(1, 100001)])
+
+    it "complains and kills the rest if one of the processes fails":
+        producer = check_and_start_process("sh", "-c 'echo 1; exit 1'", "Fail")
+        consumer = check_and_start_process("sleep", "10", "Sleep", source=producer.stdout)
+        producer.stdout.close()
+
+        start = time.time()
+        with self.assertRaisesRegexp(FailedToRun, "Fail failed"):
+            supervise([(producer, Watchdog("Fail")), (consumer, Watchdog("Sleep"))])
+        self.assertLess(time.time() - start, 5)
+        self.assertIsNot(consumer.poll(), None)
+
+    it "counts what the children of a process do as it's progress":
+        # The shell itself doesn't read or write anything while it waits for the loop
+        script = "for i in 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16; do echo $i; sleep 0.25; done"
+        process = check_and_start_process("sh", "-c 'sh -c \"$0\" > /dev/null; echo done' {0}".format(pipes.quote(script)), "Loop")
+        supervise([(process, Watchdog("Loop", idle_timeout=2))])
+
+    it "reads /proc once an interval for all the supervisors rather than for every process every tick":
+        scans = []
+        def counted():
+            scans.append(time.time())
+            return process_parents()
+
+        supervisors = [Pipeline([ProcessStage("sh", "-c 'sleep 1.5'", "Sleep"), ProcessStage("cat", "", "Cat")]).start() for _ in range(5)]
+        with mock.patch("db_backup.processes.process_parents", counted):
+            self.assertEqual(supervise_all(supervisors), [None] * 5)
+        self.assertLessEqual(len(scans), 3)
+
+describe TestCase, "Fanning out":
+    it "gives everything to every branch":
+        received = bytearray()
+        def collect(chunks):
+            for chunk in chunks:
+                received.extend(chunk)
+            return iter(())
+
+        with a_temp_file() as destination1:
+            with a_temp_file() as destination2:
+                Pipeline([
+                      ProcessStage("seq", "100000", "Count")
+                    , Fanout([
+                          [ProcessStage("tee", destination1, "Tee one")]
+                        , [ProcessStage("cat", "", "Cat something"), ProcessStage("tee", destination2, "Tee two")]
+                        , [PythonStage(collect, "Collect")]
+                        ])
+                    ]).run()
+
+                expected = [str(num) for num in range(1, 100001)]
+                for destination in (destination1, destination2):
+                    with open(destination) as fle:
+                        self.assertEqual(fle.read().split(), expected)
+                self.assertEqual(str(received).split(), expected)
+
+    it "lets a slow branch fall behind by up to buffer_size":
+        script = "sleep 0.5; cat > /dev/null"
+        fast_done = []
+        def fast(chunks):
+            for chunk in chunks:
+                pass
+            fast_done.append(time.time())
+            return iter(())
+
+        start = time.time()
+        Pipeline([
+              ProcessStage("head", "-c 200000 /dev/zero", "Zeros")
+            , Fanout([[PythonStage(fast, "Fast")], [ProcessStage("sh", "-c '{0}'".format(script), "Slow")]], buffer_size=1000000)
+            ]).run()
+        self.assertLess(fast_done[0] - start, 0.4)
+
+    it "complains and kills everything if a branch fails":
+        with self.assertRaisesRegexp(FailedToRun, "Fail failed"):
+            Pipeline([
+                  ProcessStage("seq", "100000", "Count")
+                , Fanout([[ProcessStage("cat", "", "Cat something")], [ProcessStage("sh", "-c 'exit 1'", "Fail")]])
+                ]).run()
+
+    it "has to be the last stage":
+        with self.assertRaisesRegexp(ValueError, "Fanning out has to be the last stage"):
+            Pipeline([ProcessStage("seq", "10", "Count"), Fanout([]), ProcessStage("cat", "", "Cat something")]).run()
+
+describe TestCase, "Producer":
+    it "yields everything from the iterator in order":
+        producer = Producer(iter(range(100)), queue_size=2)
+        producer.start()
+        self.assertEqual(list(producer), range(100))
+
+    it "raises whatever the iterator raised":
+        AnException = type("AnException", (Exception, ), {})
+        def food():
+            yield 1
+            raise AnException("hmmm")
+
+        producer = Producer(food())
+        producer.start()
+        with self.assertRaisesRegexp(AnException, "hmmm"):
+            list(producer)
+
+    it "closes the iterator when it's stopped early":
+        closed = []
+        def food():
+            try:
+                while True:
+                    yield "a"
+            finally:
+                closed.append(True)
+
+        producer = Producer(food(), queue_size=1)
+        producer.start()
+        for _ in producer:
+            break
+        producer.stop()
+        producer.join(5)
+        self.assertEqual(closed, [True])
+
+    it "makes feed_process complain and kill the process when the food fails":
+        AnException = type("AnException", (Exception, ), {})
+        def food():
+            yield "a"
+            raise AnException("hmmm")
+
+        process = check_and_start_process("cat", "", "Cat something", capture_stdin=True)
+        with self.assertRaisesRegexp(AnException, "hmmm"):
+            feed_process(process, "Cat something", food())
+        self.assertIsNot(process.poll(), None)
+
+describe TestCase, "Finding commands":
+    it "finds the absolute path to a command":
+        location = resolve_command("sh")
+        assert os.path.isabs(location)
+        assert os.access(location, os.X_OK)
+
+    it "only looks for a command once":
+        resolved_commands.clear()
+        with mock.patch("db_backup.processes.find_command") as find_command:
+            find_command.return_value = "/bin/blah"
+            self.assertEqual(resolve_command("blah"), "/bin/blah")
+            self.assertEqual(resolve_command("blah"), "/bin/blah")
+            self.assertEqual(len(find_command.mock_calls), 1)
+        resolved_commands.clear()
+
+    it "complains if the command doesn't exist":
+        with self.assertRaisesRegexp(NoCommand, "It seems you need to install not_a_real_command for Testing"):
+            check_for_command("not_a_real_command", "Testing")
+
+describe TestCase, "Running things concurrently":
+    it "returns what each function returned in order":
+        self.assertEqual(run_concurrently(lambda: 1, lambda: 2, lambda: 3), [1, 2, 3])
+
+    it "runs them at the same time":
+        start = time.time()
+        run_concurrently(*[lambda: time.sleep(0.2) for _ in range(5)])
+        self.assertLess(time.time() - start, 0.6)
+
+    it "raises the first exception":
+        AnException = type("AnException", (Exception, ), {})
+        def fail(message):
+            raise AnException(message)
+
+        with self.assertRaisesRegexp(AnException, "first"):
+            run_concurrently(lambda: 1, lambda: fail("first"), lambda: fail("second"))
+
+    it "maps in threads but gives back results in order":
+        def slow(num):
+            time.sleep(0.01 * (num % 3))
+            return num * 2
+
+        start = time.time()
+        self.assertEqual(list(map_in_order(slow, range(30), workers=5)), [num * 2 for num in range(30)])
+        self.assertLess(time.time() - start, 0.3)
+
+    it "doesn't pull items much faster than results are used":
+        pulled = []
+        def items():
+            for num in range(100):
+                pulled.append(num)
+                yield num
+
+        results = map_in_order(lambda num: num, items(), workers=2)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(pulled), 4)
+        results.close()
+
+    it "raises what the function raised when it gets to that item":
+        AnException = type("AnException", (Exception, ), {})
+        def fail(num):
+            if num == 3:
+                raise AnException("hmmm")
+            return num
+
+        results = map_in_order(fail, range(10), workers=2)
+        self.assertEqual([next(results) for _ in range(3)], [0, 1, 2])
+        with self.assertRaisesRegexp(AnException, "hmmm"):
+            next(results)
+
+describe TestCase, "Communicating with a process":
+    it "gives the process all the data and returns all it's output":
+        data = "a" * 1000000
+        self.assertEqual(communicate("cat", "", "Cat something", data), data)
+
+    it "complains if the process fails":
+        with self.assertRaisesRegexp(FailedToRun, "Fail failed"):
+            communicate("sh", "-c 'exit 1'", "Fail", "a" * 1000000)
+
+    it "regroups chunks into pieces of the same size":
+        self.assertEqual(list(regroup(["ab", "cde", "", "fghij", "k"], 3)), ["abc", "def", "ghi", "jk"])
+        self.assertEqual(list(regroup([], 3)), [])
+
+describe TestCase, "Process stats":
+    it "records what a process cost when it's reaped":
+        reported = []
+        output = ''.join(stdout_chunks("head", "-c 100000 /dev/zero", "Zeros", metrics=reported.append))
+        self.assertEqual(len(output), 100000)
+
+        self.assertEqual(len(reported), 1)
+        stats = reported[0]
+        self.assertEqual(stats.desc, "Zeros")
+        self.assertEqual(stats.returncode, 0)
+        self.assertGreater(stats.max_rss, 0)
+        self.assertGreaterEqual(stats.cpu_time, 0)
+        self.assertGreaterEqual(stats.blocked_read, 0)
+        self.assertGreater(stats.wall_time, 0)
+        if os.path.exists("/proc/self/io"):
+            self.assertGreaterEqual(stats.bytes_out, 100000)
+            self.assertGreater(stats.throughput, 0)
+
+    it "reports processes that fail as well":
+        reported = []
+        with self.assertRaises(FailedToRun):
+            list(stdout_chunks("false", "", "Fail", metrics=reported.append))
+        self.assertEqual([stats.returncode for stats in reported], [1])
+
+describe TestCase, "Pipeline":
+    it "passes data from one process to the next":
+        with a_temp_file() as destination:
+            Pipeline([
+                  ProcessStage("seq", "100000", "Count")
+                , ProcessStage("tee", destination, "Tee something")
+                ]).run()
+
+            with open(destination) as fle:
+                self.assertEqual(fle.read().split(), [str(num) for num in range(1, 100001)])
+
+    it "puts python stages between processes":
+        def shout(chunks):
+            for chunk in chunks:
+                yield chunk.tobytes().upper()
+
+        def exclaim(chunks):
+            for chunk in chunks:
+                yield chunk.replace("\n", "!\n")
+
+        with a_temp_file() as destination:
+            Pipeline([
+                  ProcessStage("sh", "-c 'for i in 1 2 3; do echo stuff; done'", "Stuff")
+                , PythonStage(shout, "Shout")
+                , PythonStage(exclaim, "Exclaim")
+                , ProcessStage("tee", destination, "Tee something")
+                ]).run()
+
+            with open(destination) as fle:
+                self.assertEqual(fle.read(), "STUFF!\nSTUFF!\nSTUFF!\n")
+
+    it "can start and end with python stages":
+        received = bytearray()
+        def collect(chunks):
+            for chunk in chunks:
+                received.extend(chunk)
+            return iter(())
+
+        Pipeline([
+              PythonStage(lambda _: ("a" * 100000 for _ in range(10)), "Food")
+            , ProcessStage("cat", "", "Cat something")
+            , PythonStage(collect, "Collect")
+            ], chunk_size=1000, max_memory=2000).run()
+        self.assertEqual(str(received), "a" * 1000000)
+
+    it "raises what a python stage raised and kills the processes":
+        AnException = type("AnException", (Exception, ), {})
+        def fail(chunks):
+            for chunk in chunks:
+                raise AnException("hmmm")
+            yield ""
+
+        supervisor = Pipeline([
+              ProcessStage("yes", "", "Yes")
+            , PythonStage(fail, "Fail")
+            , ProcessStage("cat", "", "Cat something")
+            ]).start()
+
+        with self.assertRaisesRegexp(AnException, "hmmm"):
+            supervisor.run()
+        for process, _ in supervisor.stages:
+            self.assertIsNot(process.poll(), None)
+
+    it "complains and kills everything if one of the processes fails":
+        start = time.time()
+        with self.assertRaisesRegexp(FailedToRun, "Fail failed"):
+            Pipeline([
+                  ProcessStage("yes", "", "Yes")
+                , PythonStage(lambda chunks: chunks, "Nothing")
+                , ProcessStage("sh", "-c 'head -c 10 > /dev/null; exit 1'", "Fail")
+                ]).run()
+        self.assertLess(time.time() - start, 5)
+
+    it "kills a python stage that stops making progress":
+        def stall(chunks):
+            time.sleep(2)
+            yield ""
+
+        start = time.time()
+        with self.assertRaisesRegexp(TimedOut, "Stall made no progress"):
+            Pipeline([PythonStage(stall, "Stall"), ProcessStage("cat", "", "Cat something")], idle_timeout=0.3).run()
+        self.assertLess(time.time() - start, 5)
+
+    it "reports stats for processes and python stages":
+        reported = []
+        Pipeline([
+              ProcessStage("head", "-c 100000 /dev/zero", "Zeros")
+            , PythonStage(lambda chunks: chunks, "Nothing")
+            , ProcessStage("cat", "", "Cat something")
+            ], metrics=reported.append).run()
+
+        self.assertEqual(sorted(stats.desc for stats in reported), ["Cat something", "Nothing", "Zeros"])
+        segment = [stats for stats in reported if stats.desc == "Nothing"][0]
+        self.assertEqual((segment.bytes_in, segment.bytes_out, segment.returncode), (100000, 100000, 0))
@@ -0,0 +1,169 @@
+# coding: spec
+
+from db_backup.databases import SqliteDriver, SqliteFileDriver, MysqlDriver, PsqlDriver, DatabaseInfo
+from db_backup.tables import TableIndex, keep_ranges, with_offsets
+from db_backup.errors import BadBackupFile, NoTableIndex
+
+from tests.utils import a_temp_directory
+from tests.case import TestCase
+
+from textwrap import dedent
+import os
+
+dump = dedent("""
+    PRAGMA foreign_keys=OFF;
+    BEGIN TRANSACTION;
+    CREATE TABLE blah (id integer primary key autoincrement, val text);
+    INSERT INTO blah VALUES(1,'one');
+    CREATE TABLE IF NOT EXISTS "other things" (val text);
+    INSERT INTO "other things" VALUES('two');
+    INSERT INTO sqlite_sequence VALUES('blah',1);
+    CREATE INDEX blah_val on blah(val);
+    COMMIT;
+    """).lstrip()
+
+describe TestCase, "TableIndex":
+    def index(self, pieces):
+        index = SqliteDriver(DatabaseInfo("sqlite3", "blah")).table_index()
+        for piece in pieces:
+            index.update(piece)
+        index.finish()
+        return index
+
+    it "finds the tables however the dump is split up":
+        expected = None
+        for size in (1, 2, 7, 64, len(dump)):
+            index = self.index([dump[start:start + size] for start in range(0, len(dump), size)])
+            if expected is None:
+                expected = index.sections
+            self.assertEqual(index.sections, expected)
+            self.assertEqual(index.size, len(dump))
+
+        self.assertEqual(index.tables, ["blah", "other things", "sqlite_sequence"])
+
+    it "only keeps the tables it's asked for and everything that isn't a table":
+        index = self.index([dump])
+        kept = "".join(keep_ranges(with_offsets([dump[:50], dump[50:]]), index.ranges(["blah"])))
+        self.assertEqual(kept, dedent("""
+            PRAGMA foreign_keys=OFF;
+            BEGIN TRANSACTION;
+            CREATE TABLE blah (id integer primary key autoincrement, val text);
+            INSERT INTO blah VALUES(1,'one');
+            CREATE INDEX blah_val on blah(val);
+            COMMIT;
+            """).lstrip())
+
+        with self.assertRaisesRegexp(BadBackupFile, "The backup doesn't have these tables: nope"):
+            index.ranges(["blah", "nope"])
+
+    it "finds tables in mysqldumps":
+        index = MysqlDriver(DatabaseInfo("mysql", "blah")).table_index()
+        index.update("/*!40101 SET NAMES utf8 */;\n--\n-- Table structure for table `blah`\n--\nCREATE TABLE `blah` (id int);\n")
+        index.update("--\n-- Dumping data for table `blah`\n--\nINSERT INTO `blah` VALUES (1);\n/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;\n")
+        index.finish()
+        self.assertEqual([name for name, _ in index.sections], [None, "blah", None])
+
+    it "gives the indexes, grants and sequences in a pg_dump to their table":
+        pg_dump = dedent("""
+            SET statement_timeout = 0;
+
+            --
+            -- Name: blah; Type: TABLE; Schema: public; Owner: bob
+            --
+
+            CREATE TABLE public.blah (id integer NOT NULL);
+
+            --
+            -- Name: other; Type: TABLE; Schema: public; Owner: bob
+            --
+
+            CREATE TABLE public.other (id integer NOT NULL, val text);
+
+            --
+            -- Name: TABLE other; Type: COMMENT; Schema: public; Owner: bob
+            --
+
+            COMMENT ON TABLE public.other IS 'other things';
+
+            --
+            -- Name: other_id_seq; Type: SEQUENCE; Schema: public; Owner: bob
+            --
+
+            CREATE SEQUENCE public.other_id_seq START WITH 1;
+
+            --
+            -- Name: other_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: bob
+            --
+
+            ALTER SEQUENCE public.other_id_seq OWNED BY public.other.id;
+
+            --
+            -- Data for Name: blah; Type: TABLE DATA; Schema: public; Owner: bob
+            --
+
+            COPY public.blah (id) FROM stdin;
+            1
+            \\.
+
+            --
+            -- Data for Name: other; Type: TABLE DATA; Schema: public; Owner: bob
+            --
+
+            COPY public.other (id, val) FROM stdin;
+            1\tone
+            \\.
+
+            --
+            -- Name: other_val; Type: INDEX; Schema: public; Owner: bob
+            --
+
+            CREATE INDEX other_val ON public.other USING btree (val);
+
+            --
+            -- Name: blah_id; Type: INDEX; Schema: public; Owner: bob
+            --
+
+            CREATE UNIQUE INDEX blah_id ON ONLY public.blah USING btree (id);
+
+            --
+            -- Name: TABLE other; Type: ACL; Schema: public; Owner: bob
+            --
+
+            GRANT SELECT ON TABLE public.other TO reader;
+
+            --
+            -- PostgreSQL database dump complete
+            --
+            """).lstrip()
+
+        index = PsqlDriver(DatabaseInfo("psql", "blah")).table_index()
+        for start in range(0, len(pg_dump), 7):
+            index.update(pg_dump[start:start + 7])
+        index.finish()
+        self.assertEqual(index.tables, ["blah", "other"])
+
+        kept = "".join(keep_ranges(with_offsets([pg_dump]), index.ranges(["blah"])))
+        statements = [line for line in kept.split("\n") if line and not line.startswith("--")]
+        self.assertEqual(statements, [
+              "SET statement_timeout = 0;"
+            , "CREATE TABLE public.blah (id integer NOT NULL);"
+            , "CREATE SEQUENCE public.other_id_seq START WITH 1;"
+            , "COPY public.blah (id) FROM stdin;"
+            , "1"
+            , "\\."
+            , "CREATE UNIQUE INDEX blah_id ON ONLY public.blah USING btree (id);"
+            ])
+
+    it "remembers where the tables are next to the backup":
+        with a_temp_directory() as directory:
+            location = os.path.join(directory, "backup")
+            index = self.index([dump])
+            index.write(location, lambda data: data[::-1])
+            self.assertEqual(TableIndex.read(location, lambda data: data[::-1]).ranges(["blah"]), index.ranges(["blah"]))
+
+            with self.assertRaisesRegexp(BadBackupFile, "The backup at '{0}' has no table index".format(os.path.join(directory, "other"))):
+                TableIndex.read(os.path.join(directory, "other"), lambda data: data)
+
+    it "can't find tables in dumps that aren't sql":
+        with self.assertRaisesRegexp(NoTableIndex, "Can't find the tables in dumps of sqlite3_file databases"):
+            SqliteFileDriver(DatabaseInfo("sqlite3_file", "blah")).table_index()